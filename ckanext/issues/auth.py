@@ -1,16 +1,42 @@
 from ckan import model
 import ckan.plugins as p
 from ckanext.issues import model as issue_model
+from ckanext.issues.lib.util import request_cache
+
+
+def check_dataset_access(privilege, context, dataset_id):
+    '''check_access(privilege, context, {'id': dataset_id}), remembering the
+    decision for the user, dataset and privilege until the end of the
+    request, as one page can ask the same thing many times over.
+
+    Returns True or raises NotAuthorized.
+    '''
+    decisions = None
+    if not context.get('ignore_auth'):
+        decisions = request_cache('dataset_access')
+    key = (context.get('user'), dataset_id, privilege)
+    if decisions is not None and key in decisions:
+        allowed = decisions[key]
+    else:
+        try:
+            allowed = p.toolkit.check_access(privilege, context,
+                                             {'id': dataset_id})
+        except p.toolkit.NotAuthorized:
+            allowed = False
+        if decisions is not None:
+            decisions[key] = allowed
+    if not allowed:
+        raise p.toolkit.NotAuthorized
+    return True
 
 
 def issue_auth(context, data_dict, privilege='package_update'):
     '''Returns whether the current user is allowed to do the action
     (privilege).'''
-    auth_data_dict = dict(data_dict)
     # we're checking package access so it is dataset/package id
-    auth_data_dict['id'] = auth_data_dict['dataset_id']
+    dataset_id = data_dict['dataset_id']
     try:
-        p.toolkit.check_access(privilege, context, auth_data_dict)
+        check_dataset_access(privilege, context, dataset_id)
         return {'success': True}
     except p.toolkit.NotAuthorized:
         return {
@@ -18,7 +44,7 @@ def issue_auth(context, data_dict, privilege='package_update'):
             'msg': p.toolkit._(
                 'User {0} not authorized for action on issue {1}'.format(
                     str(context['user']),
-                    auth_data_dict['id']
+                    dataset_id
                 )
             )
         }
@@ -29,6 +55,11 @@ def issue_show(context, data_dict):
     return issue_auth(context, data_dict, 'package_show')
 
 
+@p.toolkit.auth_allow_anonymous_access
+def issue_comment_list(context, data_dict):
+    return issue_auth(context, data_dict, 'package_show')
+
+
 @p.toolkit.auth_allow_anonymous_access
 def issue_search(context, data_dict):
     try:
@@ -117,6 +148,32 @@ def issue_admin(context, data_dict):
     return issue_auth(context, data_dict)
 
 
+def issue_search_cache_stats(context, data_dict):
+    '''sysadmins only'''
+    return {'success': False}
+
+
+def issue_bulk_create(context, data_dict):
+    '''sysadmins only'''
+    return {'success': False}
+
+
+@p.toolkit.auth_disallow_anonymous_access
+def issue_export(context, data_dict):
+    '''organization admins for their organization's issues, those who can
+    edit a dataset for its issues, and sysadmins for the whole site's'''
+    if data_dict.get('organization_id'):
+        try:
+            p.toolkit.check_access('organization_update', context,
+                                   {'id': data_dict['organization_id']})
+            return {'success': True}
+        except p.toolkit.NotAuthorized:
+            return {'success': False}
+    if data_dict.get('dataset_id'):
+        return issue_auth(context, data_dict)
+    return {'success': False}
+
+
 @p.toolkit.auth_allow_anonymous_access
 def issue_comment_search(context, data_dict):
     return {'success': True}
@@ -13,6 +13,46 @@ class Issues(CkanCommand):
 
         paster issues upgrade_db
            - Does any database migrations required (idempotent)
+
+        paster issues backfill_comment_stats
+           - Recalculates the comment count and last activity stored on
+             every issue from its comments
+
+        paster issues backfill_dataset_stats
+           - Recalculates the issue counts and last activity stored for
+             every dataset
+
+        paster issues rebuild_search_index
+           - Reindexes the title, description and comments of every issue
+             for full text search
+
+        paster issues send_notifications [batch_size]
+           - Emails the notifications waiting in the outbox, retrying ones
+             that failed before once their backoff has passed. Run it
+             regularly, e.g. from cron, unless
+             ckanext.issues.send_notifications_inline is set
+
+        paster issues reindex_datasets [batch_size]
+           - Updates the issue counts in the search index of the datasets
+             whose issues changed since the last run. Run it regularly,
+             e.g. from cron, unless ckanext.issues.reindex_datasets is false
+
+        paster issues rerender_markdown [--all]
+           - Stores the rendered Markdown of every issue and comment that
+             was rendered by an older version of the renderer, or of every
+             one with --all
+
+        paster issues export [csv|jsonl] [name=value ...] > FILE
+           - Writes the issues and their comments as CSV (the default) or
+             JSON Lines, reading them in batches. The name=value filters are
+             the parameters of the issue_export action, e.g.
+             organization_id=my-org since=2016-01-01
+
+        paster issues import FILE [batch_size]
+           - Creates the issues, with their comments, in a JSON Lines file,
+             one issue per line as for the issue_bulk_create action, in
+             batches (of 500 by default). Lines with errors are reported
+             and left out. No notifications are sent.
     """
     summary = __doc__.split('\n')[0]
     usage = __doc__
@@ -38,5 +78,120 @@ class Issues(CkanCommand):
             from ckanext.issues.model import upgrade
             upgrade()
             self.log.info('Issues tables are up to date')
+        elif cmd == 'backfill_comment_stats':
+            from ckan import model
+            from ckanext.issues.model import backfill_comment_stats
+            count = backfill_comment_stats(model.Session)
+            model.Session.commit()
+            self.log.info('Comment stats updated for %s issues', count)
+        elif cmd == 'backfill_dataset_stats':
+            from ckan import model
+            from ckanext.issues.model import backfill_dataset_stats
+            count = backfill_dataset_stats(model.Session)
+            model.Session.commit()
+            self.log.info('Issue stats updated for %s datasets', count)
+        elif cmd == 'rebuild_search_index':
+            from ckan import model
+            from ckanext.issues.model import search
+            if search.rebuild_index(model.Session):
+                model.Session.commit()
+                self.log.info('Issues search index rebuilt')
+            else:
+                self.log.error('There is no full text index for issues, '
+                               'run upgrade_db first')
+        elif cmd == 'send_notifications':
+            from ckan import model
+            from ckanext.issues.lib import notifications
+            batch_size = int(self.args[1]) if len(self.args) > 1 else 100
+            sent, failed = notifications.send_queued(model.Session,
+                                                     batch_size=batch_size)
+            self.log.info('Sent %s notifications, %s failed', sent, failed)
+        elif cmd == 'reindex_datasets':
+            from ckan import model
+            from ckanext.issues.lib import dataset_index
+            batch_size = int(self.args[1]) if len(self.args) > 1 else 100
+            reindexed, failed = dataset_index.reindex_queued(
+                model.Session, batch_size=batch_size)
+            self.log.info('Reindexed %s datasets, %s failed', reindexed,
+                          failed)
+        elif cmd == 'rerender_markdown':
+            from ckan import model
+            from ckanext.issues.model import rendering
+            count = rendering.rerender_all(model.Session,
+                                           force='--all' in self.args[1:])
+            self.log.info('Rendered the Markdown of %s issues and comments',
+                          count)
+        elif cmd == 'export':
+            self._export(self.args[1:])
+        elif cmd == 'import':
+            if len(self.args) < 2:
+                print self.usage
+                sys.exit(1)
+            batch_size = int(self.args[2]) if len(self.args) > 2 else 500
+            self._import(self.args[1], batch_size)
         else:
             self.log.error('Command %s not recognized' % (cmd,))
+
+    def _export(self, args):
+        from ckan import model
+        from ckan.plugins import toolkit
+        data_dict = {}
+        for arg in args:
+            if '=' in arg:
+                name, value = arg.split('=', 1)
+                data_dict[name] = value
+            else:
+                data_dict['format'] = arg
+        context = {'model': model, 'session': model.Session,
+                   'ignore_auth': True}
+        try:
+            chunks = toolkit.get_action('issue_export')(context, data_dict)
+        except toolkit.ValidationError, e:
+            self.log.error('Invalid export: %s', e.error_summary)
+            sys.exit(1)
+        for chunk in chunks:
+            sys.stdout.write(chunk)
+        sys.stdout.flush()
+
+    def _import(self, path, batch_size):
+        import json
+        from ckan import model
+        from ckan.plugins import toolkit
+        site_user = toolkit.get_action('get_site_user')(
+            {'model': model, 'ignore_auth': True}, {})
+        context = {'model': model, 'session': model.Session,
+                   'user': site_user['name'], 'ignore_auth': True}
+        created = failed = 0
+
+        def create(issues, line_numbers):
+            result = toolkit.get_action('issue_bulk_create')(
+                dict(context), {'issues': issues, 'batch_size': batch_size})
+            for error in result['errors']:
+                self.log.error('Line %s: %s', line_numbers[error['index']],
+                               error['errors'])
+            return result['created'], len(result['errors'])
+
+        issues = []
+        line_numbers = []
+        with open(path) as lines:
+            for line_number, line in enumerate(lines, 1):
+                if not line.strip():
+                    continue
+                try:
+                    issues.append(json.loads(line))
+                    line_numbers.append(line_number)
+                except ValueError, e:
+                    self.log.error('Line %s: %s', line_number, e)
+                    failed += 1
+                if len(issues) >= batch_size:
+                    batch_created, batch_failed = create(issues,
+                                                         line_numbers)
+                    created += batch_created
+                    failed += batch_failed
+                    issues = []
+                    line_numbers = []
+        if issues:
+            batch_created, batch_failed = create(issues, line_numbers)
+            created += batch_created
+            failed += batch_failed
+        self.log.info('Created %s issues, %s left out', created, failed)
@@ -1,14 +1,18 @@
 import collections
+import hashlib
+import json
 from logging import getLogger
 import re
+import time
 
 from sqlalchemy import func
 from pylons.i18n import _
-from pylons import request, config, tmpl_context as c
+from pylons import request, response, config, tmpl_context as c
+from pylons.controllers.util import etag_cache
 
 from ckan.lib.base import BaseController, render, abort
 import ckan.lib.helpers as h
-from ckan.lib import mailer
+from ckan.lib.mailer import MailerException
 import ckan.model as model
 import ckan.logic as logic
 import ckan.plugins as p
@@ -18,9 +22,14 @@ import ckanext.issues.model as issuemodel
 from ckanext.issues.controller import show
 from ckanext.issues.exception import ReportAlreadyExists
 from ckanext.issues.lib import helpers as issues_helpers
+from ckanext.issues.lib.export import CONTENT_TYPES as EXPORT_CONTENT_TYPES
 from ckanext.issues.logic import schema
 from ckanext.issues.lib.helpers import (Pagination, get_issues_per_page,
-                                        get_issue_subject)
+                                        get_listing_count_limit,
+                                        get_issue_subject,
+                                        get_comments_per_page)
+from ckanext.issues.lib.mailer import NotificationSender
+from ckanext.issues.model import membership
 
 log = getLogger(__name__)
 
@@ -122,10 +131,23 @@ class IssueController(BaseController):
 
     def show(self, issue_number, dataset_id):
         dataset = self._before_dataset(dataset_id)
+        if issue_number.isdigit():
+            count, last_modified = issuemodel.Issue.get_last_modified(
+                dataset_id=dataset['id'], issue_number=int(issue_number))
+            if count:
+                # the page also shows who the dataset's editors are (as
+                # owner badges), users' names and a page of comments
+                _answer_if_not_modified(last_modified,
+                                        dataset['metadata_modified'],
+                                        _editor_ids(dataset['owner_org']),
+                                        membership.cache_generation(),
+                                        get_comments_per_page())
         try:
-            extra_vars = show.show(issue_number,
-                                   dataset_id,
-                                   session=model.Session)
+            extra_vars = show.show(
+                issue_number,
+                dataset_id,
+                session=model.Session,
+                comment_cursor=request.params.get('comment_cursor'))
         except toolkit.ValidationError, e:
             p.toolkit.abort(
                 404, toolkit._('Issue not found: {0}'.format(e.error_summary)))
@@ -231,7 +253,11 @@ class IssueController(BaseController):
         Display a page containing a list of all issues items for a dataset,
         sorted by category.
         """
-        self._before_dataset(dataset_id)
+        dataset = self._before_dataset(dataset_id)
+        count, last_modified = issuemodel.Issue.get_last_modified(
+            dataset_id=dataset['id'])
+        _answer_if_not_modified(last_modified, count,
+                                dataset['metadata_modified'])
         try:
             extra_vars = issues_for_dataset(dataset_id, request.GET)
         except toolkit.ValidationError, e:
@@ -300,8 +326,9 @@ class IssueController(BaseController):
 
                     user_obj = model.User.get(assignee_id)
                     try:
-                        mailer.mail_user(user_obj, subject, body)
-                    except mailer.MailerException, e:
+                        with NotificationSender() as sender:
+                            sender.send_to_user(user_obj, subject, body)
+                    except MailerException, e:
                         log.debug(e.message)
 
             except toolkit.NotAuthorized:
@@ -440,7 +467,11 @@ class IssueController(BaseController):
         """
         Display a page containing a list of all issues for a given organization
         """
-        self._before_org(org_id)
+        org = self._before_org(org_id)
+        count, last_modified = issuemodel.Issue.get_last_modified(
+            organization_id=org['id'])
+        _answer_if_not_modified(last_modified, count,
+                                org.get('revision_id'))
         try:
             template_params = issues_for_org(org_id, request.GET)
         except toolkit.ValidationError, e:
@@ -482,6 +513,59 @@ class IssueController(BaseController):
         template_params = all_issues(request.GET)
         return render("issues/all_issues.html", extra_vars=template_params)
 
+    def export(self):
+        """
+        Download the issues (of an organization or dataset, given as
+        parameters as for issue_export) with their comments, streamed
+        """
+        data_dict = dict(request.params.items())
+        try:
+            chunks = toolkit.get_action('issue_export')(data_dict=data_dict)
+        except toolkit.NotAuthorized:
+            abort(401, _('Not authorized to export these issues'))
+        except toolkit.ValidationError, e:
+            abort(400, str(e.error_summary))
+        export_format = data_dict.get('format') or 'csv'
+        response.headers['Content-Type'] = \
+            EXPORT_CONTENT_TYPES[export_format]
+        response.headers['Content-Disposition'] = \
+            'attachment; filename="issues.{0}"'.format(export_format)
+
+        def stream():
+            # the request's session is removed before the response is sent,
+            # so this one is closed once the export is done
+            try:
+                for chunk in chunks:
+                    yield chunk
+            finally:
+                model.Session.remove()
+        return stream()
+
+
+def _answer_if_not_modified(last_modified, *validators):
+    '''Answers 304 Not Modified, without going on to build the page, if the
+    client's copy of it is still current, going by its ETag. That is made
+    from the url, language, last_modified and any other validators, which
+    between them must change whenever the page's content does.
+
+    Only done for anonymous users, as pages for logged in users depend on
+    who they are and what they can do.'''
+    if c.user or h.are_there_flash_messages():
+        return
+    etag = hashlib.sha1(json.dumps(
+        [request.path_qs, request.environ.get('CKAN_LANG'), last_modified] +
+        list(validators), default=unicode)).hexdigest()
+    if last_modified:
+        response.last_modified = time.mktime(last_modified.timetuple())
+    etag_cache(etag)
+
+
+def _editor_ids(organization_id):
+    if not organization_id:
+        return []
+    return sorted(editor['user_id'] for editor in
+                  membership.get_organization_editors(organization_id))
+
 
 def _dataset_handle_error(dataset_id, exc):
     msg = toolkit._("Validation error: {0}".format(exc.error_summary))
@@ -510,6 +594,7 @@ def issues_for_org(org_id, get_query_dict):
     query.pop('__extras', None)
     template_params = _search_issues(organization_id=org_id,
                                      include_datasets=True,
+                                     dataset_summary=True,
                                      **query)
     template_params['org'] = \
         logic.get_action('organization_show')({}, {'id': org_id})
@@ -524,6 +609,7 @@ def all_issues(get_query_dict):
         raise toolkit.ValidationError(errors)
     query.pop('__extras', None)
     return _search_issues(include_datasets=True,
+                          dataset_summary=True,
                           **query)
 
 def _search_issues(dataset_id=None,
@@ -535,7 +621,9 @@ def _search_issues(dataset_id=None,
                    q='',
                    page=1,
                    per_page=get_issues_per_page()[0],
+                   cursor=None,
                    include_datasets=False,
+                   dataset_summary=False,
                    include_reports=True):
     # use the function params to set default for our arguments to our
     # data_dict if needed
@@ -547,27 +635,29 @@ def _search_issues(dataset_id=None,
     params.pop('page', None)
     params.pop('per_page', None)
 
-    # fetch only the results for the current page
+    # fetch the results for the current page along with the total count
     params.update({
-        'include_count': False,
+        'include_count': True,
+        'total_count': True,
         'limit': limit,
-        'offset': offset,
     })
-
-    results_for_current_page = toolkit.get_action('issue_search')(
-        data_dict=params
-    )
-    issues = results_for_current_page['results']
-
-    # fetch the total count of all the search results without dictizing
-    params['include_count'] = True
-    params['include_results'] = False
-    params.pop('limit', None)
-    params.pop('offset', None)
-    all_search_results = toolkit.get_action('issue_search')(data_dict=params)
-    issue_count = all_search_results['count']
-
-    pagination = Pagination(page, limit, issue_count)
+    count_limit = get_listing_count_limit()
+    if count_limit:
+        params['count_limit'] = count_limit
+    if cursor:
+        # we've followed a 'next' link, which carries the position of the
+        # end of the previous page, so no need for the offset
+        params['cursor'] = cursor
+    else:
+        params.pop('cursor', None)
+        params['offset'] = offset
+
+    search_results = toolkit.get_action('issue_search')(data_dict=params)
+    issues = search_results['results']
+
+    pagination = Pagination(page, limit, search_results['count'],
+                            next_cursor=search_results['next_cursor'],
+                            count_capped=search_results['count_capped'])
 
     template_variables = {
         'issues': issues,
@@ -0,0 +1,156 @@
+'''Creating issues, with their comments, in bulk
+
+create_issues() inserts a batch of validated issues (see issue_bulk_create)
+with one multi-row INSERT for the issues and another for their comments,
+rather than saving them one at a time through the ORM. Each dataset's
+issue numbers are allocated in one go. What the ORM's events would keep up
+to date for each issue - the rendered Markdown, owner_org, the comment and
+dataset stats, the full text search index and the cached searches - is
+brought up to date for the whole batch instead, and the datasets are queued
+for their search documents to be reindexed (see
+ckanext.issues.lib.dataset_index). No notifications are sent.
+'''
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import select, or_
+
+from ckan import model
+
+from ckanext.issues.model import (ISSUE_STATUS, AbuseStatus, issue_table,
+                                  issue_comment_table,
+                                  allocate_issue_numbers,
+                                  backfill_comment_stats, dataset_stats,
+                                  rendering, search, search_cache)
+
+
+def resolve_datasets(session, names_or_ids):
+    '''Returns {name or id: (dataset id, owner_org)} for those of the given
+    dataset names or ids that exist'''
+    names_or_ids = list(set(names_or_ids))
+    if not names_or_ids:
+        return {}
+    packages = model.package_table
+    rows = session.execute(
+        select([packages.c.id, packages.c.name, packages.c.owner_org])
+        .where(or_(packages.c.id.in_(names_or_ids),
+                   packages.c.name.in_(names_or_ids))))
+    datasets = {}
+    for row in rows:
+        datasets[row.id] = datasets[row.name] = (row.id, row.owner_org)
+    return datasets
+
+
+def resolve_users(session, names_or_ids):
+    '''Returns {name or id: user id} for those of the given user names or
+    ids that exist'''
+    names_or_ids = list(set(names_or_ids))
+    if not names_or_ids:
+        return {}
+    users = model.user_table
+    rows = session.execute(
+        select([users.c.id, users.c.name])
+        .where(or_(users.c.id.in_(names_or_ids),
+                   users.c.name.in_(names_or_ids))))
+    user_ids = {}
+    for row in rows:
+        user_ids[row.id] = user_ids[row.name] = row.id
+    return user_ids
+
+
+def _rendered(text):
+    html, extract = rendering.render(text)
+    return {'html': html, 'extract': extract,
+            'renderer_version': rendering.RENDERER_VERSION}
+
+
+def create_issues(session, issues):
+    '''Inserts the issues, each a dict with the dataset_id, owner_org and
+    user_id resolved to ids (see resolve_datasets and resolve_users) and an
+    optional list of comments. Sets the number and id of each. The caller
+    commits.'''
+    now = datetime.now()
+    by_dataset = defaultdict(list)
+    for issue in issues:
+        by_dataset[issue['dataset_id']].append(issue)
+
+    issue_rows = []
+    for dataset_id, dataset_issues in by_dataset.items():
+        number = allocate_issue_numbers(session, dataset_id,
+                                        count=len(dataset_issues))
+        for issue in dataset_issues:
+            issue['number'] = number
+            number += 1
+            rendered = _rendered(issue.get('description'))
+            created = issue.get('created') or now
+            # every row has the same keys, for executemany
+            issue_rows.append({
+                'number': issue['number'],
+                'title': issue['title'],
+                'description': issue.get('description'),
+                'description_html': rendered['html'],
+                'description_extract': rendered['extract'],
+                'renderer_version': rendered['renderer_version'],
+                'dataset_id': dataset_id,
+                'owner_org': issue['owner_org'],
+                'user_id': issue['user_id'],
+                'assignee_id': issue.get('assignee_id'),
+                'status': issue.get('status') or ISSUE_STATUS.open,
+                'resolved': issue.get('resolved'),
+                'created': created,
+                'visibility': u'visible',
+                'abuse_status': AbuseStatus.unmoderated.value,
+                'comment_count': 0,
+                'last_activity': created,
+                'modified': now,
+            })
+    session.execute(issue_table.insert(), issue_rows)
+
+    # the numbers of each dataset's issues are consecutive
+    for dataset_id, dataset_issues in by_dataset.items():
+        numbers = [issue['number'] for issue in dataset_issues]
+        ids = dict(session.execute(
+            select([issue_table.c.number, issue_table.c.id])
+            .where(issue_table.c.dataset_id == dataset_id)
+            .where(issue_table.c.number.between(min(numbers),
+                                                max(numbers)))).fetchall())
+        for issue in dataset_issues:
+            issue['id'] = ids[issue['number']]
+
+    comment_rows = []
+    for issue in issues:
+        # as backfill_comment_stats works it out: the last comment, or
+        # when the issue was created
+        last_comment = None
+        for comment in issue.get('comments') or []:
+            created = comment.get('created') or now
+            last_comment = max(last_comment, created)
+            rendered = _rendered(comment['comment'])
+            comment_rows.append({
+                'issue_id': issue['id'],
+                'comment': comment['comment'],
+                'comment_html': rendered['html'],
+                'comment_extract': rendered['extract'],
+                'renderer_version': rendered['renderer_version'],
+                'user_id': comment['user_id'],
+                'created': created,
+                'visibility': u'visible',
+                'abuse_status': AbuseStatus.unmoderated.value,
+            })
+        issue['last_activity'] = last_comment or issue.get('created') or now
+    if comment_rows:
+        session.execute(issue_comment_table.insert(), comment_rows)
+
+    issue_ids = [issue['id'] for issue in issues]
+    backfill_comment_stats(session, issue_ids)
+    search.index_issues(session, issue_ids)
+    for dataset_id, dataset_issues in by_dataset.items():
+        # added to, rather than recalculated, so as not to undo issues made
+        # at the same time
+        dataset_stats.count_new_issues(session, dataset_id, [
+            (u'visible', issue.get('status') or ISSUE_STATUS.open,
+             issue['last_activity']) for issue in dataset_issues])
+    search_cache.record_changes(session, dict(
+        (dataset_id, set([dataset_issues[0]['owner_org']]))
+        for dataset_id, dataset_issues in by_dataset.items()))
+    return issues
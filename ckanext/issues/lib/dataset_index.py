@@ -0,0 +1,83 @@
+'''Issue counts in the dataset search index
+
+before_index adds these fields to each dataset's search document, so that
+dataset searches can filter, facet and sort on them:
+
+    num_open_issues     visible open issues
+    num_closed_issues   visible closed issues
+    last_issue_activity when an issue was last created or commented on (a
+                        Solr date, left out if there are no issues)
+
+CKAN's Solr schema indexes fields it doesn't know as strings, which is
+enough to filter and facet on them and, being in ISO format, to sort on
+last_issue_activity. To sort numerically on the counts, add them to the
+schema as int fields.
+
+When their issues change, datasets are queued to be reindexed, in the same
+transaction, and ``paster issues reindex_datasets`` updates the search
+documents of the queued datasets. Run it regularly, e.g. from cron. A
+dataset is reindexed at most once per run, however often its issues
+changed, so how often it runs throttles the reindexing of busy datasets.
+Set ckanext.issues.reindex_datasets to false to not queue them at all (e.g.
+to reindex on a schedule with ``paster search-index rebuild`` instead).
+'''
+from datetime import datetime
+import logging
+
+from ckan import model
+import ckan.plugins as p
+
+from ckanext.issues.model import dataset_stats
+
+log = logging.getLogger(__name__)
+
+
+def before_index(pkg_dict):
+    stats = dataset_stats.get_dataset_stats(
+        [pkg_dict['id']], model.Session)[pkg_dict['id']]
+    pkg_dict['num_open_issues'] = stats['open_count']
+    pkg_dict['num_closed_issues'] = stats['closed_count']
+    if stats['last_activity']:
+        pkg_dict['last_issue_activity'] = \
+            stats['last_activity'].isoformat() + 'Z'
+    return pkg_dict
+
+
+def reindex_queued(session, batch_size=100):
+    '''Reindexes the datasets queued for it, batch_size at a time,
+    committing after each batch. Datasets that fail (e.g. as Solr is down)
+    stay queued for the next run.
+
+    Returns the number reindexed and the number that failed.
+    '''
+    from ckan.lib.search import index_for
+    package_index = index_for(model.Package)
+    context = {'model': model, 'session': session, 'ignore_auth': True,
+               'validate': False, 'use_cache': False}
+    reindexed = 0
+    failed = set()
+    # datasets queued again after this are left for the next run
+    started = datetime.now()
+    while True:
+        batch = dataset_stats.get_queued_reindexes(session, batch_size,
+                                                   started, exclude=failed)
+        if not batch:
+            break
+        for dataset_id, queued in batch:
+            try:
+                pkg_dict = p.toolkit.get_action('package_show')(
+                    dict(context), {'id': dataset_id})
+                package_index.update_dict(pkg_dict)
+            except p.toolkit.ObjectNotFound:
+                log.info('Not reindexing dataset %s as it is gone',
+                         dataset_id)
+            except Exception, e:
+                log.warning('Could not reindex dataset %s: %r', dataset_id,
+                            e)
+                failed.add(dataset_id)
+                continue
+            else:
+                reindexed += 1
+            dataset_stats.dequeue_reindex(session, dataset_id, queued)
+        session.commit()
+    return reindexed, len(failed)
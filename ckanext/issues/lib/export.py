@@ -0,0 +1,143 @@
+'''Streaming export of issues and their comments
+
+export() yields an export as chunks of UTF-8 text. It reads the issues and
+their comments in batches, from server-side cursors where the database has
+them, so its memory use doesn't grow with the number of issues. Issues come
+in id order, each with its comments in the order they were made:
+
+    csv     a row per issue followed by a row per comment, told apart by
+            the record column ('issue' or 'comment')
+    jsonl   a JSON object per line for each issue, with a list of its
+            comments
+'''
+import csv
+import cStringIO
+import json
+from datetime import datetime
+
+from ckan import model
+
+from ckanext.issues.model import Issue, IssueComment, AbuseStatus
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+CSV_COLUMNS = ('record', 'issue_id', 'comment_id', 'number', 'dataset_id',
+               'dataset_name', 'owner_org', 'title', 'text', 'status',
+               'resolved', 'created', 'modified', 'last_activity', 'user_id',
+               'user_name', 'assignee_id', 'visibility', 'abuse_status',
+               'comment_count')
+
+
+def _issue_query(session, since, filters):
+    query = session.query(
+        Issue.id, Issue.number, Issue.dataset_id,
+        model.Package.name.label('dataset_name'), Issue.owner_org,
+        Issue.title, Issue.description, Issue.status, Issue.resolved,
+        Issue.created, Issue.modified, Issue.last_activity, Issue.user_id,
+        model.User.name.label('user_name'), Issue.assignee_id,
+        Issue.visibility, Issue.abuse_status, Issue.comment_count)\
+        .outerjoin(model.Package, model.Package.id == Issue.dataset_id)\
+        .outerjoin(model.User, model.User.id == Issue.user_id)
+    query = Issue.apply_filters_to_an_issue_query(query, **filters)
+    if since:
+        query = query.filter(Issue.modified >= since)
+    return query.order_by(Issue.id)
+
+
+def _comment_query(session, since, filters):
+    query = session.query(
+        IssueComment.id, IssueComment.issue_id, IssueComment.comment,
+        IssueComment.created, IssueComment.user_id,
+        model.User.name.label('user_name'), IssueComment.visibility,
+        IssueComment.abuse_status)\
+        .join(Issue, Issue.id == IssueComment.issue_id)\
+        .outerjoin(model.User, model.User.id == IssueComment.user_id)
+    query = Issue.apply_filters_to_an_issue_query(query, **filters)
+    if since:
+        query = query.filter(Issue.modified >= since)
+    return query.order_by(IssueComment.issue_id, IssueComment.created,
+                          IssueComment.id)
+
+
+def _as_dict(row):
+    out = row._asdict()
+    for key, value in out.items():
+        if isinstance(value, datetime):
+            out[key] = value.isoformat()
+    try:
+        out['abuse_status'] = AbuseStatus(out['abuse_status']).name
+    except ValueError:
+        pass
+    return out
+
+
+def iter_issues(session, since=None, batch_size=1000, **filters):
+    '''Yields (issue dict, list of its comment dicts) for each issue matching
+    the filters (as for Issue.apply_filters_to_an_issue_query) and, with
+    since, modified since then'''
+    issues = _issue_query(session, since, filters).yield_per(batch_size)
+    comments = iter(
+        _comment_query(session, since, filters).yield_per(batch_size))
+    comment = next(comments, None)
+    for issue in issues:
+        # both queries are in issue id order. An issue changed after the
+        # issues were read can have comments read for it, which are skipped.
+        while comment is not None and comment.issue_id < issue.id:
+            comment = next(comments, None)
+        issue_comments = []
+        while comment is not None and comment.issue_id == issue.id:
+            issue_comments.append(_as_dict(comment))
+            comment = next(comments, None)
+        yield _as_dict(issue), issue_comments
+
+
+def _encode(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _csv_rows(issue, comments):
+    yield dict(issue, record='issue', issue_id=issue['id'],
+               text=issue['description'])
+    for comment in comments:
+        yield dict(comment, record='comment', comment_id=comment['id'],
+                   number=issue['number'], dataset_id=issue['dataset_id'],
+                   dataset_name=issue['dataset_name'],
+                   owner_org=issue['owner_org'], text=comment['comment'])
+
+
+def _export_csv(issues):
+    buffer = cStringIO.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    for issue, comments in issues:
+        for row in _csv_rows(issue, comments):
+            writer.writerow([_encode(row.get(column))
+                             for column in CSV_COLUMNS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _export_jsonl(issues):
+    for issue, comments in issues:
+        issue['comments'] = comments
+        yield json.dumps(issue) + '\n'
+
+
+def export(session, format='csv', since=None, batch_size=1000, **filters):
+    '''Yields the export of the issues matching the filters, and their
+    comments, in the given format ('csv' or 'jsonl'), as chunks of UTF-8
+    encoded text'''
+    issues = iter_issues(session, since=since, batch_size=batch_size,
+                         **filters)
+    if format == 'jsonl':
+        return _export_jsonl(issues)
+    return _export_csv(issues)
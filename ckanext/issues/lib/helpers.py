@@ -7,6 +7,7 @@ from ckan.plugins import toolkit
 from ckan.lib import helpers
 from ckanext.issues.model import IssueFilter
 from ckanext.issues import model as issuemodel
+from ckanext.issues.lib.util import get_dataset_stats, request_cache
 
 ISSUES_PER_PAGE = (15, 30, 50)
 
@@ -24,12 +25,14 @@ def replace_url_param(new_params, alternative_url=None, controller=None,
 
     This can be overriden providing an alternative_url, which will be used
     instead.
+
+    A parameter given a value of None in new_params is removed.
     '''
     params_cleaned = [(k, v) for k, v in toolkit.request.params.items()
                       if k not in new_params.keys()]
     params = set(params_cleaned)
     if new_params:
-        params |= set(new_params.items())
+        params |= set((k, v) for k, v in new_params.items() if v is not None)
     if alternative_url:
         return helpers._url_with_params(alternative_url, params)
 
@@ -37,7 +40,8 @@ def replace_url_param(new_params, alternative_url=None, controller=None,
 
 
 class Pagination(object):
-    def __init__(self, page, per_page, total_count, show_left=2, show_right=2):
+    def __init__(self, page, per_page, total_count, show_left=2, show_right=2,
+                 next_cursor=None, count_capped=False):
         '''
         Helper for displaying a page navigator.
 
@@ -45,12 +49,25 @@ class Pagination(object):
 
         :param show_left/right: the number of pages either side of the current
                                 one should be offered
+        :param next_cursor: the issue_search cursor for the next page, which
+                            the 'next' link uses instead of an offset
+        :param count_capped: whether total_count is a lower bound, because
+                             counting stopped there
         '''
         self.page = page
         self.per_page = per_page
         self.total_count = total_count
         self.show_left = show_left
         self.show_right = show_right
+        self.next_cursor = next_cursor
+        self.count_capped = count_capped
+
+    @property
+    def total_count_text(self):
+        '''The total count for display, e.g. "1000+" if it was capped'''
+        if self.count_capped:
+            return '{0}+'.format(self.total_count)
+        return str(self.total_count)
 
     @property
     def pages(self):
@@ -62,6 +79,9 @@ class Pagination(object):
 
     @property
     def has_next(self):
+        if self.count_capped and self.next_cursor:
+            # we stopped counting, so there may be pages beyond the last
+            return True
         return self.page < self.pages
 
     @property
@@ -103,6 +123,24 @@ def get_issues_per_page():
     return issues_per_page
 
 
+def get_listing_count_limit():
+    '''Returns the number of issues at which the listing pages stop counting
+    (and show e.g. "1000+"), or None to always count them all'''
+    try:
+        return int(config['ckanext.issues.listing_count_limit']) or None
+    except (ValueError, KeyError):
+        return None
+
+
+def get_comments_per_page():
+    '''Returns how many comments the issue page shows at a time, or None to
+    show them all at once'''
+    try:
+        return int(config['ckanext.issues.comments_per_page']) or None
+    except (ValueError, KeyError):
+        return 50
+
+
 def issues_enabled(dataset):
     '''Returns whether issues are enabled for the given dataset (dict)'''
     # config options allow you to only enable issues for particular datasets or
@@ -162,27 +200,72 @@ def issues_list(dataset_ref, status=issuemodel.ISSUE_STATUS.open):
     return issues
 
 
+def _user_id(user):
+    '''The id of the user with the given name (or id), looked up once per
+    request'''
+    user_ids = request_cache('user_ids')
+    if user_ids is not None and user in user_ids:
+        return user_ids[user]
+    user_obj = model.User.get(user) if user else None
+    user_id = user_obj.id if user_obj else None
+    if user_ids is not None:
+        user_ids[user] = user_id
+    return user_id
+
+
 def issues_user_has_reported_issue(user, abuse_reports):
     '''Returns whether the given user is among the given list of an issue's
     abuse_reports'''
-    user_obj = model.User.get(user)
-    if user_obj:
-        return user_obj.id in abuse_reports
-    else:
-        return False
+    user_id = _user_id(user)
+    return bool(user_id) and user_id in abuse_reports
+
+
+def get_reporter_summaries(user_ids):
+    '''Returns {'id', 'name', 'fullname'} dicts for the given user ids,
+    keyed by id. Ones already looked up in this request are reused, and the
+    rest are read in one query.'''
+    summaries = request_cache('user_summaries')
+    if summaries is None:
+        summaries = {}
+    missing = set(user_ids) - set(summaries)
+    if missing:
+        found = issuemodel.get_user_summaries(missing)
+        for user_id in missing:
+            # deleted users are shown by their id
+            summaries[user_id] = found.get(
+                user_id, {'id': user_id, 'name': user_id, 'fullname': None})
+    return summaries
+
+
+def issues_preload_reporters(issue):
+    '''Looks up everyone who reported the issue or any of its comments in
+    one go, so that issues_users_who_reported_issue needs no more queries
+    for this page'''
+    user_ids = set(issue.get('abuse_reports') or [])
+    for comment in issue.get('comments') or []:
+        user_ids.update(comment.get('abuse_reports') or [])
+    get_reporter_summaries(user_ids)
 
 
 def issues_users_who_reported_issue(abuse_reports):
-    '''Returns a list of users (dicts) who reported an issue/comment as
-    spam/abuse'''
-    users = []
-    for user_id in abuse_reports:
-        try:
-            users.append(toolkit.get_action('user_show')(data_dict={'id':
-                                                                    user_id}))
-        except toolkit.ObjectNotFound:
-            users.append(user_id)
-    return users
+    '''Returns a list of users (dicts with id, name and fullname) who
+    reported an issue/comment as spam/abuse'''
+    summaries = get_reporter_summaries(abuse_reports)
+    return [summaries[user_id] for user_id in abuse_reports]
+
+
+def issues_preload_dataset_stats(datasets):
+    '''Looks up the issue stats of a page of datasets (dicts) in one go, so
+    that issue_count and issues_dataset_stats need no more queries for
+    them. Returns an empty string, to be called from a template.'''
+    get_dataset_stats([dataset['id'] for dataset in datasets])
+    return ''
+
+
+def issues_dataset_stats(dataset):
+    '''Returns the dataset's open_count, closed_count, hidden_count and
+    total_count of issues, and their last_activity'''
+    return get_dataset_stats([dataset['id']])[dataset['id']]
 
 
 def get_site_title():
@@ -0,0 +1,132 @@
+'''Sending a batch of emails over one SMTP connection
+
+ckan.lib.mailer.mail_user connects, says EHLO, starts TLS and logs in for
+every single email. NotificationSender does that once for a batch and sends
+the emails one after the other over the same session, reconnecting if the
+server drops it. The messages are built the same way as CKAN's, so they
+look just the same to the recipient.
+
+    with NotificationSender() as sender:
+        for user, subject, body in emails:
+            sender.send_to_user(user, subject, body)
+'''
+import logging
+import smtplib
+import socket
+from email.header import Header
+from email.mime.text import MIMEText
+from email import Utils
+from time import time
+
+import ckan
+from ckan.lib.mailer import MailerException, add_msg_niceties
+import ckan.plugins as p
+from pylons import config
+
+from ckanext.issues.lib.helpers import get_site_title
+
+log = logging.getLogger(__name__)
+
+
+class NotificationSender(object):
+    '''Sends emails over a single SMTP session, opened on the first send and
+    closed when the ``with`` block ends.
+
+    The server settings are CKAN's own smtp.* options (smtp.test_server
+    included) unless smtp_server is given.
+    '''
+    # errors after which the connection is assumed unusable
+    CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, socket.error)
+
+    def __init__(self, smtp_server=None):
+        if smtp_server:
+            self.smtp_server = smtp_server
+            self.starttls = False
+            self.user = self.password = None
+        elif 'smtp.test_server' in config:
+            # as for ckan.lib.mailer, assume we're running tests and don't
+            # use starttls, user, password etc.
+            self.smtp_server = config['smtp.test_server']
+            self.starttls = False
+            self.user = self.password = None
+        else:
+            self.smtp_server = config.get('smtp.server', 'localhost')
+            self.starttls = p.toolkit.asbool(config.get('smtp.starttls'))
+            self.user = config.get('smtp.user')
+            self.password = config.get('smtp.password')
+        self.mail_from = config.get('smtp.mail_from')
+        self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def connect(self):
+        connection = smtplib.SMTP()
+        connection.connect(self.smtp_server)
+        try:
+            connection.ehlo()
+            if self.starttls:
+                if not connection.has_extn('STARTTLS'):
+                    raise MailerException(
+                        'SMTP server does not support STARTTLS')
+                connection.starttls()
+                connection.ehlo()
+            if self.user:
+                connection.login(self.user, self.password)
+        except smtplib.SMTPException, e:
+            connection.close()
+            raise MailerException('%r' % e)
+        self.connection = connection
+
+    def close(self):
+        if self.connection is None:
+            return
+        try:
+            self.connection.quit()
+        except self.CONNECTION_ERRORS + (smtplib.SMTPException,):
+            self.connection.close()
+        self.connection = None
+
+    def send(self, recipient_name, recipient_email, subject, body):
+        '''Sends an email, connecting (or reconnecting, once, if the
+        connection has gone) as needed. Raises MailerException if the email
+        could not be sent.'''
+        msg = self._message(recipient_name, recipient_email, subject, body)
+        for attempt in (1, 2):
+            try:
+                if self.connection is None:
+                    self.connect()
+                self.connection.sendmail(self.mail_from, [recipient_email],
+                                         msg)
+            except self.CONNECTION_ERRORS, e:
+                log.debug('SMTP connection failed, reconnecting: %r', e)
+                self.connection = None
+                if attempt == 2:
+                    raise MailerException('%r' % e)
+            except smtplib.SMTPException, e:
+                # the server refused this email, but the session is fine
+                raise MailerException('%r' % e)
+            else:
+                log.info('Sent email to %s', recipient_email)
+                return
+
+    def send_to_user(self, user, subject, body):
+        if not user.email:
+            raise MailerException('No recipient email address available!')
+        self.send(user.display_name, user.email, subject, body)
+
+    def _message(self, recipient_name, recipient_email, subject, body):
+        site_title = get_site_title()
+        body = add_msg_niceties(recipient_name, body, site_title,
+                                config.get('ckan.site_url'))
+        msg = MIMEText(body.encode('utf-8'), 'plain', 'utf-8')
+        msg['Subject'] = Header(subject.encode('utf-8'), 'utf-8')
+        msg['From'] = u'%s <%s>' % (site_title, self.mail_from)
+        msg['To'] = Header(u'%s <%s>' % (recipient_name, recipient_email),
+                           'utf-8')
+        msg['Date'] = Utils.formatdate(time())
+        msg['X-Mailer'] = 'CKAN %s' % ckan.__version__
+        return msg.as_string()
@@ -0,0 +1,108 @@
+'''Sending of the email notifications about new issues and comments
+
+By default the actions only add the emails to the issue_notification outbox,
+in the same transaction as the issue or comment, and
+``paster issues send_notifications`` sends them. Set
+ckanext.issues.send_notifications_inline to send them during the request
+instead, as before the outbox existed.
+'''
+from datetime import datetime
+import logging
+
+from ckan import model
+from ckan.lib.mailer import MailerException
+from pylons import config
+
+import ckan.plugins as p
+from ckanext.issues.lib.mailer import NotificationSender
+from ckanext.issues.model import IssueNotification
+
+log = logging.getLogger(__name__)
+
+
+def send_inline():
+    return p.toolkit.asbool(
+        config.get('ckanext.issues.send_notifications_inline', False))
+
+
+def max_attempts():
+    return int(config.get('ckanext.issues.notification_max_attempts', 5))
+
+
+def retry_delay():
+    '''Seconds before the first retry of a failed notification, doubling
+    for each attempt after that'''
+    return max(int(config.get('ckanext.issues.notification_retry_delay', 60)),
+               1)
+
+
+def queue(session, subject, messages):
+    '''Adds the messages, a list of (recipient user id, body), to the outbox.
+    The caller commits.'''
+    for recipient_id, body in messages:
+        session.add(IssueNotification(recipient_id, subject, body))
+
+
+def send_now(session, subject, messages,
+             sender_factory=NotificationSender):
+    '''Mails the messages, a list of (recipient user id, body), over one
+    SMTP connection, logging any that fail'''
+    recipients = _get_users([recipient_id for recipient_id, _ in messages],
+                            session)
+    with sender_factory() as sender:
+        for i, (recipient_id, body) in enumerate(messages):
+            recipient = recipients.get(recipient_id)
+            if recipient is None:
+                continue
+            if i == 0:
+                log.debug('Mailing to %s (and %s others):\n%s',
+                          recipient.email, len(messages) - 1, body)
+            try:
+                sender.send_to_user(recipient, subject, body)
+            except MailerException, e:
+                log.debug(e.message)
+
+
+def send_queued(session, batch_size=100, sender_factory=NotificationSender):
+    '''Sends the notifications in the outbox that are due, batch_size at a
+    time over one SMTP connection, committing after each batch. Failures are
+    retried on a later run with exponential backoff.
+
+    Returns the number sent and the number that failed.
+    '''
+    sent = failed = 0
+    attempts = max_attempts()
+    delay = retry_delay()
+    # failures are rescheduled after this, so aren't retried in the same run
+    started = datetime.now()
+    while True:
+        batch = IssueNotification.get_due(session, batch_size, now=started)
+        if not batch:
+            break
+        recipients = _get_users([n.recipient_id for n in batch], session)
+        with sender_factory() as sender:
+            for notification in batch:
+                recipient = recipients.get(notification.recipient_id)
+                if recipient is None or recipient.state == 'deleted':
+                    log.info('Dropping notification %s as user %s is gone',
+                             notification.id, notification.recipient_id)
+                    session.delete(notification)
+                    continue
+                try:
+                    sender.send_to_user(recipient, notification.subject,
+                                        notification.body)
+                except MailerException, e:
+                    log.warning('Notification %s to %s failed: %s',
+                                notification.id, recipient.name, e)
+                    notification.record_failure(e, attempts, delay)
+                    failed += 1
+                else:
+                    session.delete(notification)
+                    sent += 1
+        session.commit()
+    return sent, failed
+
+
+def _get_users(user_ids, session):
+    users = session.query(model.User).filter(model.User.id.in_(user_ids))
+    return dict((user.id, user) for user in users)
@@ -1,9 +1,33 @@
 import ckanext.issues.model as issue_model
 import ckan.model as model
+from pylons import request
+
+
+def request_cache(name):
+    '''Returns a dict, called name, that lasts until the end of the current
+    request, or None when not in a request (e.g. paster commands)'''
+    try:
+        environ = request.environ
+    except (TypeError, AttributeError):
+        return None
+    return environ.setdefault('ckanext.issues.{0}'.format(name), {})
+
+
+def get_dataset_stats(dataset_ids):
+    '''Returns the issue stats (see issue_dataset_stats) of the given
+    datasets, keyed by id. Ones already looked up in this request are reused,
+    and the rest are read in one query.'''
+    stats = request_cache('dataset_stats')
+    if stats is None:
+        stats = {}
+    missing = set(dataset_ids) - set(stats)
+    if missing:
+        stats.update(issue_model.get_dataset_stats(missing, model.Session))
+    return stats
 
 
 def issue_count(package):
-    return issue_model.Issue.get_issue_count_for_package(package['id'])
+    return get_dataset_stats([package['id']])[package['id']]['total_count']
 
 def issue_comment_count(issue):
     return issue_model.IssueComment.get_comment_count_for_issue(issue['id'])
@@ -1,8 +1,12 @@
 from action import (
+    issue_bulk_create,
     issue_comment_create,
+    issue_comment_list,
     issue_create,
     issue_delete,
+    issue_export,
     issue_search,
+    issue_search_cache_stats,
     issue_show,
     issue_report,
     issue_report_show,
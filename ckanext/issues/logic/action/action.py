@@ -4,13 +4,15 @@ from datetime import datetime
 import ckan.logic as logic
 import ckan.plugins as p
 import ckan.model as model
-from ckan.lib import mailer
 from ckan.lib.base import render_jinja2
 from ckan.logic import validate
 import ckan.lib.helpers as h
 import ckanext.issues.model as issuemodel
+from ckanext.issues.model import membership, search, search_cache
 from ckanext.issues.logic import schema
+from ckanext.issues.auth import check_dataset_access
 from ckanext.issues.exception import ReportAlreadyExists
+from ckanext.issues.lib import bulk_import, export, notifications
 from ckanext.issues.lib.helpers import get_issue_subject, get_site_title
 try:
     import ckan.authz as authz
@@ -18,24 +20,84 @@ except ImportError:
     import ckan.new_authz as authz
 
 from pylons import config
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy import desc
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy import func
 
 _get_or_bust = logic.get_or_bust
 
 log = logging.getLogger(__name__)
 
 
-def _add_reports(obj, can_edit, current_user):
+def _add_reports(obj, can_edit, current_user_id):
     reports = [r.user_id for r in obj.abuse_reports]
     if can_edit:
         return reports
+    elif current_user_id and current_user_id in reports:
+        return [current_user_id]
     else:
-        user_obj = model.User.get(current_user)
-        if user_obj and user_obj.id in reports:
-            return [user_obj.id]
-        else:
-            return []
+        return []
+
+
+def _get_shown_issue(context, data_dict):
+    '''Returns the issue to show and whether the user can edit its dataset.
+    Issues marked as spam/abuse are only shown to those who can.'''
+    # dataset_id has been validated and converted to the dataset's id
+    issue = issuemodel.Issue.get_by_number(
+        dataset_id=data_dict['dataset_id'],
+        issue_number=data_dict['issue_number'],
+        session=context['session'])
+    if not issue:
+        raise p.toolkit.ObjectNotFound(p.toolkit._('Issue does not exist'))
+    context['issue'] = issue
+
+    can_edit = False
+    if context.get('user'):
+        try:
+            can_edit = check_dataset_access('package_update', context,
+                                            issue.dataset_id)
+        except p.toolkit.NotAuthorized:
+            pass
+
+    if issue.visibility != 'visible' and not can_edit:
+        raise p.toolkit.ObjectNotFound(
+            p.toolkit._('Issue marked as spam/abuse'))
+    return issue, can_edit
+
+
+def _get_comment_page(session, issue, limit, cursor, include_reports):
+    '''Returns a page of the issue's comments and the cursor for the next
+    page, or None if there are no more'''
+    comments = issuemodel.IssueComment.get_thread_page(
+        issue.id,
+        # one extra to see if there is a next page
+        limit=limit + 1 if limit else None,
+        after=cursor,
+        session=session,
+        include_reports=include_reports)
+    next_cursor = None
+    if limit and len(comments) > limit:
+        comments = comments[:limit]
+        next_cursor = issuemodel.encode_comment_cursor(comments[-1])
+    return comments, next_cursor
+
+
+def _get_current_user_id(context):
+    user_obj = model.User.get(context['user']) if context.get('user') \
+        else None
+    return user_obj.id if user_obj else None
+
+
+def _dictize_comments(comments, user_dicts, owner_ids, include_reports,
+                      can_edit, current_user_id):
+    comment_dicts = []
+    for comment in comments:
+        comment_dict = comment.as_dict(user_dicts)
+        comment_dict['is_owner'] = comment.user_id in owner_ids
+        if include_reports:
+            comment_dict['abuse_reports'] = _add_reports(comment, can_edit,
+                                                         current_user_id)
+        comment_dicts.append(comment_dict)
+    return comment_dicts
 
 
 @p.toolkit.side_effect_free
@@ -47,92 +109,161 @@ def issue_show(context, data_dict):
     :type dataset_id: string
     :param issue_number: the issue number
     :type issue_number: string
-    :param include_reports: whether to include abuse reports in the output
+    :param include_reports: whether to include abuse reports on the issue
+        and its comments in the output. Publishers see every report,
+        others only their own (as for issue_report_show)
     :type include_reports: bool
-
+    :param comment_limit: the most comments to return, oldest first. The
+        rest can be fetched with issue_comment_list, or by passing
+        next_comment_cursor back as comment_cursor (default: all of them)
+    :type comment_limit: int
+    :param comment_cursor: a next_comment_cursor from a previous call, to
+        return the comments after it
+    :type comment_cursor: string
+
+    :returns: the issue, with its comments, comment_count (of all the
+        comments, whether returned or not), next_comment_cursor (None if
+        there are no more comments) and the assignee's user dict. The
+        issue and each comment have an is_owner flag, saying whether its
+        author administers the dataset's issues
     :rtype: dictionary
     '''
     session = context['session']
-    dataset_id = data_dict['dataset_id']
-    issue_number = data_dict['issue_number']
-    issue = issuemodel.Issue.get_by_name_or_id_and_number(
-        dataset_name_or_id=dataset_id,
-        issue_number=issue_number,
+    include_reports = data_dict.get('include_reports')
+    issue, can_edit = _get_shown_issue(context, data_dict)
+    comment_objs, next_comment_cursor = _get_comment_page(
+        session, issue,
+        limit=data_dict.get('comment_limit'),
+        cursor=data_dict.get('comment_cursor'),
+        include_reports=include_reports)
+
+    # load all the users involved in one go
+    user_dicts = issuemodel.get_user_dicts(
+        [issue.user_id, issue.assignee_id] +
+        [comment.user_id for comment in comment_objs],
         session=session)
-    if not issue:
-        raise p.toolkit.ObjectNotFound(p.toolkit._('Issue does not exist'))
+    issue_dict = issue.as_dict(user_dicts)
+    issue_dict['assignee'] = user_dicts.get(issue.assignee_id)
+    # kept up to date as comments are made, so there's no need to count them
+    issue_dict['comment_count'] = issue.comment_count
+    issue_dict['next_comment_cursor'] = next_comment_cursor
 
-    context['issue'] = issue
-    issue_dict = issue.as_dict()
+    owner_ids = _get_owner_ids(issue.dataset_id, user_dicts)
+    issue_dict['is_owner'] = issue.user_id in owner_ids
 
-    user = context.get('user')
-    if user:
-        try:
-            can_edit = p.toolkit.check_access(
-                'package_update',
-                context,
-                data_dict={'id': issue.dataset_id}
-            )
-        except p.toolkit.NotAuthorized:
-            can_edit = False
-    else:
-        can_edit = False
+    current_user_id = None
+    if include_reports and context.get('user'):
+        current_user_id = _get_current_user_id(context)
+        issue_dict['abuse_reports'] = _add_reports(issue, can_edit,
+                                                   current_user_id)
 
-    if issue.visibility != 'visible' and not can_edit:
-        raise p.toolkit.ObjectNotFound(
-            p.toolkit._('Issue marked as spam/abuse'))
+    issue_dict['comments'] = _dictize_comments(
+        comment_objs, user_dicts, owner_ids, include_reports, can_edit,
+        current_user_id)
 
-    include_reports = data_dict.get('include_reports')
+    p.toolkit.check_access('issue_show', context, issue_dict)
+    return issue_dict
 
-    comments = []
-    for comment in issue.comments:
-        comment_dict = comment.as_dict()
-        if include_reports:
-            comment_dict['abuse_reports'] = _add_reports(comment, can_edit,
-                                                         context['user'])
-        comments.append(comment_dict)
 
-    issue_dict['comments'] = comments
+@p.toolkit.side_effect_free
+@validate(schema.issue_comment_list_schema)
+def issue_comment_list(context, data_dict):
+    '''Return a page of an issue's comments, oldest first.
 
-    p.toolkit.check_access('issue_show', context, issue_dict)
-    return issue_dict
+    :param dataset_id: the dataset name or id of the issue
+    :type dataset_id: string
+    :param issue_number: the issue number
+    :type issue_number: string
+    :param limit: the most comments to return (default: 50)
+    :type limit: int
+    :param cursor: the next_cursor from a previous call (or
+        next_comment_cursor from issue_show), to return the comments after
+        it
+    :type cursor: string
+    :param include_reports: whether to include abuse reports on the
+        comments, as for issue_show
+    :type include_reports: bool
+
+    :returns: dict with 'comments' and 'next_cursor' (None if there are no
+        more comments)
+    :rtype: dictionary
+    '''
+    p.toolkit.check_access('issue_comment_list', context, data_dict)
+    session = context['session']
+    include_reports = data_dict.get('include_reports')
+    issue, can_edit = _get_shown_issue(context, data_dict)
+    comment_objs, next_cursor = _get_comment_page(
+        session, issue,
+        limit=data_dict.get('limit', 50),
+        cursor=data_dict.get('cursor'),
+        include_reports=include_reports)
+
+    user_dicts = issuemodel.get_user_dicts(
+        [comment.user_id for comment in comment_objs], session=session)
+    owner_ids = _get_owner_ids(issue.dataset_id, user_dicts)
+    current_user_id = None
+    if include_reports:
+        current_user_id = _get_current_user_id(context)
+    return {
+        'comments': _dictize_comments(comment_objs, user_dicts, owner_ids,
+                                      include_reports, can_edit,
+                                      current_user_id),
+        'next_cursor': next_cursor,
+    }
+
+
+def _get_owner_ids(dataset_id, user_dicts):
+    '''Returns the ids of the users (from user_dicts) that administer the
+    dataset's issues, i.e. pass issue_admin: sysadmins and the admins and
+    editors of the dataset's organization.'''
+    dataset = model.Package.get(dataset_id)
+    if not dataset.owner_org:
+        # no organization to look at, so fall back to asking about each user
+        owner_ids = set()
+        for user_id, user_dict in user_dicts.items():
+            try:
+                check_dataset_access('package_update',
+                                     {'model': model,
+                                      'user': user_dict['name']},
+                                     dataset_id)
+                owner_ids.add(user_id)
+            except p.toolkit.NotAuthorized:
+                pass
+        return owner_ids
+    owner_ids = set(editor['user_id'] for editor in
+                    membership.get_organization_editors(dataset.owner_org))
+    owner_ids.update(user_id for user_id, user_dict in user_dicts.items()
+                     if user_dict.get('sysadmin'))
+    return owner_ids
 
 
 def _get_next_issue_number(session, dataset_id):
-    q = session.query(issuemodel.Issue)\
-        .filter(issuemodel.Issue.dataset_id == dataset_id)\
-        .order_by(desc('number')).first()
-    if not q:
-        return 1
-    return q.number + 1
+    return issuemodel.allocate_issue_numbers(session, dataset_id)
 
 
 def _get_recipients(context, dataset):
+    '''Returns the users to notify about the dataset's issues: its
+    organization's admins and editors that have an email address.'''
     organization = dataset.owner_org
     if not organization:
         return []
-    org_obj = model.Group.get(organization)
-    if not org_obj:
-        return []
-    recipients = []
-    roles = authz.get_roles_with_permission('update_dataset')
-    for role in roles:
-        members = p.toolkit.get_action('member_list')(
-            context,
-            data_dict={
-                'id': organization,
-                'object_type': 'user',
-                'capacity': role,
-            }
-        )
-        for member in members:
-            recipients.append(dict(
-                user_id=member[0],
-                capacity=member[2],
-                organization_name=org_obj.name,
-                organization_title=org_obj.title,
-                ))
-    return recipients
+    editors = membership.get_organization_editors(organization)
+    # copies, as the editors are cached
+    return [dict(editor, capacity=_translated_capacity(editor['capacity']))
+            for editor in editors if editor['email']]
+
+
+def _translated_capacity(capacity):
+    try:
+        return authz.trans_role(capacity)
+    except AttributeError:
+        return capacity
+
+
+def _send_email_notifications():
+    return p.toolkit.asbool(
+        config.get('ckanext.issues.send_email_notifications')
+    )
 
 
 def _get_issue_vars(issue, issue_subject, user_obj, recipient):
@@ -192,32 +323,147 @@ def issue_create(context, data_dict):
     issue.number = _get_next_issue_number(session, dataset.id)
 
     session.add(issue)
-    session.commit()
-
-    notifications = p.toolkit.asbool(
-        config.get('ckanext.issues.send_email_notifications')
-    )
+    session.flush()
+    search.index_issue(session, issue.id)
 
-    if notifications:
-        recipients = _get_recipients(context, dataset)
+    messages = []
+    if _send_email_notifications():
         subject = get_issue_subject(issue.as_dict())
+        messages = [
+            (recipient['user_id'],
+             _get_issue_email_body(issue, subject, user_obj, recipient))
+            for recipient in _get_recipients(context, dataset)]
+        if not notifications.send_inline():
+            notifications.queue(session, subject, messages)
+    session.commit()
 
-        for i, recipient in enumerate(recipients):
-            body = _get_issue_email_body(issue, subject, user_obj, recipient)
-            user_obj = model.User.get(recipient['user_id'])
-            if i == 0:
-                log.debug('Mailing to %s (and %s others):\n%s',
-                          user_obj.email, len(recipients) - 1, body)
-            try:
-                mailer.mail_user(user_obj, subject, body)
-            except (mailer.MailerException, TypeError), e:
-                # TypeError occurs when we're running command from ckanapi
-                log.debug(e.message)
+    if messages and notifications.send_inline():
+        notifications.send_now(session, subject, messages)
 
     log.debug('Created issue %s (%s)' % (issue.title, issue.id))
     return issue.as_dict()
 
 
+def issue_bulk_create(context, data_dict):
+    '''Create many issues, with their comments, at once, e.g. to import them
+    from another tracker. Only for sysadmins.
+
+    Each issue is validated on its own, and one with errors is left out and
+    reported rather than stopping the rest being created. They are created
+    in batches, each inserted in one go and committed. No notifications are
+    sent.
+
+    :param issues: the issues, each a dict with a title, description
+        (optional), dataset_id (the name or id of the dataset), user_id
+        (the name or id of the user who reported it, default the caller),
+        assignee_id (optional), status ('open', the default, or 'closed'),
+        created and resolved (optional ISO format dates) and comments (an
+        optional list of dicts with the comment, user_id and created)
+    :type issues: list of dicts
+    :param batch_size: the number of issues to create in each transaction
+        (default=500)
+    :type batch_size: int
+
+    :returns: dict with the number of issues created and the errors, a list
+        of dicts with the index of each issue left out and its errors
+    :rtype: dictionary
+    '''
+    p.toolkit.check_access('issue_bulk_create', context, data_dict)
+    issues = data_dict.get('issues')
+    if not isinstance(issues, list):
+        raise p.toolkit.ValidationError({
+            'issues': [p.toolkit._('Must be a list of issues')]})
+    try:
+        batch_size = int(data_dict.get('batch_size') or 500)
+        assert batch_size > 0
+    except (ValueError, AssertionError):
+        raise p.toolkit.ValidationError({
+            'batch_size': [p.toolkit._('Must be a positive integer')]})
+    session = context['session']
+    user_obj = model.User.get(context['user'])
+    default_user_id = user_obj.id if user_obj else None
+
+    created = 0
+    errors = []
+    for start in range(0, len(issues), batch_size):
+        batch, batch_errors = _validate_bulk_issues(
+            context, issues[start:start + batch_size], start,
+            default_user_id)
+        errors.extend(batch_errors)
+        if not batch:
+            continue
+        try:
+            bulk_import.create_issues(session, [issue for index, issue
+                                                in batch])
+            session.commit()
+            created += len(batch)
+        except DBAPIError, e:
+            session.rollback()
+            log.exception('Could not create issues %s to %s', start,
+                          start + batch_size - 1)
+            errors.extend({'index': index, 'errors': {'issue': [unicode(e)]}}
+                          for index, issue in batch)
+    log.info('Created %s issues in bulk, %s left out', created, len(errors))
+    return {'created': created, 'errors': errors}
+
+
+def _validate_bulk_issues(context, issues, start, default_user_id):
+    '''Validates a batch of issues for issue_bulk_create, looking up all of
+    their datasets and users at once. Returns (index, issue) for the valid
+    ones and the errors of the rest.'''
+    session = context['session']
+    valid = []
+    errors = []
+    for index, issue in enumerate(issues, start):
+        if not isinstance(issue, dict):
+            errors.append({'index': index, 'errors': {
+                'issue': [p.toolkit._('Must be a dict')]}})
+            continue
+        issue, issue_errors = p.toolkit.navl_validate(
+            issue, schema.issue_bulk_create_schema(), context)
+        if issue_errors:
+            errors.append({'index': index, 'errors': issue_errors})
+            continue
+        issue.pop('__extras', None)
+        valid.append((index, issue))
+
+    datasets = bulk_import.resolve_datasets(
+        session, [issue['dataset_id'] for index, issue in valid])
+    user_refs = []
+    for index, issue in valid:
+        user_refs.extend([issue.get('user_id'), issue.get('assignee_id')])
+        user_refs.extend(comment.get('user_id')
+                         for comment in issue.get('comments') or [])
+    users = bulk_import.resolve_users(
+        session, [user_ref for user_ref in user_refs if user_ref])
+
+    def user_id(user_ref):
+        return users.get(user_ref) if user_ref else default_user_id
+
+    batch = []
+    for index, issue in valid:
+        issue_errors = {}
+        if issue['dataset_id'] in datasets:
+            issue['dataset_id'], issue['owner_org'] = \
+                datasets[issue['dataset_id']]
+        else:
+            issue_errors['dataset_id'] = [p.toolkit._('Dataset not found')]
+        for key in ('user_id', 'assignee_id'):
+            if issue.get(key) or key == 'user_id':
+                issue[key] = user_id(issue.get(key))
+                if not issue[key]:
+                    issue_errors[key] = [p.toolkit._('User not found')]
+        for comment in issue.get('comments') or []:
+            comment['user_id'] = user_id(comment.get('user_id'))
+            if not comment['user_id']:
+                issue_errors['comments'] = [p.toolkit._('User not found')]
+        if issue_errors:
+            errors.append({'index': index, 'errors': issue_errors})
+        else:
+            batch.append((index, issue))
+    return batch, errors
+
+
 @validate(schema.issue_update_schema)
 def issue_update(context, data_dict):
     '''Update an issue.
@@ -267,6 +513,8 @@ def issue_update(context, data_dict):
             issue.resolved = None
 
     session.add(issue)
+    session.flush()
+    search.index_issue(session, issue.id)
     session.commit()
     return issue.as_dict()
 
@@ -298,6 +546,7 @@ def issue_delete(context, data_dict):
                 dataset_id=dataset_id,
             )
         )
+    search.remove_issue(session, issue.id)
     session.delete(issue)
     session.commit()
 
@@ -314,11 +563,13 @@ def issue_search(context, data_dict):
         to filter the issues by (optional)
     :type organization_id: string
     :param include_sub_organizations: if filtering by organization_id, this
-        includes organizations below the specified one in the hierarchy.
-        (default=False)
+        includes organizations below the specified one in the hierarchy, at
+        any depth. (default=False)
     :type include_sub_organizations: bool
-    :param q: a query string, currently on searches for titles that match
-        this query
+    :param q: a query string, matched against the title, description and
+        comments of the issues using the full text index. Without a sort,
+        the best matches are returned first. (If the index is not available
+        it only does a substring match on title and description.)
     :type q: string
     :param sort: sorting method for the results returned
     :type sort: string, must be 'newest', 'oldest', 'most_commented',
@@ -327,21 +578,41 @@ def issue_search(context, data_dict):
     :type limit: int
     :param offset: offset of the search results to return
     :type offset: int
+    :param cursor: return the results after this position, as given by
+        next_cursor in a previous response with the same parameters. This is
+        cheaper than offset for deep pages and isn't affected by issues
+        being added in the meantime.
+    :type cursor: string
     :param visibility: filter on visibility
     :type visibility: string in 'visible', 'hidden', ''
     :param include_datasets: include details of the dataset each issue is
         attached to
     :type include_datasets: bool
+    :param dataset_summary: with include_datasets, only include the id, name,
+        title and owner_org of the datasets rather than the full dataset dicts
+        (default=False)
+    :type dataset_summary: bool
     :param include_count: perform an additional query to count the number of
         datasets
     :type include_count: bool
+    :param total_count: make the count the total number of matching issues,
+        ignoring limit, offset and cursor. When returning results (without a
+        cursor or count_limit), it is counted in the same query as them.
+        (default=False, for which count is also limited by limit/offset)
+    :type total_count: bool
+    :param count_limit: stop counting at this number of issues, so that a
+        huge listing doesn't need an exact count. If there are more,
+        count_capped is True in the response and count is count_limit.
+    :type count_limit: int
     :param include_results: include dictized results of the issues, you will
         only want to do this if you're just looking to get a count of the
         number of datasets without fetching and dictizing the issue objects
     :type include_results: bool
 
-    :returns: list of issues
-    :rtype: list of dictionaries
+    :returns: dict with the list of issues (results), the count (and
+        count_capped) and, when there is a limit, a sort and more results, the
+        next_cursor to pass in to get the next page
+    :rtype: dictionary
 
     '''
     p.toolkit.check_access('issue_search', context, data_dict)
@@ -360,8 +631,7 @@ def issue_search(context, data_dict):
             pass
     elif dataset_id:
         try:
-            p.toolkit.check_access('package_update', context,
-                                   data_dict={'id': dataset_id})
+            check_dataset_access('package_update', context, dataset_id)
             visibility = data_dict.get('visibility', None)
             can_update = True
         except p.toolkit.NotAuthorized:
@@ -376,34 +646,165 @@ def issue_search(context, data_dict):
     include_reports = p.toolkit.asbool(data_dict.get('include_reports'))
     include_count = p.toolkit.asbool(data_dict.pop('include_count', True))
     include_results = p.toolkit.asbool(data_dict.pop('include_results', True))
+    total_count = p.toolkit.asbool(data_dict.pop('total_count', False))
+    dataset_summary = p.toolkit.asbool(data_dict.pop('dataset_summary', False))
+    count_limit = data_dict.pop('count_limit', None)
     data_dict['include_datasets'] = include_datasets
 
-    query = issuemodel.Issue.get_issues(
-        session=context['session'],
-        **data_dict)
+    cursor = data_dict.get('cursor')
+    if cursor:
+        cursor_sort = cursor[0]
+        if data_dict.get('sort') and data_dict['sort'] != cursor_sort:
+            raise p.toolkit.ValidationError({
+                'cursor': [p.toolkit._('Cursor is for a different sort')]
+            })
+        data_dict['sort'] = cursor_sort
+    limit = data_dict.get('limit')
+    sort = data_dict.get('sort')
+
+    def _run_search():
+        query = issuemodel.Issue.get_issues(
+            session=context['session'],
+            **data_dict)
 
-    if include_count:
-        count = query.count()
-    else:
         count = None
+        count_capped = False
+        # with total_count, count the matches in the same query as the page
+        window_count = (include_count and include_results and total_count
+                        and not count_limit and not cursor)
+
+        next_cursor = None
+        if include_results:
+            results_query = query
+            if window_count:
+                results_query = results_query.add_column(
+                    func.count().over().label('total_count'))
+            if limit and sort:
+                # fetch one extra row to find out whether there is a next page
+                rows = results_query.limit(limit + 1).all()
+                if len(rows) > limit:
+                    rows = rows[:limit]
+                    next_cursor = issuemodel.encode_cursor(sort, rows[-1][0])
+            else:
+                rows = results_query.all()
+            if window_count and rows:
+                count = rows[0][-1]
+            rows = [row[:2] for row in rows]
+            dataset_dicts = None
+            if include_datasets:
+                dataset_dicts = issuemodel.get_dataset_dicts(
+                    [issue.dataset_id for (issue, u) in rows],
+                    summary=dataset_summary,
+                    session=context['session'])
+            results = [issue.as_plain_dict(u,
+                                           include_dataset=include_datasets,
+                                           include_reports=include_reports,
+                                           dataset_dicts=dataset_dicts)
+                       for (issue, u) in rows]
+        else:
+            results = []
+
+        if include_count and count is None:
+            if total_count or count_limit:
+                # count all the matches, not just this page
+                count_params = dict(data_dict)
+                for key in ('limit', 'offset', 'cursor', 'sort'):
+                    count_params.pop(key, None)
+                count_query = issuemodel.Issue.get_issues(
+                    session=context['session'],
+                    **count_params)
+                if count_limit:
+                    # the database can stop counting once it passes the limit
+                    count = count_query.limit(count_limit + 1).count()
+                    if count > count_limit:
+                        count = count_limit
+                        count_capped = True
+                else:
+                    count = count_query.count()
+            else:
+                count = query.count()
 
-    if include_results:
-        results = [issue.as_plain_dict(u, comment_count_, updated,
-                                       include_dataset=include_datasets,
-                                       include_reports=include_reports)
-                   for (issue, u, comment_count_, updated) in query.all()]
-    else:
-        results = []
+        return {
+            'count': count,
+            'count_capped': count_capped,
+            'results': results,
+            'next_cursor': next_cursor,
+        }
+
+    # the parameters that the results depend on, for the cache key
+    cache_params = dict(data_dict, include_count=include_count,
+                        include_results=include_results,
+                        total_count=total_count, count_limit=count_limit,
+                        dataset_summary=dataset_summary)
+    result = search_cache.get_or_search(cache_params, _run_search)
 
     if include_reports and not can_update:
         user_obj = model.User.get(user)
         if user_obj:
-            results = _filter_reports_for_user(user_obj.id, results)
+            result['results'] = _filter_reports_for_user(user_obj.id,
+                                                         result['results'])
+    return result
+
+
+@validate(schema.issue_export_schema)
+def issue_export(context, data_dict):
+    '''Export issues, with their comments, for loading into other systems
+
+    The export is streamed, reading the issues in batches rather than all at
+    once, so this is only for calling from Python - e.g. by the
+    /issues/export download and ``paster issues export`` - and not through
+    the API. Exporting an organization's issues is for its admins, a
+    dataset's for those who can edit it, and the whole site's for
+    sysadmins.
+
+    :param format: 'csv' (default) or 'jsonl' (JSON Lines)
+    :type format: string
+    :param dataset_id: the name or id of the dataset to export the issues of
+        (optional)
+    :type dataset_id: string
+    :param organization_id: the name or id of the organization to export
+        the issues of (optional)
+    :type organization_id: string
+    :param include_sub_organizations: with organization_id, also export the
+        issues of the organizations below it (default=False)
+    :type include_sub_organizations: bool
+    :param status: filter on status
+    :type status: string
+    :param visibility: filter on visibility (default is both visible and
+        hidden issues)
+    :type visibility: string
+    :param abuse_status: filter on abuse status
+    :type abuse_status: string
+    :param q: as for issue_search
+    :type q: string
+    :param since: only export issues modified (or commented on) since this
+        date and time, for incremental exports
+    :type since: ISO format date string
+    :param batch_size: the number of issues (and comments) to read at a
+        time (default=1000)
+    :type batch_size: int
+
+    :returns: an iterator of the chunks of the export, as UTF-8 encoded text
+    '''
+    if context.get('api_version'):
+        raise p.toolkit.ValidationError({'format': [p.toolkit._(
+            'issue_export is not available through the API, download '
+            '/issues/export instead')]})
+    p.toolkit.check_access('issue_export', context, data_dict)
+    data_dict.pop('__extras', None)
+    return export.export(context['session'], **data_dict)
 
-    return {
-        'count': count,
-        'results': results,
-    }
+
+@p.toolkit.side_effect_free
+def issue_search_cache_stats(context, data_dict):
+    '''Return how often issue_search has found its results in the cache
+    since this process started. Only for sysadmins.
+
+    :returns: dict with the numbers of hits and misses
+    :rtype: dictionary
+    '''
+    p.toolkit.check_access('issue_search_cache_stats', context, data_dict)
+    return search_cache.stats()
 
 
 def _filter_reports_for_user(user_id, results):
@@ -456,29 +857,28 @@ def issue_comment_create(context, data_dict):
         'issue_id': issue.id,
     })
 
+    session = context['session']
     issue_comment = issuemodel.IssueComment(**comment_dict)
-    model.Session.add(issue_comment)
-    model.Session.commit()
-
-    notifications = p.toolkit.asbool(
-        config.get('ckanext.issues.send_email_notifications')
-    )
+    session.add(issue_comment)
+    session.flush()
+    issue.record_comment(session, issue_comment)
+    search.index_issue(session, issue.id)
 
-    if notifications:
+    messages = []
+    if _send_email_notifications():
         dataset = model.Package.get(data_dict['dataset_id'])
-        recipients = _get_recipients(context, dataset)
         subject = get_issue_subject(issue.as_dict())
+        messages = [
+            (recipient['user_id'],
+             _get_comment_email_body(issue_comment, subject, user_obj,
+                                     recipient))
+            for recipient in _get_recipients(context, dataset)]
+        if not notifications.send_inline():
+            notifications.queue(session, subject, messages)
+    session.commit()
 
-        for recipient in recipients:
-            body = _get_comment_email_body(
-                issue_comment, subject, user_obj, recipient)
-
-            user_obj = model.User.get(recipient['user_id'])
-            try:
-                mailer.mail_user(user_obj, subject, body)
-            except (mailer.MailerException, TypeError), e:
-                # TypeError occurs when we're running command from ckanapi
-                log.debug(e.message)
+    if messages and notifications.send_inline():
+        notifications.send_now(session, subject, messages)
 
     log.debug('Created issue comment %s' % (issue.id))
     return issue_comment.as_dict()
@@ -561,8 +961,7 @@ def _comment_or_issue_report(issue_or_comment, user_ref, dataset_id, session):
             'session': session,
             'model': model,
         }
-        p.toolkit.check_access('package_update', context,
-                               data_dict={'id': dataset_id})
+        check_dataset_access('package_update', context, dataset_id)
 
         issue_or_comment.change_visibility(session, u'hidden')
         issue_or_comment.abuse_status = issuemodel.AbuseStatus.abuse.value
@@ -641,8 +1040,7 @@ def issue_report_show(context, data_dict):
             'session': session,
             'model': model,
         }
-        p.toolkit.check_access('package_update', package_context,
-                               data_dict={'id': dataset_id})
+        check_dataset_access('package_update', package_context, dataset_id)
         reports = issuemodel.Issue.Report.get_reports(session,
                                                       parent_id=issue.id)
     except p.toolkit.NotAuthorized:
@@ -686,8 +1084,7 @@ def issue_report_clear(context, data_dict):
             'session': session,
             'model': model,
         }
-        p.toolkit.check_access('package_update', package_context,
-                               data_dict={'id': dataset_id})
+        check_dataset_access('package_update', package_context, dataset_id)
         issue.clear_all_abuse_reports(session)
         issue.abuse_status = issuemodel.AbuseStatus.not_abuse.value
     except p.toolkit.NotAuthorized:
@@ -727,8 +1124,7 @@ def issue_comment_report_clear(context, data_dict):
             'session': session,
             'model': model,
         }
-        p.toolkit.check_access('package_update', package_context,
-                               data_dict={'id': dataset_id})
+        check_dataset_access('package_update', package_context, dataset_id)
         comment.clear_all_abuse_reports(session)
         comment.abuse_status = issuemodel.AbuseStatus.not_abuse.value
     except p.toolkit.NotAuthorized:
@@ -762,9 +1158,12 @@ def issue_comment_search(context, data_dict):
             organization_id=organization_id
         )
 
+    rows = the_comments.all()
+    user_dicts = issuemodel.get_user_dicts(
+        [comment.user_id for comment, issue in rows], session=session)
     comments = []
-    for comment, issue in the_comments.all():
-        comment_dict = comment.as_dict()
+    for comment, issue in rows:
+        comment_dict = comment.as_dict(user_dicts)
         comment_dict.update({
             'dataset_id': issue.dataset_id,
             'issue_number': issue.number,
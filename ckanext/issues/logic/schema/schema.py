@@ -5,6 +5,9 @@ from ckanext.issues.logic.validators import (
     is_valid_sort,
     is_valid_status,
     is_valid_abuse_status,
+    is_valid_cursor,
+    is_valid_comment_cursor,
+    is_valid_export_format,
     issue_exists,
     issue_comment_exists,
     issue_number_exists_for_dataset,
@@ -19,6 +22,8 @@ organization_exists = toolkit.get_validator('group_id_or_name_exists')
 is_natural_number = toolkit.get_validator('natural_number_validator')
 is_positive_integer = toolkit.get_validator('is_positive_integer')
 boolean_validator = toolkit.get_validator('boolean_validator')
+isodate = toolkit.get_validator('isodate')
+default = toolkit.get_validator('default')
 
 
 def issue_show_schema():
@@ -26,6 +31,19 @@ def issue_show_schema():
         'dataset_id': [not_missing, unicode, package_exists, as_package_id],
         'include_reports': [ignore_missing, bool],
         'issue_number': [not_missing, is_positive_integer],
+        'comment_limit': [ignore_missing, is_positive_integer],
+        'comment_cursor': [ignore_missing, unicode, is_valid_comment_cursor],
+        '__after': [issue_number_exists_for_dataset],
+    }
+
+
+def issue_comment_list_schema():
+    return {
+        'dataset_id': [not_missing, unicode, package_exists, as_package_id],
+        'include_reports': [ignore_missing, bool],
+        'issue_number': [not_missing, is_positive_integer],
+        'limit': [ignore_missing, is_positive_integer],
+        'cursor': [ignore_missing, unicode, is_valid_comment_cursor],
         '__after': [issue_number_exists_for_dataset],
     }
 
@@ -38,6 +56,26 @@ def issue_create_schema():
     }
 
 
+def issue_bulk_create_schema():
+    '''For each issue of issue_bulk_create. The dataset and user names or ids
+    are looked up for the whole batch afterwards.'''
+    return {
+        'title': [not_missing, unicode],
+        'description': [ignore_missing, unicode],
+        'dataset_id': [not_missing, unicode],
+        'user_id': [ignore_missing, unicode],
+        'assignee_id': [ignore_missing, unicode],
+        'status': [ignore_missing, unicode, is_valid_status],
+        'created': [ignore_missing, isodate],
+        'resolved': [ignore_missing, isodate],
+        'comments': {
+            'comment': [not_missing, unicode],
+            'user_id': [ignore_missing, unicode],
+            'created': [ignore_missing, isodate],
+        },
+    }
+
+
 def issue_update_schema():
     return {
         'assignee_id': [ignore_missing, unicode, user_exists],
@@ -67,10 +105,14 @@ def issue_search_schema():
         'sort': [ignore_missing, unicode, is_valid_sort],
         'limit': [ignore_missing, is_natural_number],
         'offset': [ignore_missing, is_natural_number],
+        'cursor': [ignore_missing, unicode, is_valid_cursor],
         'q': [ignore_missing, unicode],
         'visibility': [ignore_missing, unicode],
         'include_count': [ignore_missing, bool],
+        'total_count': [ignore_missing, boolean_validator],
+        'count_limit': [ignore_missing, is_positive_integer],
         'include_datasets': [ignore_missing, bool],
+        'dataset_summary': [ignore_missing, boolean_validator],
         'include_reports': [ignore_missing, bool],
         'include_results': [ignore_missing, bool],
         'include_sub_organizations': [ignore_missing, bool],
@@ -78,6 +120,22 @@ def issue_search_schema():
     }
 
 
+def issue_export_schema():
+    return {
+        'format': [default(u'csv'), unicode, is_valid_export_format],
+        'dataset_id': [ignore_missing, unicode, package_exists,
+                       as_package_id],
+        'organization_id': [ignore_missing, unicode, as_org_id],
+        'include_sub_organizations': [ignore_missing, boolean_validator],
+        'status': [ignore_missing, unicode, is_valid_status],
+        'visibility': [ignore_missing, unicode],
+        'abuse_status': [ignore_missing, unicode, is_valid_abuse_status],
+        'q': [ignore_missing, unicode],
+        'since': [ignore_missing, isodate],
+        'batch_size': [ignore_missing, is_positive_integer],
+    }
+
+
 def issue_comment_schema():
     return {
         'comment': [not_missing, unicode],
@@ -122,20 +180,13 @@ def issue_dataset_controller_schema():
         'sort': [ignore_missing, unicode],
         'page': [ignore_missing, is_positive_integer],
         'per_page': [ignore_missing, is_positive_integer],
+        'cursor': [ignore_missing, unicode],
         'q': [ignore_missing, unicode],
         'visibility': [ignore_missing, unicode],
         'abuse_status': [ignore_missing, unicode],
     }
 
 
-def issue_show_controller_schema():
-    return {
-        'dataset_id': [not_missing, unicode, package_exists, as_package_id],
-        'issue_number': [not_missing, is_positive_integer],
-        '__after': [issue_number_exists_for_dataset],
-    }
-
-
 def organization_users_autocomplete_schema():
     return {
         'q': [not_missing, unicode],
@@ -14,6 +14,14 @@ def is_valid_status(value, context):
         )
 
 
+def is_valid_export_format(value, context):
+    from ckanext.issues.lib.export import CONTENT_TYPES
+    if value in CONTENT_TYPES:
+        return value
+    raise toolkit.Invalid(toolkit._(
+        '{0} is not a valid export format'.format(value)))
+
+
 def is_valid_sort(filter_string, context):
     '''takes a string, validates and returns an IssueFilter enum'''
     try:
@@ -36,6 +44,24 @@ def is_valid_abuse_status(filter_string, context):
         )
 
 
+def is_valid_cursor(cursor, context):
+    '''takes an opaque cursor string, validates and returns the decoded
+    (IssueFilter, value, issue_id) position'''
+    try:
+        return issuemodel.decode_cursor(cursor)
+    except ValueError:
+        raise toolkit.Invalid(toolkit._('Invalid cursor'))
+
+
+def is_valid_comment_cursor(cursor, context):
+    '''takes an opaque comment cursor string, validates and returns the
+    decoded (created, comment_id) position'''
+    try:
+        return issuemodel.decode_comment_cursor(cursor)
+    except ValueError:
+        raise toolkit.Invalid(toolkit._('Invalid cursor'))
+
+
 def as_package_id(package_id_or_name, context):
     '''given a package_id_or_name, return just the package id'''
     model = context['model']
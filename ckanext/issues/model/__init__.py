@@ -8,15 +8,29 @@ import ckan.lib.helpers as h
 import ckan.model.domain_object as domain_object
 from ckan.lib.dictization import model_dictize
 
+from ckanext.issues.model import (dataset_stats, membership, rendering,
+                                  search, search_cache)
+from ckanext.issues.model.dataset_stats import (
+    backfill_dataset_stats, get_dataset_stats, issue_dataset_stats_table,
+    issue_dataset_reindex_table)
+from ckanext.issues.model.notification import (IssueNotification,
+                                               issue_notification_table)
 from ckanext.issues.model.report import define_report_tables
 
+import base64
 from datetime import datetime
+import json
 import logging
+import threading
 
 import enum
-from sqlalchemy import func, types, Table, ForeignKey, Column, Index
+from sqlalchemy import (func, types, Table, ForeignKey, Column, Index,
+                        event)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy.orm import relation, backref, subqueryload, foreign, remote
-from sqlalchemy.sql.expression import or_
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.sql.expression import or_, and_, select
 
 log = logging.getLogger(__name__)
 
@@ -33,6 +47,10 @@ def setup():
         issue_category_table.create(checkfirst=True)
         issue_table.create(checkfirst=True)
         issue_comment_table.create(checkfirst=True)
+        issue_number_counter_table.create(checkfirst=True)
+        issue_notification_table.create(checkfirst=True)
+        issue_dataset_stats_table.create(checkfirst=True)
+        issue_dataset_reindex_table.create(checkfirst=True)
 
         if report_tables:
             for table in report_tables:
@@ -58,6 +76,8 @@ def setup():
 
 
 def upgrade():
+    rerender_markdown = False
+
     # Migration 1
     fkey_sql = "SELECT * FROM pg_constraint " \
                "WHERE conname = 'issue_assignee_id_fkey';"
@@ -75,6 +95,204 @@ def upgrade():
               'core ckan tables now removed'
         model.Session.commit()
 
+    # Migration 2
+    if not _column_exists('issue', 'comment_count'):
+        add_comment_stats_sql = '''
+        ALTER TABLE issue ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE issue ADD COLUMN last_activity TIMESTAMP;
+        CREATE INDEX idx_issue_comment_count ON issue (comment_count);
+        CREATE INDEX idx_issue_last_activity ON issue (last_activity);
+        '''
+        model.Session.execute(add_comment_stats_sql)
+        backfill_comment_stats(model.Session)
+        model.Session.commit()
+        print 'Migration 2 done: issue.comment_count and issue.last_activity '\
+              'added and populated'
+
+    # Migration 3
+    if not _column_exists('issue', 'search_vector'):
+        model.Session.execute(search.POSTGRES_CREATE_SQL)
+        search.reset_backend_cache()
+        search.rebuild_index(model.Session)
+        model.Session.commit()
+        print 'Migration 3 done: full text search index added to issue'
+
+    # Migration 4
+    if not issue_number_counter_table.exists():
+        issue_number_counter_table.create()
+        model.Session.execute('''
+        INSERT INTO issue_number_counter (dataset_id, last_number)
+        SELECT dataset_id, max(number) FROM issue GROUP BY dataset_id;
+        ''')
+        model.Session.commit()
+        print 'Migration 4 done: issue_number_counter table created'
+
+    # Migration 5
+    if not issue_notification_table.exists():
+        issue_notification_table.create()
+        print 'Migration 5 done: issue_notification table created'
+
+    # Migration 6
+    if not _column_exists('issue', 'renderer_version'):
+        model.Session.execute('''
+        ALTER TABLE issue ADD COLUMN description_html TEXT;
+        ALTER TABLE issue ADD COLUMN description_extract TEXT;
+        ALTER TABLE issue ADD COLUMN renderer_version INTEGER;
+        ALTER TABLE issue_comment ADD COLUMN comment_html TEXT;
+        ALTER TABLE issue_comment ADD COLUMN comment_extract TEXT;
+        ALTER TABLE issue_comment ADD COLUMN renderer_version INTEGER;
+        ''')
+        model.Session.commit()
+        # rendered once the later migrations are done, as it goes through
+        # the ORM, which expects all the columns
+        rerender_markdown = True
+
+    # Migration 7
+    if not _column_exists('issue', 'modified'):
+        model.Session.execute('''
+        ALTER TABLE issue ADD COLUMN modified TIMESTAMP;
+        UPDATE issue SET modified = COALESCE(last_activity, created);
+        ''')
+        model.Session.commit()
+        print 'Migration 7 done: issue.modified added'
+
+    # Migration 8
+    if not issue_dataset_stats_table.exists():
+        issue_dataset_stats_table.create()
+        count = backfill_dataset_stats(model.Session)
+        model.Session.commit()
+        print 'Migration 8 done: issue_dataset_stats table created for {0} '\
+              'datasets'.format(count)
+
+    # Migration 9
+    created = _create_missing_indexes(MIGRATION_INDEXES[9])
+    if created:
+        print 'Migration 9 done: indexes {0} created'.format(
+            ', '.join(created))
+
+    # Migration 10
+    if not _column_exists('issue', 'owner_org'):
+        model.Session.execute('''
+        ALTER TABLE issue ADD COLUMN owner_org TEXT;
+        UPDATE issue SET owner_org = (SELECT owner_org FROM package
+                                      WHERE package.id = issue.dataset_id);
+        ''')
+        model.Session.commit()
+        _create_missing_indexes(MIGRATION_INDEXES[10])
+        print 'Migration 10 done: issue.owner_org added'
+
+    # Migration 11
+    if not issue_dataset_reindex_table.exists():
+        issue_dataset_reindex_table.create()
+        print 'Migration 11 done: issue_dataset_reindex table created'
+
+    if rerender_markdown:
+        count = rendering.rerender_all(model.Session)
+        print 'Migration 6 done: rendered Markdown stored for {0} issues '\
+              'and comments'.format(count)
+
+
+def _create_missing_indexes(index_names):
+    '''Creates the named indexes (of the issue tables) that don't exist yet,
+    returning their names'''
+    inspector = Inspector.from_engine(meta.engine)
+    created = []
+    for table in (issue_table, issue_comment_table):
+        existing = set(index['name']
+                       for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in index_names and index.name not in existing:
+                index.create(meta.engine)
+                created.append(index.name)
+    return created
+
+
+def _column_exists(table_name, column_name):
+    inspector = Inspector.from_engine(meta.engine)
+    return column_name in [column['name'] for column
+                           in inspector.get_columns(table_name)]
+
+
+def backfill_comment_stats(session, issue_ids=None):
+    '''Recalculates the denormalized comment_count and last_activity columns
+    of every issue (or of the given issues) from the issue_comment table.
+
+    last_activity falls back to the issue's creation time when it has no
+    comments.
+    '''
+    comments = issue_comment_table
+    comment_count = select([func.count(comments.c.id)])\
+        .where(comments.c.issue_id == issue_table.c.id)\
+        .as_scalar()
+    last_comment = select([func.max(comments.c.created)])\
+        .where(comments.c.issue_id == issue_table.c.id)\
+        .as_scalar()
+    update = issue_table.update().values(
+        comment_count=comment_count,
+        last_activity=func.coalesce(last_comment, issue_table.c.created),
+    )
+    if issue_ids is not None:
+        update = update.where(issue_table.c.id.in_(issue_ids))
+    return session.execute(update).rowcount
+
+
+# serializes issue number allocation on SQLite, which has no UPDATE ..
+# RETURNING (and only allows one writer at a time anyway)
+_issue_number_lock = threading.Lock()
+
+
+def allocate_issue_numbers(session, dataset_id, count=1):
+    '''Reserves the next count issue numbers for a dataset, returning the
+    first of them.
+
+    The last number used for each dataset is kept in issue_number_counter and
+    incremented in a single statement, so concurrent creates never get the
+    same number. The row lock taken by the UPDATE is held until the caller's
+    transaction ends. Numbers of deleted issues are not reused.
+    '''
+    counter = issue_number_counter_table
+    increment = counter.update()\
+        .where(counter.c.dataset_id == dataset_id)\
+        .values(last_number=counter.c.last_number + count)
+    if session.get_bind().dialect.name == 'postgresql':
+        last_number = session.execute(
+            increment.returning(counter.c.last_number)).scalar()
+        if last_number is None:
+            last_number = _create_issue_number_counter(session, dataset_id,
+                                                       count)
+    else:
+        with _issue_number_lock:
+            if session.execute(increment).rowcount:
+                last_number = session.execute(
+                    select([counter.c.last_number])
+                    .where(counter.c.dataset_id == dataset_id)).scalar()
+            else:
+                last_number = _create_issue_number_counter(
+                    session, dataset_id, count, use_savepoint=False)
+    return last_number - count + 1
+
+
+def _create_issue_number_counter(session, dataset_id, count,
+                                 use_savepoint=True):
+    '''Creates the counter for a dataset's first allocation, carrying on from
+    any issues it already has. Returns the last number allocated.'''
+    highest = session.query(func.max(Issue.number))\
+        .filter(Issue.dataset_id == dataset_id).scalar() or 0
+    insert = issue_number_counter_table.insert().values(
+        dataset_id=dataset_id, last_number=highest + count)
+    if not use_savepoint:
+        session.execute(insert)
+        return highest + count
+    savepoint = session.begin_nested()
+    try:
+        session.execute(insert)
+        savepoint.commit()
+    except IntegrityError:
+        # a concurrent request created it first, so we can increment it now
+        savepoint.rollback()
+        return allocate_issue_numbers(session, dataset_id, count) + count - 1
+    return highest + count
+
 
 ISSUE_CATEGORY_NAME_MAX_LENGTH = 100
 DEFAULT_CATEGORIES = {u"broken-resource-link": "Broken data link",
@@ -125,6 +343,66 @@ def _user_dict(user):
     return out
 
 
+def get_user_dicts(user_ids, session=Session):
+    '''Returns a dict of user dicts keyed by user id, for passing to the
+    as_dict methods.
+
+    The users are loaded in one query and each is dictized once, however many
+    times it appears in user_ids.
+    '''
+    user_ids = set(user_id for user_id in user_ids if user_id)
+    if not user_ids:
+        return {}
+    users = session.query(User).filter(User.id.in_(user_ids)).all()
+    return dict((user.id, _user_dict(user)) for user in users)
+
+
+def get_user_summaries(user_ids, session=Session):
+    '''Returns a dict of {'id', 'name', 'fullname'} dicts keyed by user id,
+    read in one query, for when the full user dict isn't needed.'''
+    user_ids = set(user_id for user_id in user_ids if user_id)
+    if not user_ids:
+        return {}
+    users = session.query(User.id, User.name, User.fullname)\
+        .filter(User.id.in_(user_ids))
+    return dict((user.id, {'id': user.id,
+                           'name': user.name,
+                           'fullname': user.fullname})
+                for user in users)
+
+
+def get_dataset_dicts(dataset_ids, summary=False, session=Session):
+    '''Returns a dict of dataset dicts keyed by dataset id, for passing to
+    Issue.as_plain_dict.
+
+    The datasets are loaded in one query and each is dictized once, however
+    many times it appears in dataset_ids. With summary=True only id, name,
+    title and owner_org are fetched, instead of the full package dict.
+    '''
+    dataset_ids = set(dataset_ids)
+    if not dataset_ids:
+        return {}
+    if summary:
+        query = session.query(Package.id, Package.name, Package.title,
+                              Package.owner_org)\
+            .filter(Package.id.in_(dataset_ids))
+        return dict((row.id, {'id': row.id,
+                              'name': row.name,
+                              'title': row.title,
+                              'owner_org': row.owner_org})
+                    for row in query)
+    context = {'model': model, 'session': session}
+    packages = session.query(Package).filter(Package.id.in_(dataset_ids))
+    return dict((pkg.id, model_dictize.package_dictize(pkg, context))
+                for pkg in packages)
+
+
+def _get_user_dict(user_id, user, user_dicts):
+    if user_dicts and user_id in user_dicts:
+        return user_dicts[user_id]
+    return _user_dict(user)
+
+
 class IssueFilter(enum.Enum):
     newest = 'Newest'
     oldest = 'Oldest'
@@ -134,33 +412,122 @@ class IssueFilter(enum.Enum):
     least_recently_updated = 'Least Recently Updated'
 
     @classmethod
-    def get_filter(cls, issue_filter):
-        '''Takes an IssueFilter, and returns a sqlalchemy filtering function
-
-        The filtering function returned takes and sqlalchemy query and applies
-        the filter to the sqlalchemy query'''
-        sort_functions = {
-            cls.newest: lambda q: q.order_by(Issue.created.desc()),
-            cls.oldest: lambda q: q.order_by(Issue.created.asc()),
-            cls.least_commented:
-                lambda q: q.order_by(func.count(IssueComment.id).asc()),
-            cls.most_commented:
-                lambda q: q.order_by(func.count(IssueComment.id).desc()),
-            cls.recently_updated:
-                lambda q: q.order_by(func.max(IssueComment.created).asc()),
-            cls.least_recently_updated:
-                lambda q: q.order_by(func.max(IssueComment.created).desc()),
+    def get_sort_key(cls, issue_filter):
+        '''Returns the Issue column name an IssueFilter sorts on, and whether
+        it sorts descending'''
+        sort_keys = {
+            cls.newest: ('created', True),
+            cls.oldest: ('created', False),
+            cls.least_commented: ('comment_count', False),
+            cls.most_commented: ('comment_count', True),
+            cls.recently_updated: ('last_activity', True),
+            cls.least_recently_updated: ('last_activity', False),
         }
         try:
-            return sort_functions[issue_filter]
+            return sort_keys[issue_filter]
         except KeyError:
             raise InvalidIssueFilterException()
 
+    @classmethod
+    def get_filter(cls, issue_filter):
+        '''Takes an IssueFilter, and returns a sqlalchemy filtering function
+
+        The filtering function returned takes and sqlalchemy query and applies
+        the filter to the sqlalchemy query. Issue.id is used as a tiebreaker
+        so that the order is stable.'''
+        column_name, descending = cls.get_sort_key(issue_filter)
+        column = getattr(Issue, column_name)
+        if descending:
+            return lambda q: q.order_by(column.desc(), Issue.id.desc())
+        return lambda q: q.order_by(column.asc(), Issue.id.asc())
+
+    @classmethod
+    def get_cursor_filter(cls, issue_filter, value, issue_id):
+        '''Returns a sqlalchemy filtering function that restricts a query
+        sorted by issue_filter to the issues after the given position (the sort
+        column's value and the issue id of the last issue already seen).
+
+        This is keyset pagination, so unlike an offset the database can seek
+        straight to the page through the index.'''
+        column_name, descending = cls.get_sort_key(issue_filter)
+        column = getattr(Issue, column_name)
+        if descending:
+            after = or_(column < value,
+                        and_(column == value, Issue.id < issue_id))
+        else:
+            after = or_(column > value,
+                        and_(column == value, Issue.id > issue_id))
+        return lambda q: q.filter(after)
 
-class InvalidIssueFilterException(object):
+
+class InvalidIssueFilterException(Exception):
     pass
 
 
+def _encode_position(position):
+    return base64.urlsafe_b64encode(json.dumps(position)).rstrip('=')
+
+
+def _decode_position(cursor):
+    padding = '=' * (-len(cursor) % 4)
+    return json.loads(base64.urlsafe_b64decode(str(cursor) + padding))
+
+
+def encode_cursor(issue_filter, issue):
+    '''Returns an opaque cursor string for the position of issue in the
+    results sorted by issue_filter'''
+    column_name, descending = IssueFilter.get_sort_key(issue_filter)
+    value = getattr(issue, column_name)
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return _encode_position([issue_filter.name, value, issue.id])
+
+
+def decode_cursor(cursor):
+    '''Returns (issue_filter, value, issue_id) for a cursor created by
+    encode_cursor. Raises ValueError if it is not a valid cursor.'''
+    try:
+        sort, value, issue_id = _decode_position(cursor)
+        issue_filter = IssueFilter[sort]
+    except (TypeError, ValueError, KeyError, UnicodeEncodeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(issue_id, int):
+        raise ValueError('Invalid cursor')
+    column_name, descending = IssueFilter.get_sort_key(issue_filter)
+    if column_name in ('created', 'last_activity'):
+        value = _parse_isoformat(value)
+    elif not isinstance(value, int):
+        raise ValueError('Invalid cursor')
+    return issue_filter, value, issue_id
+
+
+def encode_comment_cursor(comment):
+    '''Returns an opaque cursor string for the position of comment in its
+    issue's thread'''
+    return _encode_position([comment.created.isoformat(), comment.id])
+
+
+def decode_comment_cursor(cursor):
+    '''Returns the (created, comment_id) position for a cursor created by
+    encode_comment_cursor. Raises ValueError if it is not a valid cursor.'''
+    try:
+        created, comment_id = _decode_position(cursor)
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(comment_id, int):
+        raise ValueError('Invalid cursor')
+    return _parse_isoformat(created), comment_id
+
+
+def _parse_isoformat(value):
+    for format_ in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value, format_)
+        except (TypeError, ValueError):
+            pass
+    raise ValueError('Invalid cursor')
+
+
 class AbuseStatus(enum.Enum):
     unmoderated = 0
     abuse = 1
@@ -194,8 +561,8 @@ class Issue(domain_object.DomainObject):
 
     @classmethod
     def get_issue_count_for_package(cls, dataset_id):
-        return model.Session.query(cls)\
-            .filter(cls.dataset_id==dataset_id).count()
+        stats = get_dataset_stats([dataset_id], model.Session)
+        return stats[dataset_id]['total_count']
 
     @classmethod
     def apply_filters_to_an_issue_query(cls,
@@ -212,20 +579,21 @@ class Issue(domain_object.DomainObject):
         if organization_id:
             org = model.Group.get(organization_id)
             assert org
-            query = query.join(model.Package,
-                               cls.dataset_id == model.Package.id)
             if include_sub_organizations:
-                orgs = (org_.id
-                        for org_
-                        in org.get_children_groups(type='organization'))
-                query = query.filter(model.Package.owner_org.in_(orgs))
+                orgs = membership.get_organization_tree(org.id)
+                query = query.filter(cls.owner_org.in_(orgs))
             else:
-                query = query.filter(model.Package.owner_org == org.id)
+                query = query.filter(cls.owner_org == org.id)
 
         if q:
             search_expr = '%{0}%'.format(q)
-            query = query.filter(or_(cls.title.ilike(search_expr),
-                                     cls.description.ilike(search_expr)))
+            substring_match = or_(cls.title.ilike(search_expr),
+                                  cls.description.ilike(search_expr))
+            backend = search.get_search_backend(query.session, q)
+            if backend:
+                query = backend.filter(query, q, substring_match)
+            else:
+                query = query.filter(substring_match)
 
         if status:
             query = query.filter(cls.status == status)
@@ -250,15 +618,14 @@ class Issue(domain_object.DomainObject):
                    include_sub_organizations=False,
                    include_datasets=False,
                    include_reports=False,
+                   cursor=None,
                    session=Session):
-        comment_count = func.count(IssueComment.id).label('comment_count')
-        last_updated = func.max(IssueComment.created).label('updated')
-        query = session.query(
-            cls,
-            model.User.name,
-            comment_count,
-            last_updated,
-        )
+        '''Returns a query for (issue, user name) rows.
+
+        cursor is a decoded (IssueFilter, value, issue_id) position to start
+        after (see decode_cursor), and takes the place of sort.
+        '''
+        query = session.query(cls, model.User.name)
         query = cls.apply_filters_to_an_issue_query(
             query,
             organization_id=organization_id,
@@ -268,15 +635,21 @@ class Issue(domain_object.DomainObject):
             q=q,
             visibility=visibility,
             include_sub_organizations=include_sub_organizations)
+        if cursor:
+            sort, value, issue_id = cursor
+            query = IssueFilter.get_cursor_filter(sort, value, issue_id)(query)
         if sort:
             try:
                 query = IssueFilter.get_filter(sort)(query)
             except InvalidIssueFilterException:
                 pass
+        elif q:
+            # best matches first
+            backend = search.get_search_backend(session, q)
+            if backend:
+                query = query.order_by(backend.rank(q))
 
-        query = query.join(User, Issue.user_id == User.id)\
-            .outerjoin(IssueComment, Issue.id == IssueComment.issue_id)\
-            .group_by(model.User.name, Issue.id)
+        query = query.join(User, Issue.user_id == User.id)
 
         if offset:
             query = query.offset(offset)
@@ -302,6 +675,37 @@ class Issue(domain_object.DomainObject):
             include_sub_organizations=include_sub_organizations)
         return query.one()[0]
 
+    @classmethod
+    def get_last_modified(cls, dataset_id=None, organization_id=None,
+                          issue_number=None, session=Session):
+        '''Returns the number of issues of the dataset or organization (or
+        the one with issue_number) and when the latest of them was modified,
+        for validating cached pages. For an organization, changes to its
+        datasets count too, as the listing includes their details.'''
+        last_modified = func.max(cls.modified)
+        query = session.query(func.count(cls.id), last_modified)
+        if dataset_id:
+            query = query.filter(cls.dataset_id == dataset_id)
+        if issue_number:
+            query = query.filter(cls.number == issue_number)
+        if organization_id:
+            query = session.query(func.count(cls.id), last_modified,
+                                  func.max(Package.metadata_modified))\
+                .join(Package, Package.id == cls.dataset_id)\
+                .filter(cls.owner_org == organization_id)
+            count, issue_modified, dataset_modified = query.one()
+            return count, max(issue_modified, dataset_modified)
+        return query.one()
+
+    def record_comment(self, session, comment):
+        '''Updates the denormalized comment_count and last_activity for a
+        newly added (and flushed) comment'''
+        self.comment_count = Issue.comment_count + 1
+        self.last_activity = comment.created
+        session.add(self)
+        session.flush()
+        return self
+
     def report_abuse(self, session, user_id, **kwargs):
         self.abuse_reports.append(self.Report(user_id, self.id))
         session.add(self)
@@ -332,7 +736,9 @@ class Issue(domain_object.DomainObject):
         session.flush()
         return self
 
-    def as_dict(self):
+    def as_dict(self, user_dicts=None):
+        '''user_dicts are the dictized users to use, as returned by
+        get_user_dicts, to save loading them one by one'''
         out = super(Issue, self).as_dict()
 
         # TODO: move this stuff to a schema
@@ -341,7 +747,8 @@ class Issue(domain_object.DomainObject):
         except ValueError:
             pass
 
-        out['user'] = _user_dict(self.user)
+        rendering.dictize(self, out)
+        out['user'] = _get_user_dict(self.user_id, self.user, user_dicts)
         # some cases dataset not yet set ...
         if self.dataset:
             out['ckan_url'] = h.url_for('issues_show',
@@ -349,14 +756,17 @@ class Issue(domain_object.DomainObject):
                                         issue_number=self.number)
         return out
 
-    def as_plain_dict(self, user, comment_count, updated,
-                      include_dataset=False, include_reports=False):
+    def as_plain_dict(self, user, include_dataset=False,
+                      include_reports=False, dataset_dicts=None):
         '''Used for listing issues against a dataset
 
         Similar to as_dict, but we're not including full comments or the full
         user dict
 
         returns an issue_dict with a comment_count and a user as a string.
+
+        dataset_dicts are the dictized datasets to use, as returned by
+        get_dataset_dicts, to save loading them one by one.
         '''
         out = super(Issue, self).as_dict()
 
@@ -367,16 +777,19 @@ class Issue(domain_object.DomainObject):
             pass
         out.update({
             'user': user,
-            'comment_count': comment_count,
+            'updated': out['last_activity'],
         })
-
-        if isinstance(updated, datetime):
-            out['updated'] = updated.isoformat()
+        # listings don't show the description, so save sending it twice
+        rendering.dictize(self, out)
+        del out['description_html']
 
         if include_dataset:
-            pkg = self.dataset
-            context = {'model': model, 'session': model.Session}
-            out['dataset'] = model_dictize.package_dictize(pkg, context)
+            if dataset_dicts and self.dataset_id in dataset_dicts:
+                out['dataset'] = dataset_dicts[self.dataset_id]
+            else:
+                pkg = self.dataset
+                context = {'model': model, 'session': model.Session}
+                out['dataset'] = model_dictize.package_dictize(pkg, context)
         if include_reports:
             out['abuse_reports'] = [i.user_id for i in self.abuse_reports]
         return out
@@ -389,6 +802,25 @@ class IssueComment(domain_object.DomainObject):
         """Returns a Issue comment object referenced by its id."""
         return session.query(cls).filter(cls.id == reference).first()
 
+    @classmethod
+    def get_thread_page(cls, issue_id, limit=None, after=None,
+                        session=Session, include_reports=False):
+        '''Returns the issue's comments in the order they were made, starting
+        after the (created, comment_id) position given by after, and at most
+        limit of them.'''
+        query = session.query(cls).filter(cls.issue_id == issue_id)
+        if after:
+            created, comment_id = after
+            query = query.filter(or_(
+                cls.created > created,
+                and_(cls.created == created, cls.id > comment_id)))
+        if include_reports:
+            query = query.options(subqueryload('abuse_reports'))
+        query = query.order_by(cls.created, cls.id)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+
     @classmethod
     def get_comments_for_issue(cls, issue_id):
         """ Gets all comments for a given issue """
@@ -405,29 +837,28 @@ class IssueComment(domain_object.DomainObject):
     def get_hidden_comments(cls, session, organization_id=None):
         query = session.query(IssueComment, Issue) \
             .join(Issue) \
-            .join(model.Package, Issue.dataset_id==Package.id) \
             .filter(cls.visibility == u'hidden') \
             .filter(cls.abuse_status == AbuseStatus.unmoderated.value) \
 
         if organization_id:
-            query = query.filter(model.Package.owner_org == organization_id)
+            query = query.filter(Issue.owner_org == organization_id)
 
         return query
 
     @classmethod
     def get_comments(cls, session, organization_id=None):
         query = session.query(IssueComment, Issue) \
-            .join(Issue) \
-            .join(model.Package, Issue.dataset_id==Package.id)
+            .join(Issue)
 
         if organization_id:
-            query = query.filter(model.Package.owner_org == organization_id)
+            query = query.filter(Issue.owner_org == organization_id)
 
         return query
 
-    def as_dict(self):
+    def as_dict(self, user_dicts=None):
         out = super(IssueComment, self).as_dict()
-        out['user'] = _user_dict(self.user)
+        rendering.dictize(self, out)
+        out['user'] = _get_user_dict(self.user_id, self.user, user_dicts)
         try:
             out['abuse_status'] = AbuseStatus(out['abuse_status']).name
         except ValueError:
@@ -441,9 +872,13 @@ class IssueComment(domain_object.DomainObject):
         return self
 
     def change_visibility(self, session, visibility):
+        changed = self.visibility != visibility
         self.visibility = visibility
         session.add(self)
         session.flush()
+        if changed:
+            # hidden comments are left out of the search index
+            search.index_issue(session, self.issue_id)
         return self
 
     def clear_abuse_report(self, session, user_id):
@@ -479,7 +914,13 @@ issue_table = Table(
     Column('number', types.Integer, nullable=False),
     Column('title', types.UnicodeText, nullable=False),
     Column('description', types.UnicodeText),
+    Column('description_html', types.UnicodeText),
+    Column('description_extract', types.UnicodeText),
+    Column('renderer_version', types.Integer),
     Column('dataset_id', types.UnicodeText, nullable=False),
+    # denormalized from package.owner_org so organization listings don't
+    # need to join to package (see _dataset_owner_org_changed)
+    Column('owner_org', types.UnicodeText),
     Column('resource_id', types.UnicodeText),
     Column('user_id', types.UnicodeText, nullable=False),
     Column('assignee_id', types.UnicodeText),
@@ -492,15 +933,36 @@ issue_table = Table(
     Column('abuse_status',
            types.Integer,
            default=AbuseStatus.unmoderated.value),
+    # denormalized from issue_comment so listings don't need to aggregate
+    Column('comment_count', types.Integer, default=0, nullable=False),
+    Column('last_activity', types.DateTime, default=datetime.now),
+    # when anything shown with the issue last changed (see _touch_issue)
+    Column('modified', types.DateTime, default=datetime.now),
     Index('idx_issue_number_dataset_id', 'dataset_id', 'number',
           unique=True),
+    Index('idx_issue_comment_count', 'comment_count'),
+    Index('idx_issue_last_activity', 'last_activity'),
 )
+# for the shapes of issue_search's queries: a dataset's issues by status,
+# newest first; moderation of hidden, unmoderated issues; and a user's issues
+Index('idx_issue_dataset_status_created', issue_table.c.dataset_id,
+      issue_table.c.status, issue_table.c.created)
+Index('idx_issue_moderation', issue_table.c.abuse_status,
+      issue_table.c.created,
+      postgresql_where=issue_table.c.visibility == u'hidden')
+Index('idx_issue_user_created', issue_table.c.user_id, issue_table.c.created)
+Index('idx_issue_owner_org_status_created', issue_table.c.owner_org,
+      issue_table.c.status, issue_table.c.created)
+search.register_ddl(issue_table)
 
 issue_comment_table = Table(
     'issue_comment',
     meta.metadata,
     Column('id', types.Integer, primary_key=True, autoincrement=True),
     Column('comment', types.Unicode, nullable=False),
+    Column('comment_html', types.UnicodeText),
+    Column('comment_extract', types.UnicodeText),
+    Column('renderer_version', types.Integer),
     Column('user_id', types.Unicode, nullable=False, index=True),
     Column('issue_id', types.Integer,
            ForeignKey('issue.id', onupdate='CASCADE', ondelete='CASCADE'),
@@ -512,6 +974,28 @@ issue_comment_table = Table(
            types.Integer,
            default=AbuseStatus.unmoderated.value),
 )
+# for an issue's thread, in order, and moderation of hidden comments
+Index('idx_issue_comment_issue_created', issue_comment_table.c.issue_id,
+      issue_comment_table.c.created, issue_comment_table.c.id)
+Index('idx_issue_comment_moderation', issue_comment_table.c.abuse_status,
+      issue_comment_table.c.issue_id,
+      postgresql_where=issue_comment_table.c.visibility == u'hidden')
+
+# indexes added since the tables were first created, by the migration that
+# added them
+MIGRATION_INDEXES = {
+    9: ['idx_issue_dataset_status_created', 'idx_issue_moderation',
+        'idx_issue_user_created', 'idx_issue_comment_issue_created',
+        'idx_issue_comment_moderation'],
+    10: ['idx_issue_owner_org_status_created'],
+}
+
+issue_number_counter_table = Table(
+    'issue_number_counter',
+    meta.metadata,
+    Column('dataset_id', types.UnicodeText, primary_key=True),
+    Column('last_number', types.Integer, nullable=False, default=0),
+)
 
 meta.mapper(
     Issue,
@@ -568,4 +1052,69 @@ meta.mapper(
     }
 )
 
+rendering.register(Issue, 'description')
+rendering.register(IssueComment, 'comment')
+
 report_tables = define_report_tables([Issue, IssueComment])
+search_cache.register(Issue, IssueComment, issue_table, issue_comment_table)
+dataset_stats.register(Issue, issue_table)
+
+
+def _issue_modified(mapper, connection, issue):
+    issue.modified = datetime.now()
+
+
+def _issue_inserted(mapper, connection, issue):
+    # last_activity starts as the creation time, as backfill_comment_stats
+    # sets it for issues without comments
+    if issue.created is None:
+        issue.created = datetime.now()
+    if issue.last_activity is None:
+        issue.last_activity = issue.created
+    if issue.owner_org is None:
+        issue.owner_org = connection.execute(
+            select([model.package_table.c.owner_org])
+            .where(model.package_table.c.id == issue.dataset_id)).scalar()
+
+
+def _dataset_owner_org_changed(mapper, connection, dataset):
+    # moves the dataset's issues with it, however it was moved (e.g.
+    # package_owner_org_update doesn't call the IPackageController hooks)
+    if not get_history(dataset, 'owner_org').has_changes():
+        return
+    connection.execute(issue_table.update()
+                       .where(issue_table.c.dataset_id == dataset.id)
+                       .values(owner_org=dataset.owner_org))
+
+
+def _touch_issue(connection, issue_id):
+    '''Marks an issue modified because of a change to its comments or
+    abuse reports'''
+    connection.execute(issue_table.update()
+                       .where(issue_table.c.id == issue_id)
+                       .values(modified=datetime.now()))
+
+
+def _comment_modified(mapper, connection, comment):
+    _touch_issue(connection, comment.issue_id)
+
+
+def _issue_report_modified(mapper, connection, report):
+    _touch_issue(connection, report.parent_id)
+
+
+def _comment_report_modified(mapper, connection, report):
+    _touch_issue(connection,
+                 select([issue_comment_table.c.issue_id])
+                 .where(issue_comment_table.c.id == report.parent_id)
+                 .as_scalar())
+
+
+event.listen(Issue, 'before_insert', _issue_modified)
+event.listen(Issue, 'before_insert', _issue_inserted)
+event.listen(Package, 'after_update', _dataset_owner_org_changed)
+event.listen(Issue, 'before_update', _issue_modified)
+for _event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(IssueComment, _event_name, _comment_modified)
+    event.listen(Issue.Report, _event_name, _issue_report_modified)
+    event.listen(IssueComment.Report, _event_name, _comment_report_modified)
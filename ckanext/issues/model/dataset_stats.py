@@ -0,0 +1,248 @@
+'''Issue counts and last activity per dataset
+
+issue_dataset_stats has a row per dataset with issues, so that badges and
+counts for a page of datasets come from one query (see get_dataset_stats)
+rather than counting each dataset's issues. Every issue is counted in one
+of open_count, closed_count (the visible ones, by status) or hidden_count
+(those hidden as spam/abuse), and in total_count.
+
+The rows are kept up to date as issues are saved, by adding or subtracting
+the change in a single UPDATE (see register, and count_new_issues for
+issues written without the ORM). backfill_dataset_stats
+recalculates them all from the issue table.
+
+The datasets whose stats change are queued in issue_dataset_reindex, in the
+same transaction, for ``paster issues reindex_datasets`` to update their
+search documents (see ckanext.issues.lib.dataset_index), unless
+ckanext.issues.reindex_datasets is false.
+'''
+from datetime import datetime
+
+from pylons import config
+from sqlalchemy import types, Table, Column, event, func, select, case, or_
+from sqlalchemy.orm.attributes import get_history
+
+from ckan.model import meta
+import ckan.plugins as p
+
+COUNT_COLUMNS = ('open_count', 'closed_count', 'hidden_count', 'total_count')
+
+issue_dataset_stats_table = Table(
+    'issue_dataset_stats',
+    meta.metadata,
+    Column('dataset_id', types.UnicodeText, primary_key=True),
+    Column('open_count', types.Integer, nullable=False, default=0),
+    Column('closed_count', types.Integer, nullable=False, default=0),
+    Column('hidden_count', types.Integer, nullable=False, default=0),
+    Column('total_count', types.Integer, nullable=False, default=0),
+    Column('last_activity', types.DateTime),
+)
+
+# a row per dataset waiting to be reindexed, however many times its stats
+# changed since the last run
+issue_dataset_reindex_table = Table(
+    'issue_dataset_reindex',
+    meta.metadata,
+    Column('dataset_id', types.UnicodeText, primary_key=True),
+    Column('queued', types.DateTime, nullable=False),
+)
+
+# set by register
+_issue_table = None
+
+
+def _empty_stats(dataset_id):
+    stats = dict((column, 0) for column in COUNT_COLUMNS)
+    stats.update(dataset_id=dataset_id, last_activity=None)
+    return stats
+
+
+def get_dataset_stats(dataset_ids, session):
+    '''Returns {dataset_id: stats dict} for the given datasets, in one
+    query. Datasets without issues get zero counts.'''
+    dataset_ids = set(dataset_id for dataset_id in dataset_ids if dataset_id)
+    stats = dict((dataset_id, _empty_stats(dataset_id))
+                 for dataset_id in dataset_ids)
+    if not dataset_ids:
+        return stats
+    table = issue_dataset_stats_table
+    rows = session.execute(
+        select([table]).where(table.c.dataset_id.in_(dataset_ids)))
+    for row in rows:
+        stats[row['dataset_id']] = dict(row)
+    return stats
+
+
+def reindex_enabled():
+    return p.toolkit.asbool(
+        config.get('ckanext.issues.reindex_datasets', True))
+
+
+def queue_reindex(connection, dataset_ids):
+    '''Queues the datasets to be reindexed. Callers hold the lock on the
+    datasets' stats (or, for a dataset's first issue, its issue number
+    counter) rows, so no one else can be adding the same dataset.'''
+    if not reindex_enabled():
+        return
+    table = issue_dataset_reindex_table
+    now = datetime.now()
+    for dataset_id in dataset_ids:
+        updated = connection.execute(
+            table.update().where(table.c.dataset_id == dataset_id)
+            .values(queued=now)).rowcount
+        if not updated:
+            connection.execute(table.insert().values(dataset_id=dataset_id,
+                                                     queued=now))
+
+
+def get_queued_reindexes(session, limit, before, exclude=()):
+    '''The datasets queued for reindexing before the given time, as
+    (dataset_id, queued) rows, the longest waiting first'''
+    table = issue_dataset_reindex_table
+    query = select([table.c.dataset_id, table.c.queued])\
+        .where(table.c.queued <= before)
+    if exclude:
+        query = query.where(~table.c.dataset_id.in_(list(exclude)))
+    return session.execute(
+        query.order_by(table.c.queued, table.c.dataset_id).limit(limit))\
+        .fetchall()
+
+
+def dequeue_reindex(session, dataset_id, queued):
+    '''Takes the dataset off the queue, unless it was queued again after
+    queued'''
+    table = issue_dataset_reindex_table
+    session.execute(table.delete()
+                    .where(table.c.dataset_id == dataset_id)
+                    .where(table.c.queued == queued))
+
+
+def _stats_select(issue_table):
+    '''Calculates the stats rows from the issue table'''
+    hidden = func.coalesce(issue_table.c.visibility, u'visible') == u'hidden'
+
+    def count_where(condition):
+        return func.sum(case([(condition, 1)], else_=0))
+    return select([
+        issue_table.c.dataset_id,
+        count_where(~hidden & (issue_table.c.status == u'open')),
+        count_where(~hidden & (issue_table.c.status != u'open')),
+        count_where(hidden),
+        func.count(issue_table.c.id),
+        func.max(issue_table.c.last_activity),
+    ]).group_by(issue_table.c.dataset_id)
+
+
+def backfill_dataset_stats(session, dataset_ids=None):
+    '''Recalculates every dataset's stats (or the given datasets', which are
+    then queued for reindexing) from its issues. Returns the number of them
+    with issues.'''
+    table = issue_dataset_stats_table
+    delete = table.delete()
+    stats_select = _stats_select(_issue_table)
+    if dataset_ids is not None:
+        dataset_ids = list(dataset_ids)
+        delete = delete.where(table.c.dataset_id.in_(dataset_ids))
+        stats_select = stats_select.where(
+            _issue_table.c.dataset_id.in_(dataset_ids))
+    session.execute(delete)
+    columns = ['dataset_id'] + list(COUNT_COLUMNS) + ['last_activity']
+    count = session.execute(table.insert().from_select(
+        [table.c[column] for column in columns], stats_select)).rowcount
+    if dataset_ids is not None:
+        queue_reindex(session, dataset_ids)
+    return count
+
+
+def _bucket(visibility, status):
+    if visibility == u'hidden':
+        return 'hidden_count'
+    return 'open_count' if status == u'open' else 'closed_count'
+
+
+def _old_value(issue, attribute):
+    history = get_history(issue, attribute)
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(issue, attribute)
+
+
+def apply_changes(connection, dataset_id, deltas, last_activity=None):
+    '''Adds deltas ({column: change}) to the dataset's counts, and moves its
+    last_activity on to last_activity if that is later, in one UPDATE, so
+    that concurrent changes to the same dataset add up'''
+    table = issue_dataset_stats_table
+    values = dict((column, table.c[column] + delta)
+                  for column, delta in deltas.items() if delta)
+    if last_activity:
+        values['last_activity'] = case(
+            [(or_(table.c.last_activity == None,  # noqa
+                  table.c.last_activity < last_activity), last_activity)],
+            else_=table.c.last_activity)
+    if not values:
+        return
+    updated = connection.execute(
+        table.update().where(table.c.dataset_id == dataset_id)
+        .values(**values)).rowcount
+    if not updated:
+        # the dataset's first issue. Issues are only created with a number
+        # from allocate_issue_numbers, which keeps the dataset's counter row
+        # locked until the transaction ends, so there's no race to create
+        # this row too. The issue has been written, so it is counted.
+        columns = ['dataset_id'] + list(COUNT_COLUMNS) + ['last_activity']
+        connection.execute(table.insert().from_select(
+            [table.c[column] for column in columns],
+            _stats_select(_issue_table)
+            .where(_issue_table.c.dataset_id == dataset_id)))
+    queue_reindex(connection, [dataset_id])
+
+
+def count_new_issues(connection, dataset_id, issues):
+    '''Adds issues written without the ORM (so without its events) to the
+    dataset's stats. issues is a list of (visibility, status,
+    last_activity).'''
+    deltas = {'total_count': len(issues)}
+    for visibility, status, last_activity in issues:
+        column = _bucket(visibility, status)
+        deltas[column] = deltas.get(column, 0) + 1
+    apply_changes(connection, dataset_id, deltas,
+                  max(issue[2] for issue in issues) if issues else None)
+
+
+def _apply(connection, issue, deltas, last_activity=None):
+    apply_changes(connection, issue.dataset_id, deltas, last_activity)
+
+
+def _issue_inserted(mapper, connection, issue):
+    _apply(connection, issue,
+           {_bucket(issue.visibility, issue.status): 1, 'total_count': 1},
+           issue.last_activity)
+
+
+def _issue_updated(mapper, connection, issue):
+    deltas = {}
+    old_bucket = _bucket(_old_value(issue, 'visibility'),
+                         _old_value(issue, 'status'))
+    new_bucket = _bucket(issue.visibility, issue.status)
+    if old_bucket != new_bucket:
+        deltas = {old_bucket: -1, new_bucket: 1}
+    last_activity = None
+    history = get_history(issue, 'last_activity')
+    if history.added and isinstance(history.added[0], datetime):
+        last_activity = history.added[0]
+    _apply(connection, issue, deltas, last_activity)
+
+
+def _issue_deleted(mapper, connection, issue):
+    _apply(connection, issue,
+           {_bucket(_old_value(issue, 'visibility'),
+                    _old_value(issue, 'status')): -1,
+            'total_count': -1})
+
+
+def register(issue_class, issue_table):
+    global _issue_table
+    _issue_table = issue_table
+    event.listen(issue_class, 'after_insert', _issue_inserted)
+    event.listen(issue_class, 'after_update', _issue_updated)
+    event.listen(issue_class, 'after_delete', _issue_deleted)
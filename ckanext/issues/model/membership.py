@@ -0,0 +1,168 @@
+'''Caches of per-organization membership lookups
+
+Values are kept for ckanext.issues.membership_cache_ttl seconds (default
+300), and dropped as soon as this process sees a change to the
+organization's members (or, for changes to users or to the group
+hierarchy, to any organization's). Other processes pick changes up when
+the ttl runs out.
+'''
+import threading
+import time
+
+from pylons import config
+from sqlalchemy import event, select
+
+from ckan import model
+
+try:
+    import ckan.authz as authz
+except ImportError:
+    import ckan.new_authz as authz
+
+# every OrganizationCache, so that they can all be invalidated
+_caches = []
+
+# when this process last invalidated them (see cache_generation)
+_last_invalidated = 0
+
+
+def cache_ttl():
+    return int(config.get('ckanext.issues.membership_cache_ttl', 300))
+
+
+class OrganizationCache(object):
+    '''Values keyed by organization id'''
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+        _caches.append(self)
+
+    def get(self, organization_id, load):
+        '''Returns the cached value for the organization, calling
+        load(organization_id) to get it if it isn't cached or has expired'''
+        now = time.time()
+        with self._lock:
+            entry = self._values.get(organization_id)
+        if entry and entry[0] > now:
+            return entry[1]
+        value = load(organization_id)
+        with self._lock:
+            self._values[organization_id] = (now + cache_ttl(), value)
+        return value
+
+    def invalidate(self, organization_id=None):
+        '''Drops the organization's value, or every value if no
+        organization_id is given'''
+        with self._lock:
+            if organization_id is None:
+                self._values.clear()
+            else:
+                self._values.pop(organization_id, None)
+
+
+def invalidate(organization_id=None):
+    global _last_invalidated
+    _last_invalidated = time.time()
+    for cache in _caches:
+        cache.invalidate(organization_id)
+
+
+def cache_generation():
+    '''Returns a value that changes whenever this process sees a change to
+    organization members, users or organizations, and otherwise every
+    cache_ttl() seconds, by when other processes' cached values have
+    expired too. For validating cached pages that show membership or user
+    details.'''
+    return '{0}.{1!r}'.format(int(time.time() // max(cache_ttl(), 1)),
+                              _last_invalidated)
+
+
+def _member_changed(mapper, connection, member):
+    if member.table_name == 'user':
+        invalidate(member.group_id)
+    else:
+        # a change to the group hierarchy
+        invalidate()
+
+
+def _user_changed(mapper, connection, user):
+    invalidate()
+
+
+def _group_changed(mapper, connection, group):
+    # e.g. a sub-organization deleted
+    invalidate()
+
+
+for _event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(model.Member, _event_name, _member_changed)
+event.listen(model.User, 'after_update', _user_changed)
+event.listen(model.Group, 'after_update', _group_changed)
+
+
+_editors_cache = OrganizationCache()
+
+
+def _query_organization_editors(organization_id):
+    roles = authz.get_roles_with_permission('update_dataset')
+    query = model.Session.query(model.Member.capacity,
+                                model.User.id,
+                                model.User.name,
+                                model.User.email,
+                                model.Group.name,
+                                model.Group.title)\
+        .join(model.User, model.User.id == model.Member.table_id)\
+        .join(model.Group, model.Group.id == model.Member.group_id)\
+        .filter(model.Member.group_id == organization_id)\
+        .filter(model.Member.table_name == 'user')\
+        .filter(model.Member.state == 'active')\
+        .filter(model.Member.capacity.in_(roles))\
+        .filter(model.User.state == 'active')\
+        .filter(model.Group.state == 'active')
+    return [dict(user_id=user_id,
+                 user_name=user_name,
+                 email=email,
+                 capacity=capacity,
+                 organization_name=org_name,
+                 organization_title=org_title)
+            for capacity, user_id, user_name, email, org_name, org_title
+            in query]
+
+
+def get_organization_editors(organization_id):
+    '''Returns a dict for each user who can edit the organization's datasets,
+    with their user_id, user_name, email and capacity (role) and the
+    organization_name and organization_title. Cached.'''
+    return _editors_cache.get(organization_id, _query_organization_editors)
+
+
+_tree_cache = OrganizationCache()
+
+
+def _query_organization_tree(organization_id):
+    groups = model.group_table
+    members = model.member_table
+    tree = select([groups.c.id])\
+        .where(groups.c.id == organization_id)\
+        .cte('organization_tree', recursive=True)
+    # a sub-organization is a member of its parent with table_name 'group'
+    children = select([members.c.group_id])\
+        .select_from(members.join(groups,
+                                  groups.c.id == members.c.group_id))\
+        .where(members.c.table_id == tree.c.id)\
+        .where(members.c.table_name == 'group')\
+        .where(members.c.state == 'active')\
+        .where(groups.c.type == 'organization')\
+        .where(groups.c.state == 'active')
+    # UNION rather than UNION ALL, so that a cycle in the hierarchy ends
+    tree = tree.union(children)
+    return frozenset(row[0] for row
+                     in model.Session.execute(select([tree.c.id])))
+
+
+def get_organization_tree(organization_id):
+    '''Returns the ids of the organization and of every organization below
+    it in the hierarchy, however deep, found with one recursive query.
+    Cached.'''
+    return _tree_cache.get(organization_id, _query_organization_tree)
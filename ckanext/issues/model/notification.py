@@ -0,0 +1,62 @@
+'''Outbox of email notifications waiting to be sent
+
+issue_create and issue_comment_create add a row per recipient in the same
+transaction as the issue or comment, and ``paster issues send_notifications``
+sends them (see ckanext.issues.lib.notifications). Rows are deleted once
+sent; ones that keep failing are kept, marked as failed, for inspection.
+'''
+from datetime import datetime, timedelta
+
+from sqlalchemy import types, Table, Column, Index
+
+from ckan.model import domain_object, meta
+
+
+class IssueNotification(domain_object.DomainObject):
+
+    def __init__(self, recipient_id, subject, body):
+        self.recipient_id = recipient_id
+        self.subject = subject
+        self.body = body
+
+    @classmethod
+    def get_due(cls, session, limit, now=None):
+        '''The unsent notifications that are due to be (re)tried, oldest
+        first'''
+        now = now or datetime.now()
+        return session.query(cls)\
+            .filter(cls.failed == False)\
+            .filter(cls.next_attempt <= now)\
+            .order_by(cls.next_attempt, cls.id)\
+            .limit(limit)\
+            .all()
+
+    def record_failure(self, error, max_attempts, retry_delay):
+        '''Schedules the next attempt, backing off exponentially from
+        retry_delay seconds, or gives up after max_attempts'''
+        self.attempts = (self.attempts or 0) + 1
+        self.last_error = unicode(error)
+        if self.attempts >= max_attempts:
+            self.failed = True
+        else:
+            delay = retry_delay * 2 ** (self.attempts - 1)
+            self.next_attempt = datetime.now() + timedelta(seconds=delay)
+
+
+issue_notification_table = Table(
+    'issue_notification',
+    meta.metadata,
+    Column('id', types.Integer, primary_key=True, autoincrement=True),
+    Column('recipient_id', types.UnicodeText, nullable=False),
+    Column('subject', types.UnicodeText, nullable=False),
+    Column('body', types.UnicodeText, nullable=False),
+    Column('created', types.DateTime, default=datetime.now, nullable=False),
+    Column('attempts', types.Integer, default=0, nullable=False),
+    Column('next_attempt', types.DateTime, default=datetime.now,
+           nullable=False),
+    Column('last_error', types.UnicodeText),
+    Column('failed', types.Boolean, default=False, nullable=False),
+    Index('idx_issue_notification_due', 'failed', 'next_attempt'),
+)
+
+meta.mapper(IssueNotification, issue_notification_table)
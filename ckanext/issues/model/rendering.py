@@ -0,0 +1,98 @@
+'''Markdown of issues and comments, rendered when it is saved
+
+Rendering Markdown and sanitizing the result is the bulk of the work of
+showing a long issue thread, so the sanitized HTML and a plain text extract
+are stored alongside Issue.description and IssueComment.comment whenever
+those change (see register), along with the RENDERER_VERSION they were made
+with. Rows rendered by an older version (or not at all) are rendered again
+by ``paster issues rerender_markdown``; until then their stored text is
+ignored and the templates render it on the fly, as before.
+'''
+from sqlalchemy import event, or_
+from sqlalchemy.orm.attributes import get_history
+
+import ckan.lib.helpers as h
+
+# bump this whenever render() would give a different result, then run
+# paster issues rerender_markdown
+RENDERER_VERSION = 1
+
+# as for the og:description of the issue page
+EXTRACT_LENGTH = 200
+
+# the Markdown source attribute of each rendered class, and the attributes
+# its renderings are stored in
+_source_attributes = {}
+
+
+def render(text):
+    '''Returns the sanitized HTML and a plain text extract of Markdown text,
+    as h.render_markdown and h.markdown_extract would'''
+    return (unicode(h.render_markdown(text)),
+            unicode(h.markdown_extract(text, extract_length=EXTRACT_LENGTH)))
+
+
+def update_rendered(obj, force=False):
+    '''Renders obj's Markdown into its html and extract attributes, if it
+    has changed or was rendered by an older version of the renderer (or if
+    force is True)'''
+    source = _source_attributes[type(obj)]
+    if not (force or obj.renderer_version != RENDERER_VERSION or
+            get_history(obj, source).has_changes()):
+        return
+    html, extract = render(getattr(obj, source))
+    setattr(obj, source + '_html', html)
+    setattr(obj, source + '_extract', extract)
+    obj.renderer_version = RENDERER_VERSION
+
+
+def is_current(obj):
+    return obj.renderer_version == RENDERER_VERSION
+
+
+def dictize(obj, out):
+    '''Tidies the rendered Markdown in an as_dict of obj: renderings by an
+    older version of the renderer are blanked, so that the caller renders
+    the Markdown itself'''
+    source = _source_attributes[type(obj)]
+    out.pop('renderer_version', None)
+    if not is_current(obj):
+        out[source + '_html'] = out[source + '_extract'] = None
+    return out
+
+
+def _before_save(mapper, connection, obj):
+    update_rendered(obj)
+
+
+def register(cls, source):
+    '''Keeps the rendering of cls's Markdown attribute source up to date.
+    The class's table needs <source>_html, <source>_extract and
+    renderer_version columns.'''
+    _source_attributes[cls] = source
+    for event_name in ('before_insert', 'before_update'):
+        event.listen(cls, event_name, _before_save)
+
+
+def rerender_all(session, batch_size=500, force=False):
+    '''Renders the Markdown of every issue and comment that was rendered by
+    an older version of the renderer (or every one of them, if force is
+    True), committing after each batch. Returns how many were rendered.'''
+    count = 0
+    for cls in _source_attributes:
+        last_id = 0
+        while True:
+            query = session.query(cls).filter(cls.id > last_id)
+            if not force:
+                query = query.filter(or_(
+                    cls.renderer_version == None,  # noqa
+                    cls.renderer_version != RENDERER_VERSION))
+            batch = query.order_by(cls.id).limit(batch_size).all()
+            if not batch:
+                break
+            for obj in batch:
+                update_rendered(obj, force=True)
+            session.commit()
+            count += len(batch)
+            last_id = batch[-1].id
+    return count
@@ -0,0 +1,238 @@
+'''Full text search over issues and their comments
+
+On PostgreSQL each issue has a ``search_vector`` tsvector column (with a GIN
+index) and on SQLite the issues are mirrored into an FTS5 table called
+``issue_fts``. Both cover the title, the description and the text of the
+issue's comments, apart from those hidden by moderation.
+
+Neither is part of the mapped issue table; they are created alongside it
+through DDL events (see register_ddl) or by ``paster issues upgrade_db`` on
+existing sites. If the index isn't there, get_backend returns None and
+searches fall back to ILIKE, as do searches for nothing but stop words.
+'''
+import logging
+import re
+
+from pylons import config
+from sqlalchemy import (DDL, event, func, select, literal_column, text, or_,
+                        and_)
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.sql import table, column
+
+log = logging.getLogger(__name__)
+
+SEARCH_TERM = re.compile(r'\w+', re.UNICODE)
+
+POSTGRES_CREATE_SQL = '''
+ALTER TABLE issue ADD COLUMN search_vector tsvector;
+CREATE INDEX idx_issue_search_vector ON issue USING gin(search_vector);
+'''
+
+SQLITE_CREATE_SQL = '''
+CREATE VIRTUAL TABLE issue_fts USING fts5(title, description, comments)
+'''
+
+SQLITE_DROP_SQL = 'DROP TABLE IF EXISTS issue_fts'
+
+issue_fts_table = table('issue_fts', column('rowid'), column('rank'))
+
+# backend (or None) for each database url, as checking means reflection
+_backends = {}
+
+
+def search_language():
+    return config.get('ckanext.issues.search_language', 'english')
+
+
+def search_terms(q):
+    '''Splits a free text query into the words to search for, dropping
+    anything that could be taken as query syntax'''
+    return SEARCH_TERM.findall(q or u'')
+
+
+class PostgresSearch(object):
+    '''tsvector column on the issue table'''
+    name = 'postgresql'
+
+    def _tsquery(self, q):
+        # prefix match every word, to behave more like the old substring
+        # search for partially typed words
+        query_string = u' & '.join(u'{0}:*'.format(term)
+                                   for term in search_terms(q))
+        return func.to_tsquery(search_language(), query_string)
+
+    def filter(self, query, q, fallback):
+        # a query of only stop words comes out empty, matching nothing, so
+        # then the fallback is used instead. numnode() of the constant
+        # tsquery is worked out when planning, leaving only one branch.
+        tsquery = self._tsquery(q)
+        is_empty = func.numnode(tsquery) == 0
+        return query.filter(or_(
+            and_(~is_empty,
+                 literal_column('issue.search_vector').op('@@')(tsquery)),
+            and_(is_empty, fallback)))
+
+    def rank(self, q):
+        return func.ts_rank(literal_column('issue.search_vector'),
+                            self._tsquery(q)).desc()
+
+    def index_issues(self, session, issue_ids=None):
+        sql = '''
+        UPDATE issue SET search_vector =
+            setweight(to_tsvector(CAST(:language AS regconfig),
+                                  coalesce(issue.title, '')), 'A') ||
+            setweight(to_tsvector(CAST(:language AS regconfig),
+                                  coalesce(issue.description, '')), 'B') ||
+            setweight(to_tsvector(CAST(:language AS regconfig), coalesce(
+                (SELECT string_agg(issue_comment.comment, ' ')
+                 FROM issue_comment
+                 WHERE issue_comment.issue_id = issue.id
+                 AND coalesce(issue_comment.visibility, 'visible')
+                     != 'hidden'), '')), 'C')
+        '''
+        if issue_ids is not None:
+            sql += 'WHERE ' + _id_in('issue.id', issue_ids)
+        session.execute(text(sql), {'language': search_language()})
+
+    def remove_issue(self, session, issue_id):
+        # the vector is deleted with the issue row
+        pass
+
+
+class SqliteSearch(object):
+    '''FTS5 table with the issue id as its rowid'''
+    name = 'sqlite'
+
+    def _match(self, q):
+        return u' '.join(u'"{0}"*'.format(term) for term in search_terms(q))
+
+    def _matches(self, q):
+        return literal_column('issue_fts').op('MATCH')(self._match(q))
+
+    def filter(self, query, q, fallback):
+        # fts5 has no stop words, so there's always something to match
+        from ckanext.issues.model import Issue
+        matches = select([issue_fts_table.c.rowid]).where(self._matches(q))
+        return query.filter(Issue.id.in_(matches))
+
+    def rank(self, q):
+        from ckanext.issues.model import Issue
+        # fts5's rank is bm25, where lower is a better match
+        return select([issue_fts_table.c.rank])\
+            .where(self._matches(q))\
+            .where(issue_fts_table.c.rowid == Issue.id)\
+            .as_scalar().asc()
+
+    def index_issues(self, session, issue_ids=None):
+        where = ''
+        if issue_ids is not None:
+            where = 'WHERE ' + _id_in('issue.id', issue_ids)
+            session.execute(text('DELETE FROM issue_fts WHERE ' +
+                                 _id_in('rowid', issue_ids)))
+        else:
+            session.execute(text('DELETE FROM issue_fts'))
+        session.execute(text('''
+        INSERT INTO issue_fts (rowid, title, description, comments)
+        SELECT issue.id, issue.title, coalesce(issue.description, ''),
+               coalesce((SELECT group_concat(issue_comment.comment, ' ')
+                         FROM issue_comment
+                         WHERE issue_comment.issue_id = issue.id
+                         AND coalesce(issue_comment.visibility, 'visible')
+                             != 'hidden'), '')
+        FROM issue
+        {where}
+        '''.format(where=where)))
+
+    def remove_issue(self, session, issue_id):
+        session.execute(text('DELETE FROM issue_fts WHERE rowid = :issue_id'),
+                        {'issue_id': issue_id})
+
+
+def _id_in(column, issue_ids):
+    # the ids are integers, so can go in the SQL as they are
+    return '{0} IN ({1})'.format(
+        column, ', '.join(str(int(issue_id)) for issue_id in issue_ids))
+
+
+def _find_backend(bind):
+    inspector = Inspector.from_engine(bind)
+    if bind.dialect.name == 'postgresql':
+        columns = [c['name'] for c in inspector.get_columns('issue')]
+        if 'search_vector' in columns:
+            return PostgresSearch()
+    elif bind.dialect.name == 'sqlite':
+        if 'issue_fts' in inspector.get_table_names():
+            return SqliteSearch()
+    log.warning('No full text index for issues, falling back to ILIKE')
+    return None
+
+
+def get_backend(session):
+    '''Returns the full text search backend for the session's database, or
+    None if the index is not available'''
+    bind = session.get_bind()
+    key = str(bind.url)
+    if key not in _backends:
+        _backends[key] = _find_backend(bind)
+    return _backends[key]
+
+
+def get_search_backend(session, q):
+    '''Returns the backend to search for q with, or None if there is no
+    index or q has no words to search for, for the caller to fall back to
+    ILIKE. The backend's filter() takes that ILIKE condition too, for when
+    the words turn out to be ones the index leaves out (stop words).'''
+    backend = get_backend(session)
+    if backend and search_terms(q):
+        return backend
+    return None
+
+
+def reset_backend_cache():
+    _backends.clear()
+
+
+def index_issue(session, issue_id):
+    '''(Re)indexes an issue and its comments, if there is an index'''
+    index_issues(session, [issue_id])
+
+
+def index_issues(session, issue_ids):
+    '''(Re)indexes the issues and their comments, if there is an index'''
+    backend = get_backend(session)
+    if backend and issue_ids:
+        backend.index_issues(session, issue_ids)
+
+
+def remove_issue(session, issue_id):
+    backend = get_backend(session)
+    if backend:
+        backend.remove_issue(session, issue_id)
+
+
+def rebuild_index(session):
+    '''Reindexes every issue. Returns False if there is no index.'''
+    backend = get_backend(session)
+    if not backend:
+        return False
+    backend.index_issues(session)
+    return True
+
+
+def _fts5_available(ddl, target, bind, **kw):
+    options = [row[0] for row in bind.execute('PRAGMA compile_options')]
+    return 'ENABLE_FTS5' in options
+
+
+def register_ddl(issue_table):
+    '''Creates (and drops) the full text index along with the issue table'''
+    event.listen(issue_table, 'after_create',
+                 DDL(POSTGRES_CREATE_SQL).execute_if(dialect='postgresql'))
+    event.listen(issue_table, 'after_create',
+                 DDL(SQLITE_CREATE_SQL).execute_if(
+                     dialect='sqlite', callable_=_fts5_available))
+    event.listen(issue_table, 'before_drop',
+                 DDL(SQLITE_DROP_SQL).execute_if(dialect='sqlite'))
+    for event_name in ('after_create', 'after_drop'):
+        event.listen(issue_table, event_name,
+                     lambda *args, **kw: reset_backend_cache())
@@ -0,0 +1,292 @@
+'''A cache of issue_search results
+
+Results are keyed on the normalized search parameters plus a generation of
+what they cover: the dataset when searching a dataset's issues, the
+organization when searching one organization's, and otherwise the whole
+site. Saving an issue, comment or abuse report (or a dataset, whose
+details are in the results) starts a new generation of its dataset, its
+organization and the site once the transaction is committed, so later
+searches miss the old results, which are left to expire.
+
+The backend is set by ckanext.issues.search_cache:
+
+    none (default)    no caching
+    module:callable   called with no arguments to make the backend, which
+                      needs get(key), returning None on a miss, and
+                      set(key, value) methods - e.g. a wrapper around a
+                      memcached client shared by every process
+    memory            an LRU cache in each process, holding up to
+                      ckanext.issues.search_cache_size results (default
+                      1000) for ckanext.issues.search_cache_ttl seconds
+                      (default 10)
+
+A new generation is only seen by the processes sharing the backend, so the
+memory backend is only up to date in the process that made the change.
+Other processes go on returning old results until they expire, so it is
+only suitable for sites served by a single process, or that can live with
+results up to the ttl out of date.
+
+Generations are kept in the backend too, as random tokens rather than
+counts, so that one lost from the cache can't come back round to a value
+that old results were stored under.
+'''
+import collections
+import copy
+import hashlib
+import json
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import enum
+from pylons import config
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session as SessionClass, object_session
+from sqlalchemy.orm.attributes import get_history
+
+from ckan import model
+
+# session.info key of the datasets changed in the current transaction, as
+# {dataset_id: set of their organization ids}
+_CHANGED = 'ckanext.issues.search_cache.changed'
+
+
+class LRUCache(object):
+    '''Keeps the most recently used max_size values, each for ttl seconds'''
+
+    def __init__(self, max_size=1000, ttl=10):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._values = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._values.pop(key, None)
+            if entry is None or entry[0] <= now:
+                return None
+            # most recently used last
+            self._values[key] = entry
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._values.pop(key, None)
+            self._values[key] = (time.time() + self.ttl, value)
+            while len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+
+
+def _make_backend():
+    setting = config.get('ckanext.issues.search_cache', 'none').strip()
+    if setting == 'none':
+        return None
+    if setting == 'memory':
+        return LRUCache(
+            max_size=int(config.get('ckanext.issues.search_cache_size',
+                                    1000)),
+            ttl=int(config.get('ckanext.issues.search_cache_ttl', 10)))
+    module_name, factory_name = setting.split(':', 1)
+    module = __import__(module_name, fromlist=[factory_name])
+    return getattr(module, factory_name)()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                # False for no caching, so the config is only read once
+                _backend = _make_backend() or False
+    return _backend or None
+
+
+def clear():
+    '''Forgets the backend, and with it the in-process cache, and resets
+    the stats'''
+    global _backend
+    with _backend_lock:
+        _backend = None
+    stats(reset=True)
+
+
+def stats(reset=False):
+    '''Returns the numbers of hits and misses of this process since it
+    started (or since the stats were last reset)'''
+    with _backend_lock:
+        current = dict(_stats)
+        if reset:
+            _stats.update(hits=0, misses=0)
+    return current
+
+
+def _count(outcome):
+    with _backend_lock:
+        _stats[outcome] += 1
+
+
+def _generation_key(scope, scope_id=None):
+    return 'ckanext.issues.generation:{0}:{1}'.format(scope, scope_id or '')
+
+
+def _generation(backend, scope, scope_id=None):
+    key = _generation_key(scope, scope_id)
+    generation = backend.get(key)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        backend.set(key, generation)
+    return generation
+
+
+def _bump(backend, scope, scope_id=None):
+    backend.set(_generation_key(scope, scope_id), uuid.uuid4().hex)
+
+
+def _key_default(value):
+    if isinstance(value, enum.Enum):
+        return value.name
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return unicode(value)
+
+
+def _search_scope(params):
+    if params.get('dataset_id'):
+        return 'dataset', params['dataset_id']
+    if params.get('organization_id') and \
+            not params.get('include_sub_organizations'):
+        return 'organization', params['organization_id']
+    return 'site', None
+
+
+def get_or_search(params, search):
+    '''Returns the cached results of a search with the given (validated)
+    params, or calls search() to get them and caches what it returns. The
+    results are copied, so the caller is free to change them.'''
+    backend = get_backend()
+    if backend is None:
+        return search()
+    scope, scope_id = _search_scope(params)
+    key = 'ckanext.issues.search:' + hashlib.sha1(json.dumps(
+        [_generation(backend, scope, scope_id), params],
+        sort_keys=True, default=_key_default)).hexdigest()
+    results = backend.get(key)
+    if results is None:
+        _count('misses')
+        results = search()
+        backend.set(key, copy.deepcopy(results))
+        return results
+    _count('hits')
+    return copy.deepcopy(results)
+
+
+def invalidate(datasets):
+    '''Starts new generations of the given datasets ({dataset_id: their
+    organization ids}), their organizations and the site'''
+    backend = get_backend()
+    if backend is None:
+        return
+    for dataset_id, organization_ids in datasets.items():
+        _bump(backend, 'dataset', dataset_id)
+        for organization_id in organization_ids:
+            if organization_id:
+                _bump(backend, 'organization', organization_id)
+    _bump(backend, 'site')
+
+
+def record_changes(session, datasets):
+    '''Invalidates the given datasets ({dataset_id: their organization ids})
+    once the session's transaction is committed, for changes made without
+    the ORM'''
+    changed = session.info.setdefault(_CHANGED, {})
+    for dataset_id, organization_ids in datasets.items():
+        changed.setdefault(dataset_id, set()).update(organization_ids)
+
+
+def _record_change(target, connection, dataset_id):
+    session = object_session(target)
+    if session is None or not dataset_id:
+        return
+    changed = session.info.setdefault(_CHANGED, {})
+    if dataset_id not in changed:
+        owner_org = connection.execute(
+            select([model.package_table.c.owner_org])
+            .where(model.package_table.c.id == dataset_id)).scalar()
+        changed[dataset_id] = set([owner_org])
+
+
+def _issue_changed(mapper, connection, issue):
+    _record_change(issue, connection, issue.dataset_id)
+
+
+def _issue_id_changed(issue_table):
+    def changed(mapper, connection, target):
+        dataset_id = connection.execute(
+            select([issue_table.c.dataset_id])
+            .where(issue_table.c.id == target.issue_id)).scalar()
+        _record_change(target, connection, dataset_id)
+    return changed
+
+
+def _report_changed(parent_table, issue_table):
+    def changed(mapper, connection, report):
+        if parent_table is issue_table:
+            query = select([issue_table.c.dataset_id])\
+                .where(issue_table.c.id == report.parent_id)
+        else:
+            query = select([issue_table.c.dataset_id])\
+                .where(issue_table.c.id == parent_table.c.issue_id)\
+                .where(parent_table.c.id == report.parent_id)
+        _record_change(report, connection, connection.execute(query).scalar())
+    return changed
+
+
+def _dataset_changed(mapper, connection, dataset):
+    session = object_session(dataset)
+    if session is None:
+        return
+    organization_ids = session.info.setdefault(_CHANGED, {})\
+        .setdefault(dataset.id, set())
+    organization_ids.add(dataset.owner_org)
+    # the organization it was moved from, if any
+    organization_ids.update(get_history(dataset, 'owner_org').deleted)
+
+
+def _after_commit(session):
+    changed = session.info.pop(_CHANGED, None)
+    if changed:
+        invalidate(changed)
+
+
+def _after_rollback(session):
+    session.info.pop(_CHANGED, None)
+
+
+def register(issue_class, comment_class, issue_table, comment_table):
+    '''Invalidates cached searches when issues, comments or their abuse
+    reports are saved'''
+    change_events = ('after_insert', 'after_update', 'after_delete')
+    for event_name in change_events:
+        event.listen(issue_class, event_name, _issue_changed)
+        event.listen(comment_class, event_name,
+                     _issue_id_changed(issue_table))
+        event.listen(issue_class.Report, event_name,
+                     _report_changed(issue_table, issue_table))
+        event.listen(comment_class.Report, event_name,
+                     _report_changed(comment_table, issue_table))
+    # dataset details are included in the results, and moving a dataset to
+    # another organization changes the results of both organizations
+    event.listen(model.Package, 'after_update', _dataset_changed)
+    event.listen(SessionClass, 'after_commit', _after_commit)
+    event.listen(SessionClass, 'after_rollback', _after_rollback)
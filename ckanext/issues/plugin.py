@@ -15,6 +15,7 @@ class IssuesPlugin(p.SingletonPlugin):
     CKAN Issues Extension
     """
     implements(p.IConfigurer, inherit=True)
+    implements(p.IPackageController, inherit=True)
     implements(p.ITemplateHelpers, inherit=True)
     implements(p.IRoutes, inherit=True)
     implements(p.IActions)
@@ -27,6 +28,12 @@ class IssuesPlugin(p.SingletonPlugin):
         toolkit.add_public_directory(config, 'public/css')
         toolkit.add_resource('public/scripts', 'ckanext_issues')
 
+    # IPackageController
+
+    def before_index(self, pkg_dict):
+        from ckanext.issues.lib import dataset_index
+        return dataset_index.before_index(pkg_dict)
+
     # ITemplateHelpers
 
     def get_helpers(self):
@@ -35,6 +42,9 @@ class IssuesPlugin(p.SingletonPlugin):
             'issues_installed': lambda: True,
             'issue_count': util.issue_count,
             'issue_comment_count': util.issue_comment_count,
+            'issues_preload_dataset_stats':
+                helpers.issues_preload_dataset_stats,
+            'issues_dataset_stats': helpers.issues_dataset_stats,
             'issues_enabled_for_organization':
                 helpers.issues_enabled_for_organization,
             'replace_url_param': helpers.replace_url_param,
@@ -95,6 +105,7 @@ class IssuesPlugin(p.SingletonPlugin):
                       '/dataset/:dataset_id/issues/:issue_number',
                       action='show')
             m.connect('all_issues_page', '/issues', action='all_issues_page')
+            m.connect('issues_export', '/issues/export', action='export')
             m.connect('issues_for_organization',
                       '/organization/:org_id/issues',
                       action='issues_for_organization')
@@ -143,4 +154,8 @@ class IssuesPlugin(p.SingletonPlugin):
             'issue_report': auth.issue_report,
             'issue_report_clear': auth.issue_report_clear,
             'issue_comment_search': auth.issue_comment_search,
+            'issue_comment_list': auth.issue_comment_list,
+            'issue_search_cache_stats': auth.issue_search_cache_stats,
+            'issue_export': auth.issue_export,
+            'issue_bulk_create': auth.issue_bulk_create,
         }
@@ -1,4 +1,5 @@
 from ckan.plugins import toolkit
+from pylons import config
 try:
     from ckan.new_tests import helpers
     from ckan.new_tests import factories
@@ -225,3 +226,64 @@ class TestOrganization(helpers.FunctionalTestBase):
         assert self.dataset['title'] in issue_page
         assert self.issue['title'] in issue_page
         assert self.issue['description'] not in issue_page
+
+
+class TestConditionalGet(helpers.FunctionalTestBase):
+    def setup(self):
+        super(TestConditionalGet, self).setup()
+        self.owner = factories.User()
+        self.org = factories.Organization(user=self.owner)
+        self.dataset = factories.Dataset(user=self.owner,
+                                         owner_org=self.org['name'])
+        self.issue = issue_factories.Issue(user=self.owner,
+                                           user_id=self.owner['id'],
+                                           dataset_id=self.dataset['id'])
+        self.app = self._get_test_app()
+        self.urls = [
+            toolkit.url_for('issues_show', dataset_id=self.dataset['name'],
+                            issue_number=self.issue['number']),
+            toolkit.url_for('issues_dataset',
+                            dataset_id=self.dataset['name']),
+            toolkit.url_for('issues_for_organization', org_id=self.org['id']),
+        ]
+
+    def _get_again(self, url, response, **kwargs):
+        return self.app.get(
+            url, headers={'If-None-Match': response.headers['ETag']},
+            **kwargs)
+
+    def test_not_modified(self):
+        for url in self.urls:
+            response = self.app.get(url)
+            assert_equals(304, self._get_again(url, response).status_int)
+
+    def test_modified_by_new_comment(self):
+        responses = [self.app.get(url) for url in self.urls]
+        issue_factories.IssueComment(user_id=self.owner['id'],
+                                     issue_number=self.issue['number'],
+                                     dataset_id=self.dataset['id'])
+        for url, response in zip(self.urls, responses):
+            assert_equals(200, self._get_again(url, response).status_int)
+
+    def test_issue_page_modified_by_new_organization_editor(self):
+        url = self.urls[0]
+        response = self.app.get(url)
+        editor = factories.User()
+        helpers.call_action('organization_member_create',
+                            id=self.org['id'], username=editor['name'],
+                            role='editor')
+        assert_equals(200, self._get_again(url, response).status_int)
+
+    def test_issue_page_modified_by_comments_per_page(self):
+        url = self.urls[0]
+        response = self.app.get(url)
+        config['ckanext.issues.comments_per_page'] = '1'
+        try:
+            assert_equals(200, self._get_again(url, response).status_int)
+        finally:
+            config.pop('ckanext.issues.comments_per_page', None)
+
+    def test_not_used_for_logged_in_users(self):
+        env = {'REMOTE_USER': self.owner['name'].encode('ascii')}
+        response = self.app.get(self.urls[0], extra_environ=env)
+        assert_not_in('ETag', response.headers)
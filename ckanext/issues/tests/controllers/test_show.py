@@ -2,11 +2,11 @@ from ckan.plugins import toolkit
 try:
     from ckan.tests import helpers
     from ckan.tests import factories
-    from ckan.tests.helpers import assert_in
+    from ckan.tests.helpers import assert_in, assert_not_in
 except ImportError:
     from ckan.new_tests import helpers
     from ckan.new_tests import factories
-    from ckan.new_tests.helpers import assert_in
+    from ckan.new_tests.helpers import assert_in, assert_not_in
 
 from ckanext.issues.tests import factories as issue_factories
 from ckanext.issues.tests.helpers import (
@@ -40,3 +40,40 @@ class TestIssuesShowController(helpers.FunctionalTestBase,
         )
         assert_in(self.issue['title'], response)
         assert_in(self.issue['description'], response)
+
+
+class TestIssuesShowCommentPages(helpers.FunctionalTestBase,
+                                 ClearOnSetupClassMixin):
+    @classmethod
+    def _apply_config_changes(cls, config):
+        config['ckanext.issues.comments_per_page'] = '2'
+
+    def setup(self):
+        self.user = factories.User()
+        self.dataset = factories.Dataset()
+        self.issue = issue_factories.Issue(user_id=self.user['id'],
+                                           dataset_id=self.dataset['id'])
+        for i in range(1, 6):
+            issue_factories.IssueComment(user_id=self.user['id'],
+                                         dataset_id=self.dataset['id'],
+                                         issue_number=self.issue['number'],
+                                         comment='comment {0}'.format(i))
+
+    def test_show_more_comments_continues_from_the_last_shown(self):
+        app = self._get_test_app()
+        response = app.get(toolkit.url_for('issues_show',
+                                           dataset_id=self.dataset['id'],
+                                           issue_number=self.issue['number']))
+        assert_in('comment 2', response)
+        assert_not_in('comment 3', response)
+
+        response = response.click(description='Show more comments')
+        assert_in('comment 3', response)
+        assert_in('comment 4', response)
+        assert_not_in('comment 2', response)
+        assert_not_in('comment 5', response)
+        assert_in('Show the first comments', response)
+
+        response = response.click(description='Show more comments')
+        assert_in('comment 5', response)
+        assert_not_in('Show more comments', response)
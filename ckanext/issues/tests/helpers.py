@@ -1,3 +1,9 @@
+import asyncore
+import email
+import smtpd
+import threading
+import time
+
 try:
     from ckan.lib.search import clear_all
 except ImportError:
@@ -8,15 +14,79 @@ try:
 except ImportError:
     from ckan.new_tests import helpers
 
+from ckanext.issues.model import search_cache
+
 
 class ClearOnSetupClassMixin(object):
     @classmethod
     def setupClass(self):
         helpers.reset_db()
         clear_all()
+        search_cache.clear()
 
 
 class ClearOnTearDownMixin(object):
     def teardown(self):
         helpers.reset_db()
         clear_all()
+        search_cache.clear()
+
+
+class SMTPStandIn(smtpd.SMTPServer):
+    '''A local SMTP server, run in a thread, that keeps the emails it
+    receives and counts the connections made to it.
+
+        server = SMTPStandIn()
+        server.start()
+        ... send to server.address ...
+        server.stop()
+    '''
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('localhost', 0), None)
+        self.messages = []
+        self.connections = 0
+        self.channels = []
+        self._running = False
+        self._drop = False
+
+    @property
+    def address(self):
+        return 'localhost:{0}'.format(self.socket.getsockname()[1])
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            conn, addr = pair
+            self.connections += 1
+            self.channels.append(smtpd.SMTPChannel(self, conn, addr))
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((rcpttos, email.message_from_string(data)))
+
+    def drop_connections(self):
+        '''Hangs up on the connected clients, as a server timing out would'''
+        self._drop = True
+        while self._drop:
+            time.sleep(0.01)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        for channel in self.channels:
+            channel.close()
+        self.close()
+
+    def _serve(self):
+        while self._running:
+            if self._drop:
+                for channel in self.channels:
+                    channel.close()
+                self.channels = []
+                self._drop = False
+            asyncore.loop(timeout=0.05, count=1)
@@ -1,13 +1,19 @@
+import mock
+
 from ckanext.issues.tests.helpers import ClearOnTearDownMixin
 from ckanext.issues.tests import factories as issue_factories
-from ckanext.issues.model import Issue, IssueComment, AbuseStatus
+from ckanext.issues.model import (Issue, IssueComment, AbuseStatus,
+                                  get_user_summaries)
 from ckanext.issues.lib.util import issue_count, issue_comments, issue_comment_count
+from ckanext.issues.lib.helpers import (issues_user_has_reported_issue,
+                                        issues_users_who_reported_issue)
 try:
     from ckan.tests import factories, helpers
 except ImportError:
     from ckan.new_tests import factories, helpers
 
-from nose.tools import assert_equals, assert_raises, assert_not_in
+from nose.tools import (assert_equals, assert_raises, assert_not_in,
+                        assert_true, assert_false)
 
 
 class TestUtils(ClearOnTearDownMixin):
@@ -57,3 +63,29 @@ class TestUtils(ClearOnTearDownMixin):
         comments = issue_comments(self.issue)
         assert_equals([self.comment1['id'], self.comment2['id'], self.comment3['id']],
                       [comment.id for comment in comments])
+
+
+class TestReporterHelpers(ClearOnTearDownMixin):
+    def test_users_who_reported_issue(self):
+        users = [factories.User(fullname='User {0}'.format(i))
+                 for i in range(0, 3)]
+        reporters = issues_users_who_reported_issue(
+            [user['id'] for user in users] + ['deleted-user-id'])
+
+        assert_equals([user['name'] for user in users] + ['deleted-user-id'],
+                      [reporter['name'] for reporter in reporters])
+        assert_equals('User 0', reporters[0]['fullname'])
+
+    def test_users_who_reported_issue_in_one_query(self):
+        users = [factories.User() for i in range(0, 3)]
+        with mock.patch('ckanext.issues.model.get_user_summaries',
+                        wraps=get_user_summaries) as get_summaries:
+            issues_users_who_reported_issue([user['id'] for user in users])
+        assert_equals(1, get_summaries.call_count)
+
+    def test_user_has_reported_issue(self):
+        user = factories.User()
+        assert_true(issues_user_has_reported_issue(user['name'],
+                                                   [user['id']]))
+        assert_false(issues_user_has_reported_issue(user['name'], []))
+        assert_false(issues_user_has_reported_issue('', [user['id']]))
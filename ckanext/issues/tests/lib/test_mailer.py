@@ -0,0 +1,57 @@
+from ckan.lib.mailer import MailerException
+from ckanext.issues.lib.mailer import NotificationSender
+from ckanext.issues.tests.helpers import ClearOnTearDownMixin, SMTPStandIn
+try:
+    from ckan.tests import factories
+except ImportError:
+    from ckan.new_tests import factories
+
+from ckan import model
+
+from nose.tools import assert_equals, assert_raises
+
+
+class TestNotificationSender(ClearOnTearDownMixin):
+    def setup(self):
+        self.server = SMTPStandIn()
+        self.server.start()
+        self.users = [model.User.get(factories.User()['id'])
+                      for i in range(0, 3)]
+
+    def teardown(self):
+        self.server.stop()
+        super(TestNotificationSender, self).teardown()
+
+    def test_sends_batch_over_one_connection(self):
+        with NotificationSender(smtp_server=self.server.address) as sender:
+            for user in self.users:
+                sender.send_to_user(user, u'New issue', u'Body')
+
+        assert_equals(1, self.server.connections)
+        assert_equals([[user.email] for user in self.users],
+                      [rcpttos for rcpttos, msg in self.server.messages])
+        assert_equals('New issue', self.server.messages[0][1]['Subject'])
+
+    def test_reconnects_when_connection_dropped(self):
+        with NotificationSender(smtp_server=self.server.address) as sender:
+            sender.send_to_user(self.users[0], u'New issue', u'Body')
+            self.server.drop_connections()
+            sender.send_to_user(self.users[1], u'New issue', u'Body')
+
+        assert_equals(2, self.server.connections)
+        assert_equals(2, len(self.server.messages))
+
+    def test_server_unavailable(self):
+        unavailable = SMTPStandIn()
+        address = unavailable.address
+        unavailable.close()
+        with NotificationSender(smtp_server=address) as sender:
+            assert_raises(MailerException, sender.send_to_user,
+                          self.users[0], u'New issue', u'Body')
+
+    def test_user_without_email(self):
+        self.users[0].email = None
+        with NotificationSender(smtp_server=self.server.address) as sender:
+            assert_raises(MailerException, sender.send_to_user,
+                          self.users[0], u'New issue', u'Body')
+        assert_equals(0, self.server.connections)
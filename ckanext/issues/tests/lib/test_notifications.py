@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta
+
+from ckan import model
+from ckanext.issues.lib import notifications
+from ckanext.issues.lib.mailer import NotificationSender
+from ckanext.issues.model import IssueNotification
+from ckanext.issues.tests.helpers import ClearOnTearDownMixin, SMTPStandIn
+try:
+    from ckan.tests import factories
+except ImportError:
+    from ckan.new_tests import factories
+
+from nose.tools import assert_equals, assert_true, assert_false
+
+
+class TestSendQueued(ClearOnTearDownMixin):
+    def setup(self):
+        self.user = factories.User()
+        notifications.queue(model.Session, u'New issue',
+                            [(self.user['id'], u'Body')])
+        model.Session.commit()
+        self.server = SMTPStandIn()
+        self.server.start()
+
+    def teardown(self):
+        self.server.stop()
+        super(TestSendQueued, self).teardown()
+
+    def _send_queued(self, smtp_server=None):
+        smtp_server = smtp_server or self.server.address
+        return notifications.send_queued(
+            model.Session,
+            sender_factory=lambda: NotificationSender(smtp_server))
+
+    def test_sends_and_removes(self):
+        sent, failed = self._send_queued()
+
+        assert_equals((1, 0), (sent, failed))
+        rcpttos, msg = self.server.messages[0]
+        assert_equals([self.user['email']], rcpttos)
+        assert_equals('New issue', msg['Subject'])
+        assert_equals(0, model.Session.query(IssueNotification).count())
+
+    def test_sends_batch_over_one_connection(self):
+        other_user = factories.User()
+        notifications.queue(model.Session, u'New comment',
+                            [(self.user['id'], u'Body'),
+                             (other_user['id'], u'Body')])
+        model.Session.commit()
+
+        sent, failed = self._send_queued()
+
+        assert_equals((3, 0), (sent, failed))
+        assert_equals(1, self.server.connections)
+
+    def test_failure_is_retried_later(self):
+        unavailable = SMTPStandIn()
+        address = unavailable.address
+        unavailable.close()
+        sent, failed = self._send_queued(smtp_server=address)
+
+        assert_equals((0, 1), (sent, failed))
+        notification = model.Session.query(IssueNotification).one()
+        assert_equals(1, notification.attempts)
+        assert_true(notification.last_error)
+        assert_true(notification.next_attempt > datetime.now())
+        assert_false(notification.failed)
+
+        # not due yet
+        self._send_queued()
+        assert_equals(0, len(self.server.messages))
+
+    def test_backs_off_then_gives_up(self):
+        notification = model.Session.query(IssueNotification).one()
+        notification.record_failure('down', max_attempts=3, retry_delay=10)
+        first_retry = notification.next_attempt
+        notification.record_failure('down', max_attempts=3, retry_delay=10)
+        assert_true(notification.next_attempt - first_retry >
+                    timedelta(seconds=15))
+        assert_false(notification.failed)
+        notification.record_failure('down', max_attempts=3, retry_delay=10)
+        assert_true(notification.failed)
+
+    def test_drops_notification_for_deleted_user(self):
+        model.User.get(self.user['id']).delete()
+        model.Session.commit()
+
+        self._send_queued()
+
+        assert_equals(0, len(self.server.messages))
+        assert_equals(0, model.Session.query(IssueNotification).count())
@@ -1,6 +1,11 @@
+import csv
+from datetime import datetime
+import json
 import mock
+from multiprocessing.pool import ThreadPool
 
 from nose.tools import assert_equals, assert_raises, assert_not_in, assert_in
+from nose.plugins.skip import SkipTest
 
 try:
     from ckan.tests import factories, helpers
@@ -11,11 +16,19 @@ except ImportError:
 from ckan.plugins import toolkit
 
 from ckanext.issues.tests import factories as issue_factories
-from ckanext.issues.model import Issue, IssueComment
+from ckanext.issues.model import (Issue, IssueComment, IssueNotification,
+                                  IssueFilter, AbuseStatus,
+                                  backfill_comment_stats,
+                                  backfill_dataset_stats, get_dataset_stats,
+                                  membership, rendering, search_cache)
 from ckanext.issues.tests.helpers import ClearOnTearDownMixin
+from ckanext.issues.lib import dataset_index
 from ckanext.issues.logic.action.action import _get_recipients
 
 from ckan import model
+from ckan.lib.dictization import model_dictize
+from pylons import config
+from sqlalchemy import event
 
 
 class TestIssueShow(ClearOnTearDownMixin):
@@ -43,6 +56,173 @@ class TestIssueShow(ClearOnTearDownMixin):
         assert_not_in('reset_key', user.keys())
         assert_not_in('password', user.keys())
 
+    def test_issue_show_dictizes_each_user_once(self):
+        commenter = factories.User()
+        for i in range(0, 3):
+            issue_factories.IssueComment(
+                user=commenter,
+                issue_number=self.issue['number'],
+                dataset_id=self.issue['dataset_id'],
+            )
+
+        with mock.patch('ckanext.issues.model.model_dictize.user_dictize',
+                        wraps=model_dictize.user_dictize) as user_dictize:
+            issue = helpers.call_action(
+                'issue_show',
+                dataset_id=self.issue['dataset_id'],
+                issue_number=self.issue['number'],
+            )
+        # the issue's creator and the commenter
+        assert_equals(2, user_dictize.call_count)
+        assert_equals([commenter['name']] * 3,
+                      [c['user']['name'] for c in issue['comments']])
+
+    def test_issue_show_assignee(self):
+        assignee = factories.User()
+        helpers.call_action(
+            'issue_update',
+            dataset_id=self.issue['dataset_id'],
+            issue_number=self.issue['number'],
+            assignee_id=assignee['id'],
+        )
+        issue = helpers.call_action(
+            'issue_show',
+            dataset_id=self.issue['dataset_id'],
+            issue_number=self.issue['number'],
+        )
+        assert_equals(assignee['name'], issue['assignee']['name'])
+
+    def test_issue_show_is_owner(self):
+        admin = factories.User()
+        editor = factories.User()
+        sysadmin = factories.Sysadmin()
+        other = factories.User()
+        org = factories.Organization(
+            user=admin,
+            users=[{'name': editor['id'], 'capacity': 'editor'}])
+        dataset = factories.Dataset(owner_org=org['id'])
+        issue = issue_factories.Issue(user=other, user_id=other['id'],
+                                      dataset_id=dataset['id'])
+        for commenter in (admin, editor, sysadmin, other):
+            issue_factories.IssueComment(
+                user_id=commenter['id'],
+                issue_number=issue['number'],
+                dataset_id=dataset['id'],
+            )
+
+        issue = helpers.call_action(
+            'issue_show',
+            dataset_id=dataset['id'],
+            issue_number=issue['number'],
+        )
+        assert_equals(False, issue['is_owner'])
+        owners = dict((comment['user']['name'], comment['is_owner'])
+                      for comment in issue['comments'])
+        assert_equals({admin['name']: True, editor['name']: True,
+                       sysadmin['name']: True, other['name']: False},
+                      owners)
+
+    def test_issue_show_queries_do_not_grow_with_comments(self):
+        reporter = factories.User()
+
+        def count_queries():
+            statements = []
+
+            def before_execute(conn, cursor, statement, *args):
+                statements.append(statement)
+            event.listen(model.meta.engine, 'before_cursor_execute',
+                         before_execute)
+            try:
+                issue = helpers.call_action(
+                    'issue_show',
+                    context={'user': reporter['name']},
+                    dataset_id=self.issue['dataset_id'],
+                    issue_number=self.issue['number'],
+                    include_reports=True,
+                )
+            finally:
+                event.remove(model.meta.engine, 'before_cursor_execute',
+                             before_execute)
+            return len(issue['comments']), len(statements)
+
+        def add_reported_comment():
+            comment = issue_factories.IssueComment(
+                issue_number=self.issue['number'],
+                dataset_id=self.issue['dataset_id'],
+            )
+            helpers.call_action('issue_comment_report',
+                                context={'user': reporter['name']},
+                                dataset_id=self.issue['dataset_id'],
+                                issue_number=self.issue['number'],
+                                comment_id=comment['id'])
+
+        add_reported_comment()
+        comments, queries = count_queries()
+        assert_equals(1, comments)
+        for i in range(0, 4):
+            add_reported_comment()
+        assert_equals((5, queries), count_queries())
+
+    def test_issue_show_comment_limit(self):
+        comments = [issue_factories.IssueComment(
+            comment='Comment {0}'.format(i),
+            issue_number=self.issue['number'],
+            dataset_id=self.issue['dataset_id'],
+        ) for i in range(0, 3)]
+
+        issue = helpers.call_action(
+            'issue_show',
+            dataset_id=self.issue['dataset_id'],
+            issue_number=self.issue['number'],
+            comment_limit=2,
+        )
+        assert_equals([c['id'] for c in comments[:2]],
+                      [c['id'] for c in issue['comments']])
+        assert_equals(3, issue['comment_count'])
+
+        issue = helpers.call_action(
+            'issue_show',
+            dataset_id=self.issue['dataset_id'],
+            issue_number=self.issue['number'],
+            comment_limit=2,
+            comment_cursor=issue['next_comment_cursor'],
+        )
+        assert_equals([comments[2]['id']],
+                      [c['id'] for c in issue['comments']])
+        assert_equals(None, issue['next_comment_cursor'])
+
+
+class TestIssueCommentList(ClearOnTearDownMixin):
+    def setup(self):
+        self.issue = issue_factories.Issue()
+        self.comments = [issue_factories.IssueComment(
+            comment='Comment {0}'.format(i),
+            issue_number=self.issue['number'],
+            dataset_id=self.issue['dataset_id'],
+        ) for i in range(0, 5)]
+
+    def test_pages_through_comments_in_order(self):
+        comment_ids = []
+        cursor = None
+        for i in range(0, 3):
+            data_dict = {'dataset_id': self.issue['dataset_id'],
+                         'issue_number': self.issue['number'],
+                         'limit': 2}
+            if cursor:
+                data_dict['cursor'] = cursor
+            result = helpers.call_action('issue_comment_list', **data_dict)
+            comment_ids.extend(c['id'] for c in result['comments'])
+            cursor = result['next_cursor']
+        assert_equals([c['id'] for c in self.comments], comment_ids)
+        assert_equals(None, cursor)
+
+    def test_invalid_cursor(self):
+        assert_raises(toolkit.ValidationError, helpers.call_action,
+                      'issue_comment_list',
+                      dataset_id=self.issue['dataset_id'],
+                      issue_number=self.issue['number'],
+                      cursor='not-a-cursor')
+
 
 class TestIssueNewWithEmailing(FunctionalTestBase, ClearOnTearDownMixin):
     def setup(self):
@@ -198,6 +378,142 @@ class TestIssueNewWithEmailing(FunctionalTestBase, ClearOnTearDownMixin):
         assert_equals(recip[0]['capacity'], 'Admin')
         assert_equals(recip[0]['organization_name'], org['name'])
         assert_equals(recip[0]['organization_title'], org['title'])
+        assert_equals(recip[0]['email'], user['email'])
+
+    def test_get_recipients_only_editors(self):
+        admin = factories.User()
+        editor = factories.User()
+        member = factories.User()
+        org = factories.Organization(
+            user=admin,
+            users=[{'name': editor['id'], 'capacity': 'editor'},
+                   {'name': member['id'], 'capacity': 'member'}])
+        dataset_obj = model.Package.get(
+            factories.Dataset(owner_org=org['id'])['id'])
+
+        recip = _get_recipients(context={}, dataset=dataset_obj)
+
+        assert_equals(set([admin['id'], editor['id']]),
+                      set([r['user_id'] for r in recip]))
+
+    def test_get_recipients_is_cached_until_membership_changes(self):
+        admin = factories.User()
+        org = factories.Organization(user=admin)
+        dataset_obj = model.Package.get(
+            factories.Dataset(owner_org=org['id'])['id'])
+
+        with mock.patch(
+                'ckanext.issues.model.membership._query_organization_editors',
+                wraps=membership._query_organization_editors) as query:
+            _get_recipients(context={}, dataset=dataset_obj)
+            _get_recipients(context={}, dataset=dataset_obj)
+            assert_equals(1, query.call_count)
+
+            editor = factories.User()
+            helpers.call_action('member_create', id=org['id'],
+                                object=editor['id'], object_type='user',
+                                capacity='editor')
+            recip = _get_recipients(context={}, dataset=dataset_obj)
+            assert_equals(2, query.call_count)
+        assert_in(editor['id'], [r['user_id'] for r in recip])
+
+    def test_issue_create_queues_notifications(self):
+        admin = factories.User()
+        org = factories.Organization(
+            users=[{'name': admin['id'], 'capacity': 'admin'}])
+        dataset = factories.Dataset(owner_org=org['id'])
+        self.mock_mailer.reset_mock()
+
+        toolkit.get_action('issue_create')(
+            context={'user': self.user['name']},
+            data_dict={
+                'title': 'Title',
+                'description': 'Description',
+                'dataset_id': dataset['id'],
+            }
+        )
+
+        queued = model.Session.query(IssueNotification).all()
+        assert_in(admin['id'], [n.recipient_id for n in queued])
+        assert_equals(0, self.mock_mailer.call_count)
+
+
+class TestIssueNewWithInlineEmailing(FunctionalTestBase,
+                                     ClearOnTearDownMixin):
+    @classmethod
+    def _apply_config_changes(cls, cfg):
+        cfg['ckanext.issues.send_email_notifications'] = True
+        cfg['ckanext.issues.send_notifications_inline'] = True
+
+    def test_issue_create_sends_notifications(self):
+        creator = factories.User()
+        admin = factories.User()
+        org = factories.Organization(
+            users=[{'name': admin['id'], 'capacity': 'admin'}])
+        dataset = factories.Dataset(owner_org=org['id'])
+
+        with mock.patch('ckanext.issues.lib.mailer.NotificationSender'
+                        '.send_to_user') as send_to_user:
+            toolkit.get_action('issue_create')(
+                context={'user': creator['name']},
+                data_dict={
+                    'title': 'Title',
+                    'description': 'Description',
+                    'dataset_id': dataset['id'],
+                }
+            )
+
+        users_emailed = [call[0][0].id
+                         for call in send_to_user.call_args_list]
+        assert_in(admin['id'], users_emailed)
+        assert_equals(0, model.Session.query(IssueNotification).count())
+
+
+class TestIssueCreateConcurrently(ClearOnTearDownMixin):
+    def test_concurrent_creates_get_distinct_numbers(self):
+        # SQLite serialises its writers with a database lock, rather than
+        # the row lock taken when allocating the number
+        if model.Session.get_bind().dialect.name != 'postgresql':
+            raise SkipTest('needs PostgreSQL')
+        user = factories.User()
+        dataset = factories.Dataset()
+
+        def create_issue(i):
+            try:
+                return toolkit.get_action('issue_create')(
+                    context={'user': user['name']},
+                    data_dict={
+                        'title': 'Title {0}'.format(i),
+                        'dataset_id': dataset['id'],
+                    }
+                )['number']
+            finally:
+                # each thread has its own session
+                model.Session.remove()
+
+        pool = ThreadPool(5)
+        try:
+            numbers = pool.map(create_issue, range(0, 20))
+        finally:
+            pool.close()
+            pool.join()
+
+        assert_equals(range(1, 21), sorted(numbers))
+
+    def test_numbers_carry_on_after_deletion(self):
+        user = factories.User()
+        dataset = factories.Dataset()
+        issues = [issue_factories.Issue(user=user, user_id=user['id'],
+                                        dataset_id=dataset['id'])
+                  for i in range(0, 2)]
+        helpers.call_action('issue_delete',
+                            context={'user': user['name']},
+                            dataset_id=dataset['id'],
+                            issue_number=issues[1]['number'])
+
+        issue = issue_factories.Issue(user=user, user_id=user['id'],
+                                      dataset_id=dataset['id'])
+        assert_equals(3, issue['number'])
 
 
 class TestIssueComment(FunctionalTestBase, ClearOnTearDownMixin):
@@ -284,6 +600,26 @@ class TestIssueComment(FunctionalTestBase, ClearOnTearDownMixin):
         assert_equals(len(comments), 1)
         assert_equals(comments[0]['comment'], 'some comment')
 
+    def test_create_comment_updates_comment_stats(self):
+        user = factories.User()
+        dataset = factories.Dataset()
+        issue = issue_factories.Issue(user=user, user_id=user['id'],
+                                      dataset_id=dataset['id'])
+        assert_equals(0, issue['comment_count'])
+
+        comment = helpers.call_action(
+            'issue_comment_create',
+            context={'user': user['name']},
+            issue_number=issue['number'],
+            dataset_id=dataset['id'],
+            comment='some comment'
+        )
+
+        issue_object = Issue.get(issue['id'])
+        assert_equals(1, issue_object.comment_count)
+        assert_equals(comment['created'],
+                      issue_object.last_activity.isoformat())
+
     def test_cannot_create_empty_comment(self):
         user = factories.User()
         dataset = factories.Dataset()
@@ -369,6 +705,76 @@ class TestIssueSearch(ClearOnTearDownMixin):
                       [i['id'] for i in issues_list])
         assert_equals(search_res['count'], 5)
 
+    def test_total_count(self):
+        user = factories.User()
+        dataset = factories.Dataset()
+
+        created_issues = [issue_factories.Issue(user=user, user_id=user['id'],
+                                                dataset_id=dataset['id'],
+                                                description=i)
+                          for i in range(0, 10)]
+        search_res = helpers.call_action(
+            'issue_search',
+            context={'user': user['name']},
+            dataset_id=dataset['id'],
+            sort='oldest',
+            limit=5,
+            offset=5,
+            total_count=True,
+        )
+        assert_equals([i['id'] for i in created_issues][5:],
+                      [i['id'] for i in search_res['results']])
+        assert_equals(search_res['count'], 10)
+        assert_equals(search_res['count_capped'], False)
+
+    def test_total_count_past_the_last_page(self):
+        user = factories.User()
+        dataset = factories.Dataset()
+
+        [issue_factories.Issue(user=user, user_id=user['id'],
+                               dataset_id=dataset['id'])
+         for i in range(0, 3)]
+        search_res = helpers.call_action(
+            'issue_search',
+            context={'user': user['name']},
+            dataset_id=dataset['id'],
+            limit=5,
+            offset=5,
+            total_count=True,
+        )
+        assert_equals([], search_res['results'])
+        assert_equals(search_res['count'], 3)
+
+    def test_count_limit(self):
+        user = factories.User()
+        dataset = factories.Dataset()
+
+        [issue_factories.Issue(user=user, user_id=user['id'],
+                               dataset_id=dataset['id'])
+         for i in range(0, 6)]
+        search_res = helpers.call_action(
+            'issue_search',
+            context={'user': user['name']},
+            dataset_id=dataset['id'],
+            limit=2,
+            total_count=True,
+            count_limit=4,
+        )
+        assert_equals(len(search_res['results']), 2)
+        assert_equals(search_res['count'], 4)
+        assert_equals(search_res['count_capped'], True)
+
+        search_res = helpers.call_action(
+            'issue_search',
+            context={'user': user['name']},
+            dataset_id=dataset['id'],
+            limit=2,
+            total_count=True,
+            count_limit=6,
+        )
+        assert_equals(search_res['count'], 6)
+        assert_equals(search_res['count_capped'], False)
+
     def test_offset(self):
         user = factories.User()
         dataset = factories.Dataset()
@@ -402,6 +808,89 @@ class TestIssueSearch(ClearOnTearDownMixin):
         assert_equals([i['id'] for i in created_issues][5:8],
                       [i['id'] for i in issues_list])
 
+    def test_cursor_pagination(self):
+        user = factories.User()
+        dataset = factories.Dataset()
+
+        created_issues = [issue_factories.Issue(user=user, user_id=user['id'],
+                                                dataset_id=dataset['id'],
+                                                description=i)
+                          for i in range(0, 10)]
+        for sort in ('oldest', 'newest', 'most_commented', 'least_commented',
+                     'recently_updated', 'least_recently_updated'):
+            all_ids = [i['id'] for i in helpers.call_action(
+                'issue_search',
+                context={'user': user['name']},
+                dataset_id=dataset['id'],
+                sort=sort)['results']]
+
+            paged_ids = []
+            cursor = None
+            while True:
+                params = {'dataset_id': dataset['id'], 'sort': sort,
+                          'limit': 3}
+                if cursor:
+                    params['cursor'] = cursor
+                search_res = helpers.call_action(
+                    'issue_search', context={'user': user['name']}, **params)
+                paged_ids.extend(i['id'] for i in search_res['results'])
+                cursor = search_res['next_cursor']
+                if not cursor:
+                    break
+            assert_equals(all_ids, paged_ids)
+            assert_equals(len(created_issues), len(paged_ids))
+
+    def test_cursor_not_affected_by_new_issues(self):
+        user = factories.User()
+        dataset = factories.Dataset()
+
+        created_issues = [issue_factories.Issue(user=user, user_id=user['id'],
+                                                dataset_id=dataset['id'],
+                                                description=i)
+                          for i in range(0, 4)]
+        first_page = helpers.call_action('issue_search',
+                                         context={'user': user['name']},
+                                         dataset_id=dataset['id'],
+                                         sort='newest',
+                                         limit=2)
+        issue_factories.Issue(user=user, user_id=user['id'],
+                              dataset_id=dataset['id'])
+        second_page = helpers.call_action('issue_search',
+                                          context={'user': user['name']},
+                                          dataset_id=dataset['id'],
+                                          cursor=first_page['next_cursor'],
+                                          limit=2)
+        assert_equals([i['id'] for i in reversed(created_issues[:2])],
+                      [i['id'] for i in second_page['results']])
+        assert_equals(None, second_page['next_cursor'])
+
+    def test_invalid_cursor(self):
+        user = factories.User()
+        assert_raises(toolkit.ValidationError,
+                      helpers.call_action,
+                      'issue_search',
+                      context={'user': user['name']},
+                      cursor='not-a-cursor')
+
+    def test_cursor_for_a_different_sort(self):
+        user = factories.User()
+        dataset = factories.Dataset()
+        [issue_factories.Issue(user=user, user_id=user['id'],
+                               dataset_id=dataset['id'])
+         for i in range(0, 3)]
+        first_page = helpers.call_action('issue_search',
+                                         context={'user': user['name']},
+                                         dataset_id=dataset['id'],
+                                         sort='newest',
+                                         limit=2)
+        assert_raises(toolkit.ValidationError,
+                      helpers.call_action,
+                      'issue_search',
+                      context={'user': user['name']},
+                      dataset_id=dataset['id'],
+                      sort='oldest',
+                      cursor=first_page['next_cursor'])
+
     def test_filter_newest(self):
         user = factories.User()
         dataset = factories.Dataset()
@@ -496,6 +985,615 @@ class TestIssueSearch(ClearOnTearDownMixin):
         assert_equals(expected_issue_ids,
                       set([i['id'] for i in filtered_issues]))
 
+    def test_filter_by_comment_string_search(self):
+        user = factories.User()
+        dataset = factories.Dataset()
+
+        issues = [issue_factories.Issue(user_id=user['id'],
+                                        dataset_id=dataset['id'],
+                                        title=title)
+                  for title in ['some title', 'another title']]
+        issue_factories.IssueComment(
+            user_id=user['id'],
+            issue_number=issues[1]['number'],
+            dataset_id=dataset['id'],
+            comment='the spreadsheet has a typo',
+        )
+
+        filtered_issues = helpers.call_action('issue_search',
+                                              context={'user': user['name']},
+                                              dataset_id=dataset['id'],
+                                              q='spreadsheet')['results']
+
+        assert_equals([issues[1]['id']], [i['id'] for i in filtered_issues])
+
+    def test_hidden_comments_are_not_searched(self):
+        dataset = factories.Dataset()
+        issue = issue_factories.Issue(dataset_id=dataset['id'])
+        comment = issue_factories.IssueComment(
+            issue_number=issue['number'],
+            dataset_id=dataset['id'],
+            comment='the spreadsheet has a typo',
+        )
+
+        def search():
+            return [i['id'] for i in helpers.call_action(
+                'issue_search', dataset_id=dataset['id'],
+                q='spreadsheet')['results']]
+        comment_object = IssueComment.get(comment['id'])
+        comment_object.change_visibility(model.Session, u'hidden')
+        model.Session.commit()
+        assert_equals([], search())
+
+        comment_object = IssueComment.get(comment['id'])
+        comment_object.change_visibility(model.Session, u'visible')
+        model.Session.commit()
+        assert_equals([issue['id']], search())
+
+    def test_stop_words_only_search_falls_back_to_substring(self):
+        dataset = factories.Dataset()
+        issues = [issue_factories.Issue(dataset_id=dataset['id'],
+                                        title=title)
+                  for title in ['the data', 'missing rows']]
+
+        filtered_issues = helpers.call_action('issue_search',
+                                              dataset_id=dataset['id'],
+                                              q='the')['results']
+
+        assert_equals([issues[0]['id']], [i['id'] for i in filtered_issues])
+
+    def test_filter_by_title_string_search_without_index(self):
+        user = factories.User()
+        dataset = factories.Dataset()
+
+        issues = [issue_factories.Issue(user_id=user['id'],
+                                        dataset_id=dataset['id'],
+                                        title=title)
+                  for title in ['some title', 'another Title', 'issue']]
+
+        with mock.patch('ckanext.issues.model.search.get_backend',
+                        return_value=None):
+            filtered_issues = helpers.call_action(
+                'issue_search',
+                context={'user': user['name']},
+                dataset_id=dataset['id'],
+                q='title')['results']
+
+        expected_issue_ids = set([i['id'] for i in issues[:2]])
+        assert_equals(expected_issue_ids,
+                      set([i['id'] for i in filtered_issues]))
+
+    def test_include_datasets_dictizes_each_dataset_once(self):
+        organization = factories.Organization()
+        datasets = [factories.Dataset(owner_org=organization['id'])
+                    for i in range(0, 2)]
+        for i in range(0, 3):
+            for dataset in datasets:
+                issue_factories.Issue(dataset_id=dataset['id'])
+
+        with mock.patch('ckanext.issues.model.model_dictize.package_dictize',
+                        wraps=model_dictize.package_dictize) as dictize:
+            issues = helpers.call_action('issue_search',
+                                         organization_id=organization['id'],
+                                         include_datasets=True)['results']
+        assert_equals(2, dictize.call_count)
+        assert_equals(6, len(issues))
+        for issue in issues:
+            assert_equals(issue['dataset_id'], issue['dataset']['id'])
+            assert_in('resources', issue['dataset'])
+
+    def test_include_datasets_summary(self):
+        organization = factories.Organization()
+        dataset = factories.Dataset(owner_org=organization['id'],
+                                    title='Spending')
+        issue_factories.Issue(dataset_id=dataset['id'])
+
+        with mock.patch('ckanext.issues.model.model_dictize.package_dictize',
+                        wraps=model_dictize.package_dictize) as dictize:
+            issues = helpers.call_action('issue_search',
+                                         organization_id=organization['id'],
+                                         include_datasets=True,
+                                         dataset_summary=True)['results']
+        assert_equals(0, dictize.call_count)
+        assert_equals({'id': dataset['id'],
+                       'name': dataset['name'],
+                       'title': 'Spending',
+                       'owner_org': organization['id']},
+                      issues[0]['dataset'])
+
+
+class TestIssueSearchSubOrganizations(ClearOnTearDownMixin):
+    def setup(self):
+        self.user = factories.User()
+        self.organizations = [factories.Organization(user=self.user)]
+        # a chain of organizations, each the parent of the next
+        for i in range(0, 3):
+            self.organizations.append(factories.Organization(
+                user=self.user,
+                groups=[{'name': self.organizations[-1]['name'],
+                         'capacity': 'parent'}]))
+        self.issues = [
+            issue_factories.Issue(
+                user=self.user, user_id=self.user['id'],
+                dataset_id=factories.Dataset(owner_org=org['id'])['id'])
+            for org in self.organizations]
+
+    def _search(self, organization):
+        result = helpers.call_action('issue_search',
+                                     context={'user': self.user['name']},
+                                     organization_id=organization['id'],
+                                     include_sub_organizations=True)
+        return set(issue['id'] for issue in result['results'])
+
+    def test_includes_the_organization_and_every_level_below(self):
+        assert_equals(set(issue['id'] for issue in self.issues),
+                      self._search(self.organizations[0]))
+        assert_equals(set(issue['id'] for issue in self.issues[2:]),
+                      self._search(self.organizations[2]))
+
+    def test_expansion_cached_until_hierarchy_changes(self):
+        with mock.patch(
+                'ckanext.issues.model.membership._query_organization_tree',
+                wraps=membership._query_organization_tree) as query:
+            self._search(self.organizations[0])
+            search_cache.clear()
+            self._search(self.organizations[0])
+            assert_equals(1, query.call_count)
+
+            helpers.call_action('organization_patch',
+                                id=self.organizations[3]['id'],
+                                groups=[])
+            search_cache.clear()
+            assert_equals(set(issue['id'] for issue in self.issues[:3]),
+                          self._search(self.organizations[0]))
+            assert_equals(2, query.call_count)
+
+
+class TestIssueOwnerOrg(ClearOnTearDownMixin):
+    def setup(self):
+        self.user = factories.User()
+        self.organization = factories.Organization(user=self.user)
+        self.dataset = factories.Dataset(owner_org=self.organization['id'])
+        self.issue = issue_factories.Issue(user=self.user,
+                                           user_id=self.user['id'],
+                                           dataset_id=self.dataset['id'])
+
+    def _search(self, organization_id):
+        result = helpers.call_action('issue_search',
+                                     context={'user': self.user['name']},
+                                     organization_id=organization_id)
+        return [issue['id'] for issue in result['results']]
+
+    def test_set_from_dataset(self):
+        issue = Issue.get(self.issue['id'])
+        assert_equals(self.organization['id'], issue.owner_org)
+
+    def test_follows_dataset_to_new_organization(self):
+        other = factories.Organization(user=self.user)
+        helpers.call_action('package_patch', id=self.dataset['id'],
+                            owner_org=other['id'])
+
+        assert_equals([], self._search(self.organization['id']))
+        assert_equals([self.issue['id']], self._search(other['id']))
+
+    def test_follows_dataset_moved_by_owner_org_update(self):
+        other = factories.Organization(user=self.user)
+        helpers.call_action('package_owner_org_update',
+                            context={'user': self.user['name']},
+                            id=self.dataset['id'],
+                            organization_id=other['id'])
+
+        assert_equals(other['id'], Issue.get(self.issue['id']).owner_org)
+        assert_equals([], self._search(self.organization['id']))
+        assert_equals([self.issue['id']], self._search(other['id']))
+
+
+class TestIssueSearchCache(ClearOnTearDownMixin):
+    def setup(self):
+        config['ckanext.issues.search_cache'] = 'memory'
+        search_cache.clear()
+        self.organization = factories.Organization()
+        self.dataset = factories.Dataset(owner_org=self.organization['id'])
+        self.issue = issue_factories.Issue(dataset_id=self.dataset['id'])
+
+    def _search(self, **kwargs):
+        return helpers.call_action('issue_search', **kwargs)
+
+    def test_repeated_search_is_cached(self):
+        first = self._search(dataset_id=self.dataset['id'])
+        second = self._search(dataset_id=self.dataset['id'])
+        assert_equals(first, second)
+        assert_equals({'hits': 1, 'misses': 1},
+                      helpers.call_action('issue_search_cache_stats'))
+
+    def test_new_issue_invalidates_dataset_organization_and_site(self):
+        searches = [{'dataset_id': self.dataset['id']},
+                    {'organization_id': self.organization['id']},
+                    {}]
+        for search in searches:
+            assert_equals(1, self._search(**search)['count'])
+        issue_factories.Issue(dataset_id=self.dataset['id'])
+        for search in searches:
+            assert_equals(2, self._search(**search)['count'])
+
+    def test_comment_invalidates(self):
+        self._search(dataset_id=self.dataset['id'])
+        issue_factories.IssueComment(issue_number=self.issue['number'],
+                                     dataset_id=self.dataset['id'])
+        result = self._search(dataset_id=self.dataset['id'])
+        assert_equals(1, result['results'][0]['comment_count'])
+
+    def test_other_datasets_are_unaffected(self):
+        self._search(dataset_id=self.dataset['id'])
+        issue_factories.Issue()
+        self._search(dataset_id=self.dataset['id'])
+        assert_equals(1, search_cache.stats()['hits'])
+
+    def test_results_can_be_changed_by_the_caller(self):
+        self._search(dataset_id=self.dataset['id'])['results'].pop()
+        assert_equals(
+            1, len(self._search(dataset_id=self.dataset['id'])['results']))
+
+    def test_stats_are_for_sysadmins(self):
+        user = factories.User()
+        assert_raises(toolkit.NotAuthorized, helpers.call_auth,
+                      'issue_search_cache_stats',
+                      context={'user': user['name'], 'model': model})
+
+    def teardown(self):
+        config.pop('ckanext.issues.search_cache', None)
+        super(TestIssueSearchCache, self).teardown()
+
+    def test_not_cached_by_default(self):
+        config.pop('ckanext.issues.search_cache', None)
+        search_cache.clear()
+        self._search(dataset_id=self.dataset['id'])
+        self._search(dataset_id=self.dataset['id'])
+        assert_equals({'hits': 0, 'misses': 0}, search_cache.stats())
+
+    def test_lru_cache_evicts_least_recently_used(self):
+        cache = search_cache.LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert_equals([1, None, 3], [cache.get(k) for k in 'abc'])
+
+
+class TestIssueExport(ClearOnTearDownMixin):
+    def setup(self):
+        self.owner = factories.User()
+        self.organization = factories.Organization(user=self.owner)
+        self.dataset = factories.Dataset(owner_org=self.organization['id'])
+        self.issues = [issue_factories.Issue(dataset_id=self.dataset['id'])
+                       for i in range(0, 3)]
+        self.comments = [
+            issue_factories.IssueComment(
+                dataset_id=self.dataset['id'],
+                issue_number=self.issues[1]['number'],
+                comment=u'comment {0} \u2603'.format(i))
+            for i in range(0, 2)]
+        # not in the organization
+        issue_factories.Issue()
+
+    def _export(self, **kwargs):
+        return ''.join(helpers.call_action(
+            'issue_export', organization_id=self.organization['id'],
+            **kwargs))
+
+    def test_jsonl(self):
+        issues = [json.loads(line)
+                  for line in self._export(format='jsonl').splitlines()]
+        assert_equals([issue['id'] for issue in self.issues],
+                      [issue['id'] for issue in issues])
+        assert_equals(self.dataset['name'], issues[0]['dataset_name'])
+        assert_equals([], issues[0]['comments'])
+        assert_equals([comment['comment'] for comment in self.comments],
+                      [comment['comment'] for comment in issues[1]['comments']])
+
+    def test_csv(self):
+        rows = list(csv.DictReader(self._export(batch_size=1).splitlines()))
+        assert_equals(['issue', 'issue', 'comment', 'comment', 'issue'],
+                      [row['record'] for row in rows])
+        assert_equals(str(self.issues[1]['id']), rows[2]['issue_id'])
+        assert_equals(self.comments[1]['comment'],
+                      rows[3]['text'].decode('utf-8'))
+
+    def test_since(self):
+        since = datetime.now()
+        issue_factories.IssueComment(dataset_id=self.dataset['id'],
+                                     issue_number=self.issues[2]['number'])
+        issues = [json.loads(line) for line
+                  in self._export(format='jsonl', since=since).splitlines()]
+        assert_equals([self.issues[2]['id']],
+                      [issue['id'] for issue in issues])
+        assert_equals(1, len(issues[0]['comments']))
+
+    def test_for_organization_admins(self):
+        helpers.call_auth('issue_export',
+                          context={'user': self.owner['name'],
+                                   'model': model},
+                          organization_id=self.organization['id'])
+        user = factories.User()
+        assert_raises(toolkit.NotAuthorized, helpers.call_auth,
+                      'issue_export',
+                      context={'user': user['name'], 'model': model},
+                      organization_id=self.organization['id'])
+        assert_raises(toolkit.NotAuthorized, helpers.call_auth,
+                      'issue_export',
+                      context={'user': self.owner['name'], 'model': model})
+
+
+class TestIssueBulkCreate(ClearOnTearDownMixin):
+    def setup(self):
+        self.user = factories.User()
+        self.dataset = factories.Dataset()
+        self.existing = issue_factories.Issue(dataset_id=self.dataset['id'])
+
+    def test_bulk_create(self):
+        result = helpers.call_action(
+            'issue_bulk_create', context={'user': self.user['name']},
+            batch_size=2,
+            issues=[
+                {'title': u'first', 'description': u'**bold**',
+                 'dataset_id': self.dataset['name'],
+                 'comments': [{'comment': u'a comment',
+                               'created': '2015-06-01T10:00:00'}]},
+                {'title': u'second', 'dataset_id': self.dataset['id'],
+                 'status': 'closed'},
+                {'title': u'third', 'dataset_id': self.dataset['id'],
+                 'user_id': self.user['name']},
+            ])
+        assert_equals({'created': 3, 'errors': []}, result)
+
+        issues = helpers.call_action('issue_search',
+                                     dataset_id=self.dataset['id'],
+                                     sort='oldest')['results']
+        assert_equals([self.existing['number'], 2, 3, 4],
+                      [issue['number'] for issue in issues])
+        first = Issue.get_by_number(self.dataset['id'], 2)
+        assert_in('<strong>bold</strong>', first.description_html)
+        assert_equals(1, first.comment_count)
+        assert_equals('2015-06-01T10:00:00', first.last_activity.isoformat())
+        assert_equals(self.user['id'], first.comments[0].user_id)
+        stats = get_dataset_stats([self.dataset['id']], model.Session)
+        assert_equals(3, stats[self.dataset['id']]['open_count'])
+        assert_equals(1, stats[self.dataset['id']]['closed_count'])
+        assert_equals(4, stats[self.dataset['id']]['total_count'])
+        assert_equals(max(issue.last_activity for issue in
+                          model.Session.query(Issue).filter(
+                              Issue.dataset_id == self.dataset['id'])),
+                      stats[self.dataset['id']]['last_activity'])
+
+    def test_errors_are_reported_per_issue(self):
+        result = helpers.call_action(
+            'issue_bulk_create', context={'user': self.user['name']},
+            issues=[
+                {'dataset_id': self.dataset['id']},
+                {'title': u'ok', 'dataset_id': self.dataset['id']},
+                {'title': u'no dataset', 'dataset_id': 'not-a-dataset'},
+                'not an issue',
+                {'title': u'no user', 'dataset_id': self.dataset['id'],
+                 'user_id': 'not-a-user'},
+            ])
+        assert_equals(1, result['created'])
+        assert_equals([0, 2, 3, 4],
+                      sorted(error['index'] for error in result['errors']))
+        assert_equals(2, helpers.call_action(
+            'issue_search', dataset_id=self.dataset['id'])['count'])
+
+    def test_sysadmins_only(self):
+        assert_raises(toolkit.NotAuthorized, helpers.call_auth,
+                      'issue_bulk_create',
+                      context={'user': self.user['name'], 'model': model},
+                      issues=[])
+
+
+class TestBackfillCommentStats(ClearOnTearDownMixin):
+    def test_backfill(self):
+        user = factories.User()
+        dataset = factories.Dataset()
+        issue = issue_factories.Issue(user_id=user['id'],
+                                      dataset_id=dataset['id'])
+        comments = [issue_factories.IssueComment(
+            user_id=user['id'],
+            issue_number=issue['number'],
+            dataset_id=issue['dataset_id'],
+        ) for i in range(0, 2)]
+
+        issue_object = Issue.get(issue['id'])
+        issue_object.comment_count = 0
+        issue_object.last_activity = None
+        model.Session.commit()
+
+        backfill_comment_stats(model.Session)
+        model.Session.commit()
+
+        issue_object = Issue.get(issue['id'])
+        assert_equals(2, issue_object.comment_count)
+        assert_equals(comments[-1]['created'],
+                      issue_object.last_activity.isoformat())
+
+    def test_last_activity_is_not_changed_by_updates(self):
+        dataset = factories.Dataset()
+        issue = issue_factories.Issue(dataset_id=dataset['id'])
+        helpers.call_action('issue_update', dataset_id=dataset['id'],
+                            issue_number=issue['number'], title=u'changed')
+        last_activity = Issue.get(issue['id']).last_activity
+
+        backfill_comment_stats(model.Session)
+        model.Session.commit()
+        assert_equals(issue['created'], last_activity.isoformat())
+        assert_equals(last_activity, Issue.get(issue['id']).last_activity)
+
+
+class TestRenderedMarkdown(ClearOnTearDownMixin):
+    def setup(self):
+        self.issue = issue_factories.Issue(description='Some **bold** text')
+        issue_factories.IssueComment(
+            comment='A _comment_',
+            issue_number=self.issue['number'],
+            dataset_id=self.issue['dataset_id'],
+        )
+
+    def _issue_show(self):
+        return helpers.call_action(
+            'issue_show',
+            dataset_id=self.issue['dataset_id'],
+            issue_number=self.issue['number'],
+        )
+
+    def test_rendered_when_saved(self):
+        issue = self._issue_show()
+        assert_in('<strong>bold</strong>', issue['description_html'])
+        assert_equals('Some bold text', issue['description_extract'])
+        assert_in('<em>comment</em>', issue['comments'][0]['comment_html'])
+        assert_not_in('renderer_version', issue)
+
+    def test_rendered_again_when_changed(self):
+        helpers.call_action(
+            'issue_update',
+            dataset_id=self.issue['dataset_id'],
+            issue_number=self.issue['number'],
+            description='Now *emphasised*',
+        )
+        issue = self._issue_show()
+        assert_in('<em>emphasised</em>', issue['description_html'])
+
+    def test_old_renderings_are_ignored_until_rerendered(self):
+        model.Session.query(Issue).update({'renderer_version': 0})
+        model.Session.commit()
+        assert_equals(None, self._issue_show()['description_html'])
+
+        assert_equals(1, rendering.rerender_all(model.Session))
+        assert_in('<strong>bold</strong>',
+                  self._issue_show()['description_html'])
+
+
+class TestDatasetStats(ClearOnTearDownMixin):
+    def setup(self):
+        self.owner = factories.User()
+        organization = factories.Organization(user=self.owner)
+        self.dataset = factories.Dataset(owner_org=organization['id'])
+        self.issues = [issue_factories.Issue(dataset_id=self.dataset['id'])
+                       for i in range(0, 4)]
+
+    def _stats(self):
+        stats = get_dataset_stats([self.dataset['id']], model.Session)
+        return dict((column, stats[self.dataset['id']][column])
+                    for column in ('open_count', 'closed_count',
+                                   'hidden_count', 'total_count'))
+
+    def test_kept_up_to_date(self):
+        helpers.call_action('issue_update',
+                            context={'user': self.owner['name']},
+                            dataset_id=self.dataset['id'],
+                            issue_number=self.issues[0]['number'],
+                            status='closed')
+        helpers.call_action('issue_report',
+                            context={'user': self.owner['name']},
+                            dataset_id=self.dataset['id'],
+                            issue_number=self.issues[1]['number'])
+        helpers.call_action('issue_delete',
+                            dataset_id=self.dataset['id'],
+                            issue_number=self.issues[2]['number'])
+
+        expected = {'open_count': 1, 'closed_count': 1, 'hidden_count': 1,
+                    'total_count': 3}
+        assert_equals(expected, self._stats())
+        backfill_dataset_stats(model.Session)
+        assert_equals(expected, self._stats())
+
+    def test_last_activity_follows_comments(self):
+        comment = issue_factories.IssueComment(
+            dataset_id=self.dataset['id'],
+            issue_number=self.issues[0]['number'])
+        stats = get_dataset_stats([self.dataset['id']], model.Session)
+        assert_equals(comment['created'],
+                      stats[self.dataset['id']]['last_activity'].isoformat())
+
+    def test_datasets_without_issues(self):
+        other = factories.Dataset()
+        stats = get_dataset_stats([self.dataset['id'], other['id']],
+                                  model.Session)
+        assert_equals(4, stats[self.dataset['id']]['total_count'])
+        assert_equals(0, stats[other['id']]['total_count'])
+
+
+class TestDatasetIndex(ClearOnTearDownMixin):
+    def setup(self):
+        self.dataset = factories.Dataset()
+        self.issue = issue_factories.Issue(dataset_id=self.dataset['id'])
+
+    def _search(self, fq):
+        result = helpers.call_action('package_search', fq=fq)
+        return [dataset['id'] for dataset in result['results']]
+
+    def test_counts_indexed_when_the_queue_is_run(self):
+        assert_equals([], self._search('num_open_issues:1'))
+        assert_equals((1, 0), dataset_index.reindex_queued(model.Session))
+        assert_equals([self.dataset['id']], self._search('num_open_issues:1'))
+        assert_equals((0, 0), dataset_index.reindex_queued(model.Session))
+
+    def test_counts_indexed_when_issues_change(self):
+        dataset_index.reindex_queued(model.Session)
+        helpers.call_action('issue_update',
+                            dataset_id=self.dataset['id'],
+                            issue_number=self.issue['number'],
+                            status='closed')
+        dataset_index.reindex_queued(model.Session)
+        assert_equals([], self._search('num_open_issues:1'))
+        assert_equals([self.dataset['id']],
+                      self._search('num_closed_issues:1'))
+
+    def test_last_issue_activity(self):
+        dataset_index.reindex_queued(model.Session)
+        assert_equals([self.dataset['id']],
+                      self._search('last_issue_activity:[* TO *]'))
+        other = factories.Dataset()
+        assert_not_in(other['id'],
+                      self._search('last_issue_activity:[* TO *]'))
+
+
+class TestIssueIndexes(ClearOnTearDownMixin):
+    '''The planner uses the indexes made for issue_search's queries'''
+    def setup(self):
+        self.dataset = factories.Dataset()
+        issue_factories.Issue(dataset_id=self.dataset['id'])
+
+    def _plan(self, query):
+        connection = model.Session.connection()
+        compiled = query.statement.compile(dialect=connection.dialect)
+        if connection.dialect.name == 'postgresql':
+            # a handful of rows would otherwise be read straight off the
+            # table
+            connection.execute('SET LOCAL enable_seqscan = off')
+            rows = connection.execute('EXPLAIN ' + unicode(compiled),
+                                      compiled.params)
+        else:
+            rows = connection.execute(
+                'EXPLAIN QUERY PLAN ' + unicode(compiled),
+                [compiled.params[name] for name in compiled.positiontup])
+        plan = ' '.join(unicode(column) for row in rows for column in row)
+        model.Session.rollback()
+        return plan
+
+    def test_dataset_issues_by_status(self):
+        query = Issue.get_issues(dataset_id=self.dataset['id'],
+                                 status='open', sort=IssueFilter.newest)
+        assert_in('idx_issue_dataset_status_created', self._plan(query))
+
+    def test_moderation(self):
+        query = Issue.get_issues(visibility='hidden',
+                                 abuse_status=AbuseStatus.unmoderated)
+        assert_in('idx_issue_moderation', self._plan(query))
+
+    def test_users_issues(self):
+        user_id = model.Session.query(Issue.user_id).first()[0]
+        query = model.Session.query(Issue).filter(Issue.user_id == user_id)\
+            .order_by(Issue.created.desc())
+        assert_in('idx_issue_user_created', self._plan(query))
+
 
 class TestIssueUpdate(ClearOnTearDownMixin):
     def test_update_an_issue(self):
@@ -267,6 +267,27 @@ class TestIssueReportShow(ClearOnTearDownMixin, ClearOnSetupClassMixin):
         )
         assert_equals([], result)
 
+    def test_issue_show_reports_for_publisher(self):
+        result = helpers.call_action(
+            'issue_show',
+            context={'user': self.owner['name'], 'model': model},
+            dataset_id=self.dataset['id'],
+            issue_number=self.issue['number'],
+            include_reports=True,
+        )
+        assert_equals(set([self.owner['id'], self.user_0['id']]),
+                      set(result['abuse_reports']))
+
+    def test_issue_show_reports_for_user(self):
+        result = helpers.call_action(
+            'issue_show',
+            context={'user': self.user_0['name'], 'model': model},
+            dataset_id=self.dataset['id'],
+            issue_number=self.issue['number'],
+            include_reports=True,
+        )
+        assert_equals([self.user_0['id']], result['abuse_reports'])
+
 
 class TestReportComment(ClearOnSetupClassMixin, ClearOnTearDownMixin):
     def test_report_comment(self):
@@ -1,3 +1,5 @@
+import mock
+
 from ckan import model
 from ckan.plugins import toolkit
 try:
@@ -7,13 +9,14 @@ except ImportError:
     from ckan.tests import helpers
     from ckan.tests import factories
 
+from ckanext.issues.auth import check_dataset_access
 from ckanext.issues.tests import factories as issue_factories
 from ckanext.issues.tests.helpers import (
     ClearOnTearDownMixin,
     ClearOnSetupClassMixin
 )
 
-from nose.tools import assert_true, assert_raises
+from nose.tools import assert_equals, assert_true, assert_raises
 
 
 class TestIssueUpdate(ClearOnTearDownMixin, ClearOnSetupClassMixin):
@@ -206,3 +209,35 @@ class TestReport(object):
         }
         assert_raises(toolkit.NotAuthorized, helpers.call_auth,
             'issue_report', context=context)
+
+
+class TestCheckDatasetAccess(ClearOnTearDownMixin):
+    def setup(self):
+        self.owner = factories.User()
+        org = factories.Organization(user=self.owner)
+        self.dataset = factories.Dataset(owner_org=org['name'])
+
+    def _check_twice(self, user, decisions):
+        context = {'user': user['name'], 'model': model}
+        results = []
+        with mock.patch('ckanext.issues.auth.request_cache',
+                        return_value=decisions), \
+                mock.patch.object(toolkit, 'check_access',
+                                  wraps=toolkit.check_access) as check_access:
+            for i in range(0, 2):
+                try:
+                    results.append(check_dataset_access(
+                        'package_update', context, self.dataset['id']))
+                except toolkit.NotAuthorized:
+                    results.append(False)
+        return results, check_access.call_count
+
+    def test_allowed_is_remembered_for_the_request(self):
+        assert_equals(([True, True], 1), self._check_twice(self.owner, {}))
+
+    def test_denied_is_remembered_for_the_request(self):
+        assert_equals(([False, False], 1),
+                      self._check_twice(factories.User(), {}))
+
+    def test_not_remembered_outside_a_request(self):
+        assert_equals(([True, True], 2), self._check_twice(self.owner, None))